@@ -0,0 +1,259 @@
+"""Simulate a fleet of coordinators starting at once against local API stand-ins.
+
+    python benchmarks/fleet.py --fleet-sizes 100,500,2000 --processes 4 --capacity 16
+
+Each simulated device is a full CoordinatorContext with its own device UUID, state
+directory and key directory, running mainLoop in its own thread; devices are spread
+over several processes. All devices start together, as after a fleet-wide OS update
+(use --ramp to spread them out instead). For each fleet size, reports the request
+rate, peak concurrency and latency percentiles of every upstream endpoint, as seen
+by the stand-ins, and how long devices took to complete their iterations.
+
+--capacity limits how many requests each control plane service handles at once, so
+queueing shows up in the latencies the way it would with a fixed number of API
+workers.
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+
+from standins import (
+    APP_CREDENTIAL_ID,
+    APP_CREDENTIAL_SECRET,
+    SUPERVISOR_API_KEY,
+    StandInProcess,
+)
+
+from chi_edge_coordinator import update_lock, utils
+from chi_edge_coordinator.context import CoordinatorContext
+from chi_edge_coordinator.coordinator import mainLoop
+
+LOG = logging.getLogger(__name__)
+
+
+def _percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def build_device(workdir, device_uuid) -> CoordinatorContext:
+    ctx = CoordinatorContext(state_dir=os.path.join(workdir, "state", device_uuid))
+    ctx.device_uuid = utils.uuid_hex_to_dashed(device_uuid)
+    wg_config_dir = os.path.join(workdir, "wireguard", device_uuid)
+    os.makedirs(wg_config_dir, exist_ok=True)
+    ctx.wg_config_dir = wg_config_dir
+    return ctx
+
+
+def run_device(ctx, delay, iterations, interval) -> list:
+    time.sleep(delay)
+    results = []
+    for i in range(iterations):
+        if i:
+            time.sleep(interval)
+            ctx.invalidate_hardware()
+        start = time.perf_counter()
+        try:
+            mainLoop(ctx)
+        except Exception as exc:
+            LOG.debug("Device %s failed", ctx.device_uuid, exc_info=True)
+            results.append((time.perf_counter() - start, type(exc).__name__))
+        else:
+            results.append((time.perf_counter() - start, None))
+    return results
+
+
+def run_worker(urls, workdir, device_uuids, options, barrier, results_queue):
+    """Run a share of the fleet in this process, one thread per device."""
+
+    logging.basicConfig(level=logging.CRITICAL)
+    os.environ.update(
+        {
+            "BALENA_SUPERVISOR_ADDRESS": urls["supervisor"],
+            "BALENA_SUPERVISOR_API_KEY": SUPERVISOR_API_KEY,
+            # each simulated device has a different name to set
+            "BALENA_SUPERVISOR_OVERRIDE_LOCK": "1",
+            "OS_AUTH_URL": urls["keystone"] + "/v3",
+            "OS_APPLICATION_CREDENTIAL_ID": APP_CREDENTIAL_ID,
+            "OS_APPLICATION_CREDENTIAL_SECRET": APP_CREDENTIAL_SECRET,
+            "WG_LIVE_APPLY": "0",
+        }
+    )
+    update_lock.LOCKFILE_PATH = os.path.join(workdir, f"updates-{os.getpid()}")
+    devices = [build_device(workdir, device_uuid) for device_uuid in device_uuids]
+    rng = random.Random(os.getpid())
+
+    results = []
+
+    def run(ctx):
+        delay = rng.uniform(0, options["ramp"])
+        results.extend(
+            run_device(ctx, delay, options["iterations"], options["interval"])
+        )
+
+    threads = [threading.Thread(target=run, args=(ctx,)) for ctx in devices]
+    barrier.wait()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results_queue.put(results)
+
+
+def simulate(fleet_size, args) -> dict:
+    standin_options = {
+        "latency": args.latency,
+        "fleet_size": fleet_size,
+        "reservations_per_device": args.reservations,
+        "scoped_allocations": not args.no_scoped_allocations,
+        "capacity": args.capacity,
+    }
+    worker_options = {
+        "ramp": args.ramp,
+        "iterations": args.iterations,
+        "interval": args.interval,
+    }
+    processes = max(1, min(args.processes, fleet_size))
+
+    with StandInProcess(**standin_options) as standins, tempfile.TemporaryDirectory() as workdir:
+        barrier = multiprocessing.Barrier(processes + 1)
+        results_queue = multiprocessing.Queue()
+        workers = [
+            multiprocessing.Process(
+                target=run_worker,
+                args=(
+                    standins.urls,
+                    workdir,
+                    standins.device_uuids[i::processes],
+                    worker_options,
+                    barrier,
+                    results_queue,
+                ),
+            )
+            for i in range(processes)
+        ]
+        for worker in workers:
+            worker.start()
+
+        # wait for every device to be set up, then let them all go
+        barrier.wait()
+        start = time.time()
+        results = []
+        for _ in workers:
+            results.extend(results_queue.get())
+        wall_time = time.time() - start
+        for worker in workers:
+            worker.join()
+
+        stats = standins.stats()
+
+    latencies = sorted(latency for latency, _ in results)
+    failures = {}
+    for _, error in results:
+        if error:
+            failures[error] = failures.get(error, 0) + 1
+
+    endpoints = {}
+    for service, service_stats in stats.items():
+        for endpoint, summary in service_stats["endpoints"].items():
+            summary["rate"] = summary["requests"] / wall_time
+            endpoints[f"{service} {endpoint}"] = summary
+
+    return {
+        "fleet_size": fleet_size,
+        "wall_time_s": wall_time,
+        "iterations": len(results),
+        "failures": failures,
+        "iteration_latency_p50_s": _percentile(latencies, 0.50),
+        "iteration_latency_p95_s": _percentile(latencies, 0.95),
+        "iteration_latency_max_s": latencies[-1] if latencies else 0.0,
+        "iteration_latency_mean_s": statistics.mean(latencies) if latencies else 0.0,
+        "endpoints": endpoints,
+    }
+
+
+def print_report(result):
+    print(
+        "\nfleet of {fleet_size}: {iterations} iterations in {wall_time_s:.1f}s, "
+        "latency p50 {p50:.2f}s p95 {p95:.2f}s max {max:.2f}s, failures {failures}".format(
+            p50=result["iteration_latency_p50_s"],
+            p95=result["iteration_latency_p95_s"],
+            max=result["iteration_latency_max_s"],
+            **result,
+        )
+    )
+    print(
+        f"  {'endpoint':52} {'requests':>8} {'req/s':>8} {'peak/s':>7} "
+        f"{'conc':>5} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+    )
+    for name, summary in sorted(result["endpoints"].items()):
+        print(
+            f"  {name:52} {summary['requests']:8d} {summary['rate']:8.1f} "
+            f"{summary['peak_rate']:7d} {summary['peak_concurrency']:5d} "
+            f"{summary['latency_p50_s'] * 1000:8.1f} "
+            f"{summary['latency_p95_s'] * 1000:8.1f} "
+            f"{summary['latency_p99_s'] * 1000:8.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--fleet-sizes",
+        default="100,500,1000",
+        help="comma separated fleet sizes to simulate in turn",
+    )
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    parser.add_argument(
+        "--latency", type=float, default=0.02, help="seconds added to every request"
+    )
+    parser.add_argument(
+        "--capacity",
+        type=int,
+        help="requests each control plane service serves at once (default unlimited)",
+    )
+    parser.add_argument(
+        "--reservations", type=int, default=3, help="reservations per device"
+    )
+    parser.add_argument(
+        "--no-scoped-allocations",
+        action="store_true",
+        help="make blazar reject per-device allocation lookups",
+    )
+    parser.add_argument(
+        "--ramp",
+        type=float,
+        default=0.0,
+        help="spread device start times uniformly over this many seconds",
+    )
+    parser.add_argument("--iterations", type=int, default=1)
+    parser.add_argument(
+        "--interval", type=float, default=0.0, help="seconds between iterations"
+    )
+    parser.add_argument("--json", metavar="FILE", help="also write results as JSON")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results = []
+    for fleet_size in [int(size) for size in args.fleet_sizes.split(",")]:
+        result = simulate(fleet_size, args)
+        print_report(result)
+        results.append(result)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""Benchmark the wireguard config renderer in hub mode, with thousands of spokes.
+
+    python benchmarks/peers.py --peers 1000,10000 --change-fraction 0.01
+
+For each table size, reports the time to build and write the config from scratch
+(as after a restart), to sync an unchanged channel, to diff a channel in which a
+fraction of the spokes changed, to render the config text, and to sync those
+changes to disk. A full rebuild of every peer, as each tick did before the peer
+table, is timed for comparison. Memory is the tracemalloc peak of the first sync
+and what the manager holds on to after it.
+"""
+
+import argparse
+import copy
+import gc
+import json
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+from chi_edge_coordinator.clients.wgconfig import PeerTable, WireguardManager
+
+PRIVATE_KEY = "cHJpdmF0ZS1rZXktcHJpdmF0ZS1rZXktcHJpdmF0ZS0="
+
+
+def build_channel(num_peers) -> dict:
+    peers = []
+    for i in range(num_peers):
+        peers.append(
+            {
+                "properties": {
+                    "public_key": f"spoke-{i:06d}-" + "x" * 32,
+                    "ip": f"10.{i // 65536 + 100}.{i // 256 % 256}.{i % 256}",
+                    "endpoint": f"198.51.{i // 256 % 256}.{i % 256}:51820",
+                }
+            }
+        )
+    return {"properties": {"ip": "10.100.0.1"}, "peers": peers}
+
+
+def change_peers(channel, fraction, round_number) -> dict:
+    """Move a spread out fraction of the spokes to new endpoints."""
+
+    changed = copy.deepcopy(channel)
+    step = max(int(1 / fraction), 1) if fraction else 0
+    if step:
+        for peer in changed["peers"][round_number % step :: step]:
+            peer["properties"]["endpoint"] = f"203.0.113.{round_number % 256}:51820"
+    return changed
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def benchmark(num_peers, change_fraction, repeat) -> dict:
+    channel = build_channel(num_peers)
+    timings = {
+        "steady_sync_s": [],
+        "diff_s": [],
+        "render_s": [],
+        "changed_sync_s": [],
+        "full_rebuild_s": [],
+    }
+    changed_peers = 0
+
+    with tempfile.TemporaryDirectory() as wg_config_dir:
+        gc.collect()
+        tracemalloc.start()
+        manager = WireguardManager(wg_config_dir=wg_config_dir, hub=True)
+        first_sync_s, _ = timed(manager.sync_config, channel, PRIVATE_KEY)
+        _, peak = tracemalloc.get_traced_memory()
+        gc.collect()
+        retained, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        for round_number in range(1, repeat + 1):
+            elapsed, _ = timed(manager.sync_config, channel, PRIVATE_KEY)
+            timings["steady_sync_s"].append(elapsed)
+
+            changed = change_peers(channel, change_fraction, round_number)
+
+            # diffing and rendering on a copy of the table, so the sync below
+            # still sees the changes
+            table = copy.copy(manager._peer_table)
+            elapsed, changes = timed(table.update, changed["peers"])
+            timings["diff_s"].append(elapsed)
+            changed_peers = len(changes.peers_changed)
+            elapsed, _ = timed(table.render, PRIVATE_KEY)
+            timings["render_s"].append(elapsed)
+
+            elapsed, _ = timed(manager.sync_config, changed, PRIVATE_KEY)
+            timings["changed_sync_s"].append(elapsed)
+            channel = changed
+
+            def full_rebuild():
+                table = PeerTable(subnet_mask=32, persistent_keepalive=None)
+                table.update(channel["peers"])
+                return table.render(PRIVATE_KEY)
+
+            elapsed, _ = timed(full_rebuild)
+            timings["full_rebuild_s"].append(elapsed)
+
+    result = {
+        "peers": num_peers,
+        "changed_peers": changed_peers,
+        "first_sync_s": first_sync_s,
+        "first_sync_peak_kib": peak / 1024,
+        "retained_kib": retained / 1024,
+    }
+    for name, samples in timings.items():
+        result[name] = statistics.median(samples)
+    return result
+
+
+def print_report(results):
+    print(
+        f"{'peers':>7} {'changed':>7} {'first ms':>9} {'steady ms':>9} {'diff ms':>8} "
+        f"{'render ms':>9} {'sync ms':>8} {'rebuild ms':>10} {'peak KiB':>9} "
+        f"{'held KiB':>9}"
+    )
+    for result in results:
+        print(
+            f"{result['peers']:7d} {result['changed_peers']:7d} "
+            f"{result['first_sync_s'] * 1000:9.1f} "
+            f"{result['steady_sync_s'] * 1000:9.2f} "
+            f"{result['diff_s'] * 1000:8.2f} "
+            f"{result['render_s'] * 1000:9.2f} "
+            f"{result['changed_sync_s'] * 1000:8.2f} "
+            f"{result['full_rebuild_s'] * 1000:10.1f} "
+            f"{result['first_sync_peak_kib']:9.0f} "
+            f"{result['retained_kib']:9.0f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--peers", default="100,1000,10000", help="comma separated table sizes"
+    )
+    parser.add_argument(
+        "--change-fraction",
+        type=float,
+        default=0.01,
+        help="fraction of spokes that change between syncs",
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", metavar="FILE", help="also write results as JSON")
+    args = parser.parse_args()
+
+    results = [
+        benchmark(int(size), args.change_fraction, args.repeat)
+        for size in args.peers.split(",")
+    ]
+    print_report(results)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""Benchmark coordinator iterations end to end against local API stand-ins.
+
+    python benchmarks/run.py --iterations 20 --latency 0.02 --fleet-size 500
+    python benchmarks/run.py --save-baseline benchmarks/baseline.json
+    python benchmarks/run.py --compare benchmarks/baseline.json
+
+Reports, for the first (cold) iteration and the steady state after it: wall clock
+latency, requests and bytes per iteration, and CPU time. Peak memory is measured
+over one extra traced iteration, since tracing allocations slows everything else.
+The stand-ins run in a separate process, so only the coordinator is measured.
+
+In production iterations are a minute apart, so the cached Doni record has always
+expired by the next one; the benchmark expires it explicitly between iterations.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from standins import (
+    APP_CREDENTIAL_ID,
+    APP_CREDENTIAL_SECRET,
+    DEVICE_NAME,
+    DEVICE_UUID,
+    SUPERVISOR_API_KEY,
+    StandInProcess,
+)
+
+from chi_edge_coordinator import update_lock
+from chi_edge_coordinator.context import CoordinatorContext
+from chi_edge_coordinator.coordinator import mainLoop, mainLoopAsync
+
+
+def configure_environment(urls, workdir):
+    os.environ.update(
+        {
+            "COORDINATOR_STATE_DIR": os.path.join(workdir, "state"),
+            "BALENA_DEVICE_UUID": DEVICE_UUID,
+            "BALENA_DEVICE_NAME_AT_INIT": DEVICE_NAME,
+            "BALENA_SUPERVISOR_ADDRESS": urls["supervisor"],
+            "BALENA_SUPERVISOR_API_KEY": SUPERVISOR_API_KEY,
+            "OS_AUTH_URL": urls["keystone"] + "/v3",
+            "OS_APPLICATION_CREDENTIAL_ID": APP_CREDENTIAL_ID,
+            "OS_APPLICATION_CREDENTIAL_SECRET": APP_CREDENTIAL_SECRET,
+            # there is no interface to update in place, restart through the supervisor
+            "WG_LIVE_APPLY": "0",
+        }
+    )
+    update_lock.LOCKFILE_PATH = os.path.join(workdir, "updates")
+
+
+def build_context(workdir) -> CoordinatorContext:
+    ctx = CoordinatorContext()
+    wg_config_dir = os.path.join(workdir, "wireguard")
+    os.makedirs(wg_config_dir, exist_ok=True)
+    ctx.wg_config_dir = wg_config_dir
+    return ctx
+
+
+def total(stats, key):
+    return sum(service.get(key, 0) for service in stats.values())
+
+
+def measure(standins, ctx, run_iteration):
+    """Run one iteration, returning its cost."""
+
+    before = standins.stats()
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    run_iteration(ctx)
+    latency = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    after = standins.stats()
+    ctx.end_iteration(duration=latency)
+    ctx.invalidate_hardware()
+
+    return {
+        "latency_s": latency,
+        "cpu_s": cpu,
+        "requests": total(after, "requests") - total(before, "requests"),
+        "bytes": (total(after, "bytes_sent") + total(after, "bytes_received"))
+        - (total(before, "bytes_sent") + total(before, "bytes_received")),
+        "requests_by_service": {
+            name: after[name].get("requests", 0) - before[name].get("requests", 0)
+            for name in after
+        },
+    }
+
+
+def run(args) -> dict:
+    if args.engine == "async":
+        run_iteration = lambda ctx: asyncio.run(mainLoopAsync(ctx))  # noqa: E731
+    else:
+        run_iteration = mainLoop
+
+    options = {
+        "latency": args.latency,
+        "fleet_size": args.fleet_size,
+        "reservations_per_device": args.reservations,
+        "scoped_allocations": not args.no_scoped_allocations,
+        "etags": args.etags,
+    }
+    with StandInProcess(**options) as standins, tempfile.TemporaryDirectory() as workdir:
+        configure_environment(standins.urls, workdir)
+        ctx = build_context(workdir)
+
+        cold = measure(standins, ctx, run_iteration)
+        steady = [measure(standins, ctx, run_iteration) for _ in range(args.iterations)]
+
+        tracemalloc.start()
+        run_iteration(ctx)
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    latencies = sorted(s["latency_s"] for s in steady)
+    return {
+        "config": dict(options, iterations=args.iterations, engine=args.engine),
+        "cold": cold,
+        "steady": {
+            "latency_mean_s": statistics.mean(latencies),
+            "latency_p50_s": latencies[len(latencies) // 2],
+            "latency_p95_s": latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)],
+            "cpu_per_iteration_s": statistics.mean(s["cpu_s"] for s in steady),
+            "requests_per_iteration": statistics.mean(s["requests"] for s in steady),
+            "bytes_per_iteration": statistics.mean(s["bytes"] for s in steady),
+            "requests_by_service": {
+                name: statistics.mean(s["requests_by_service"][name] for s in steady)
+                for name in steady[0]["requests_by_service"]
+            },
+        },
+        "peak_traced_memory_kib": peak_memory / 1024,
+        "max_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def flatten(results, prefix=""):
+    flat = {}
+    for key, value in results.items():
+        if key == "config":
+            continue
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix=f"{name}."))
+        elif isinstance(value, (int, float)):
+            flat[name] = value
+    return flat
+
+
+def compare(baseline, results, fail_over=None) -> bool:
+    """Print each metric against the baseline; False if any grew more than fail_over %."""
+
+    if baseline.get("config") != results["config"]:
+        print("warning: baseline was recorded with a different configuration")
+
+    ok = True
+    current = flatten(results)
+    print(f"{'metric':45} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name, base_value in flatten(baseline).items():
+        value = current.get(name)
+        if value is None:
+            continue
+        change = (value - base_value) / base_value * 100 if base_value else 0.0
+        flag = ""
+        if fail_over is not None and change > fail_over:
+            flag = "  REGRESSION"
+            ok = False
+        print(f"{name:45} {base_value:12.4f} {value:12.4f} {change:+7.1f}%{flag}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument(
+        "--latency", type=float, default=0.02, help="seconds added to every request"
+    )
+    parser.add_argument("--fleet-size", type=int, default=500)
+    parser.add_argument(
+        "--reservations", type=int, default=3, help="reservations per device"
+    )
+    parser.add_argument(
+        "--no-scoped-allocations",
+        action="store_true",
+        help="make blazar reject per-device allocation lookups",
+    )
+    parser.add_argument(
+        "--etags", action="store_true", help="send ETags and honour If-None-Match"
+    )
+    parser.add_argument("--engine", choices=["loop", "async"], default="loop")
+    parser.add_argument("--save-baseline", metavar="FILE")
+    parser.add_argument("--compare", metavar="FILE")
+    parser.add_argument(
+        "--fail-over",
+        type=float,
+        metavar="PERCENT",
+        help="with --compare, exit non-zero if any metric grew by more than this",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results = run(args)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if not compare(baseline, results, args.fail_over):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
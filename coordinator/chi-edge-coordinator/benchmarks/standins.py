@@ -0,0 +1,499 @@
+"""Local stand-ins for the APIs the coordinator talks to.
+
+Each service gets its own HTTP server on localhost, so connection reuse behaves as
+it would against separate hosts. The servers add a configurable latency to every
+request, can limit how many requests they serve at once to model a control plane
+of a given size, and count requests, bytes, concurrency and latency per endpoint.
+`GET /_stats` reports these (without being counted itself).
+"""
+
+import hashlib
+import json
+import multiprocessing
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.request import urlopen
+
+DEVICE_NAME = "bench-rpi4-0001"
+DEVICE_UUID = "0f1e2d3c4b5a69788796a5b4c3d2e1f0"
+HUB_PUBKEY = "aHViLWtleS1odWIta2V5LWh1Yi1rZXktaHViLWtleS0="
+SUPERVISOR_API_KEY = "bench-supervisor-key"
+APP_CREDENTIAL_ID = "bench-credential"
+APP_CREDENTIAL_SECRET = "bench-secret"
+
+
+def _dashed(uuid_hex):
+    return str(uuid.UUID(uuid_hex))
+
+
+def _percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+class EndpointStats(object):
+    def __init__(self) -> None:
+        self.latencies = []
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.arrivals = Counter()
+
+    def summary(self) -> dict:
+        ordered = sorted(self.latencies)
+        return {
+            "requests": len(ordered),
+            "peak_concurrency": self.peak_in_flight,
+            "peak_rate": max(self.arrivals.values(), default=0),
+            "first_arrival": min(self.arrivals, default=None),
+            "last_arrival": max(self.arrivals, default=None),
+            "latency_p50_s": _percentile(ordered, 0.50),
+            "latency_p95_s": _percentile(ordered, 0.95),
+            "latency_p99_s": _percentile(ordered, 0.99),
+            "latency_max_s": ordered[-1] if ordered else 0.0,
+        }
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # a booting fleet opens many connections at once
+    request_queue_size = 1024
+
+    def __init__(self, name, routes, latency=0.0, etags=False, capacity=None) -> None:
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.name = name
+        # endpoints are reported by their route, with path parameters as {id}
+        self.routes = [
+            (
+                method,
+                re.sub(r"\([^)]*\)", "{id}", pattern),
+                re.compile(pattern + "$"),
+                handler,
+            )
+            for method, pattern, handler in routes
+        ]
+        self.latency = latency
+        self.etags = etags
+        # requests served at once; others wait, as they would for API workers
+        self.workers = threading.BoundedSemaphore(capacity) if capacity else None
+        self.stats = Counter()
+        self.endpoints = {}
+        self.stats_lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+    def count(self, **amounts):
+        with self.stats_lock:
+            self.stats.update(amounts)
+
+    def request_started(self, endpoint) -> EndpointStats:
+        with self.stats_lock:
+            stats = self.endpoints.setdefault(endpoint, EndpointStats())
+            stats.in_flight += 1
+            stats.peak_in_flight = max(stats.peak_in_flight, stats.in_flight)
+            stats.arrivals[int(time.time())] += 1
+        return stats
+
+    def request_finished(self, stats: EndpointStats, latency):
+        with self.stats_lock:
+            stats.in_flight -= 1
+            stats.latencies.append(latency)
+
+    def report(self) -> dict:
+        with self.stats_lock:
+            report = dict(self.stats)
+            report["endpoints"] = {
+                endpoint: stats.summary() for endpoint, stats in self.endpoints.items()
+            }
+        return report
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in separate writes; without this, Nagle holds the body
+    # back until the client's delayed ACK of the headers, adding ~40ms to a request
+    disable_nagle_algorithm = True
+    server: StandInServer
+
+    def _dispatch(self, method):
+        start = time.perf_counter()
+        path = self.path.split("?")[0]
+        length = int(self.headers.get("Content-Length") or 0)
+        raw_body = self.rfile.read(length) if length else b""
+
+        if method == "GET" and path == "/_stats":
+            self._send(200, self.server.report(), count=False)
+            return
+
+        self.server.count(requests=1, bytes_received=len(raw_body))
+        for route_method, route, pattern, handler in self.server.routes:
+            match = pattern.match(path)
+            if route_method == method and match:
+                break
+        else:
+            self._send(404, {"error": f"no route for {method} {path}"})
+            return
+
+        stats = self.server.request_started(f"{method} {route}")
+        try:
+            if self.server.workers:
+                self.server.workers.acquire()
+            try:
+                if self.server.latency:
+                    time.sleep(self.server.latency)
+                body = json.loads(raw_body) if raw_body else None
+                status, payload, headers = handler(match, body)
+            finally:
+                if self.server.workers:
+                    self.server.workers.release()
+            self._send(status, payload, headers)
+        finally:
+            self.server.request_finished(stats, time.perf_counter() - start)
+
+    def _send(self, status, payload, headers=None, count=True):
+        body = b"" if payload is None else json.dumps(payload).encode()
+        headers = dict(headers or {})
+
+        if self.server.etags and status == 200 and self.command == "GET" and count:
+            etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+            headers["ETag"] = etag
+            if self.headers.get("If-None-Match") == etag:
+                status, body = 304, b""
+
+        self.send_response(status)
+        if body:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        if count:
+            self.server.count(bytes_sent=len(body))
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_PATCH(self):
+        self._dispatch("PATCH")
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FleetData(object):
+    """Inventory, channel and reservation state for a fleet of devices.
+
+    The first device is the one the single-device benchmark runs as.
+    """
+
+    def __init__(self, fleet_size=100, reservations_per_device=3, seed=0) -> None:
+        rng = random.Random(seed)
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+
+        def new_uuid():
+            return uuid.UUID(int=rng.getrandbits(128))
+
+        self.device_uuids = []
+        self.devices = []
+        self.allocations = []
+        self.hardware = {}
+        self.channels = {}
+        for i in range(fleet_size):
+            device_uuid = DEVICE_UUID if i == 0 else new_uuid().hex
+            name = DEVICE_NAME if i == 0 else f"bench-device-{i:05d}"
+            blazar_id = str(new_uuid())
+            channel_uuid = str(new_uuid())
+            self.device_uuids.append(device_uuid)
+            self.devices.append({"id": blazar_id, "name": name})
+
+            reservations = []
+            for r in range(reservations_per_device):
+                # reservations spread over the next week, none covering now
+                start = now + timedelta(hours=2 + r * 24 + rng.randint(0, 12))
+                reservations.append(
+                    {
+                        "id": f"res-{blazar_id[:8]}-{r}",
+                        "lease_id": f"lease-{blazar_id[:8]}-{r}",
+                        "start_date": start.isoformat(),
+                        "end_date": (start + timedelta(hours=4)).isoformat(),
+                    }
+                )
+            self.allocations.append(
+                {"resource_id": blazar_id, "reservations": reservations}
+            )
+
+            self.hardware[_dashed(device_uuid)] = {
+                "uuid": _dashed(device_uuid),
+                "name": name,
+                "workers": [
+                    {
+                        "worker_type": "tunelo",
+                        "state_details": {"channels": {"user": {"uuid": channel_uuid}}},
+                    }
+                ],
+                "properties": {"channels": {}},
+            }
+            self.channels[channel_uuid] = {
+                "uuid": channel_uuid,
+                "properties": {
+                    "ip": "10.{}.{}.{}".format(20 + i // 65536, i // 256 % 256, i % 256)
+                },
+                "peers": [
+                    {
+                        "properties": {
+                            "public_key": HUB_PUBKEY,
+                            "endpoint": "192.0.2.10:51820",
+                            "ip": "10.20.0.1",
+                        }
+                    }
+                ],
+            }
+
+
+def _json_patch(document, operations):
+    for op in operations:
+        keys = op["path"].strip("/").split("/")
+        target = document
+        for key in keys[:-1]:
+            target = target[key]
+        if op["op"] in ("add", "replace"):
+            target[keys[-1]] = op["value"]
+        elif op["op"] == "remove":
+            target.pop(keys[-1], None)
+
+
+def _keystone_routes(catalog_urls):
+    def issue_token(match, body):
+        expires = datetime.now(timezone.utc) + timedelta(hours=1)
+        catalog = [
+            {
+                "type": service_type,
+                "name": service_type,
+                "id": service_type,
+                "endpoints": [
+                    {
+                        "id": f"{service_type}-public",
+                        "interface": "public",
+                        "region": "RegionOne",
+                        "region_id": "RegionOne",
+                        "url": url,
+                    }
+                ],
+            }
+            for service_type, url in catalog_urls.items()
+        ]
+        token = {
+            "token": {
+                "methods": ["application_credential"],
+                "issued_at": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000000Z"),
+                "expires_at": expires.strftime("%Y-%m-%dT%H:%M:%S.000000Z"),
+                "user": {
+                    "id": "bench-user",
+                    "name": "bench",
+                    "domain": {"id": "default", "name": "Default"},
+                },
+                "project": {
+                    "id": "bench-project",
+                    "name": "bench",
+                    "domain": {"id": "default", "name": "Default"},
+                },
+                "roles": [{"id": "member", "name": "member"}],
+                "application_credential": {
+                    "id": APP_CREDENTIAL_ID,
+                    "name": "bench",
+                    "restricted": True,
+                },
+                "catalog": catalog,
+            }
+        }
+        return 201, token, {"X-Subject-Token": uuid.uuid4().hex}
+
+    return [("POST", "/v3/auth/tokens", issue_token)]
+
+
+def _doni_routes(fleet: FleetData):
+    def get_hardware(match, body):
+        hardware = fleet.hardware.get(match.group(1))
+        if hardware is None:
+            return 404, {"error": "not found"}, None
+        return 200, hardware, None
+
+    def patch_hardware(match, body):
+        hardware = fleet.hardware.get(match.group(1))
+        if hardware is None:
+            return 404, {"error": "not found"}, None
+        _json_patch(hardware, body)
+        return 200, hardware, None
+
+    return [
+        ("GET", r"/v1/hardware/([^/]+)", get_hardware),
+        ("PATCH", r"/v1/hardware/([^/]+)", patch_hardware),
+    ]
+
+
+def _tunelo_routes(fleet: FleetData):
+    def get_channel(match, body):
+        channel = fleet.channels.get(match.group(1))
+        if channel is None:
+            return 404, {"error": "not found"}, None
+        return 200, channel, None
+
+    return [("GET", r"/channels/([^/]+)", get_channel)]
+
+
+def _blazar_routes(fleet: FleetData, scoped_allocations=True):
+    by_id = {alloc["resource_id"]: alloc for alloc in fleet.allocations}
+
+    def get_allocation(match, body):
+        allocation = by_id.get(match.group(1))
+        if not scoped_allocations or allocation is None:
+            return 404, {"error": "not found"}, None
+        return 200, {"allocation": allocation}, None
+
+    return [
+        ("GET", "/devices", lambda m, b: (200, {"devices": fleet.devices}, None)),
+        (
+            "GET",
+            "/devices/allocations",
+            lambda m, b: (200, {"allocations": fleet.allocations}, None),
+        ),
+        ("GET", r"/devices/([^/]+)/allocation", get_allocation),
+    ]
+
+
+def _supervisor_routes():
+    state = {
+        "status": "success",
+        "appState": "applied",
+        "containers": [
+            {"status": "Running", "serviceName": "wireguard", "appId": 1},
+            {"status": "Running", "serviceName": "k3s", "appId": 1},
+            {"status": "Running", "serviceName": "coordinator", "appId": 1},
+        ],
+    }
+    return [
+        ("GET", "/ping", lambda m, b: (200, None, None)),
+        ("GET", "/v2/state/status", lambda m, b: (200, state, None)),
+        ("PATCH", "/v1/device/host-config", lambda m, b: (200, {}, None)),
+        (
+            "POST",
+            r"/v2/applications/(\d+)/restart-service",
+            lambda m, b: (200, {}, None),
+        ),
+    ]
+
+
+class StandIns(object):
+    """All of the coordinator's upstream services, running in this process."""
+
+    def __init__(
+        self,
+        latency=0.0,
+        fleet_size=100,
+        reservations_per_device=3,
+        scoped_allocations=True,
+        etags=False,
+        capacity=None,
+    ) -> None:
+        self.fleet = FleetData(fleet_size, reservations_per_device)
+        self.servers = {
+            "doni": StandInServer(
+                "doni", _doni_routes(self.fleet), latency, etags, capacity
+            ),
+            "tunelo": StandInServer(
+                "tunelo", _tunelo_routes(self.fleet), latency, etags, capacity
+            ),
+            "blazar": StandInServer(
+                "blazar",
+                _blazar_routes(self.fleet, scoped_allocations),
+                latency,
+                etags,
+                capacity,
+            ),
+            # every device has its own supervisor, so it's never a shared bottleneck
+            "supervisor": StandInServer("supervisor", _supervisor_routes(), latency),
+        }
+        catalog_urls = {
+            "inventory": self.servers["doni"].url,
+            "channel": self.servers["tunelo"].url,
+            "reservation": self.servers["blazar"].url,
+        }
+        self.servers["keystone"] = StandInServer(
+            "keystone", _keystone_routes(catalog_urls), latency, capacity=capacity
+        )
+        self._threads = []
+
+    def urls(self) -> dict:
+        return {name: server.url for name, server in self.servers.items()}
+
+    def start(self):
+        for server in self.servers.values():
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        for server in self.servers.values():
+            server.shutdown()
+            server.server_close()
+
+
+def _serve(options, conn):
+    standins = StandIns(**options)
+    standins.start()
+    conn.send((standins.urls(), standins.fleet.device_uuids))
+    # serve until the parent closes its end
+    try:
+        conn.recv()
+    except EOFError:
+        pass
+    standins.stop()
+
+
+class StandInProcess(object):
+    """Runs the stand-ins in a child process, so their CPU and memory use stays out
+    of the coordinator's measurements."""
+
+    def __init__(self, **options) -> None:
+        self.options = options
+        self.urls = None
+        self.device_uuids = None
+        self._process = None
+        self._conn = None
+
+    def __enter__(self) -> "StandInProcess":
+        parent_conn, child_conn = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(
+            target=_serve, args=(self.options, child_conn), daemon=True
+        )
+        self._process.start()
+        self._conn = parent_conn
+        self.urls, self.device_uuids = parent_conn.recv()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._conn.close()
+        self._process.join(timeout=5)
+        if self._process.is_alive():
+            self._process.terminate()
+
+    def stats(self) -> dict:
+        """Request, byte and per-endpoint counts per service since the stand-ins started."""
+
+        stats = {}
+        for name, url in self.urls.items():
+            with urlopen(f"{url}/_stats") as response:
+                stats[name] = json.loads(response.read())
+        return stats
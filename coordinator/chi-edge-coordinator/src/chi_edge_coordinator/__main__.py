@@ -0,0 +1,3 @@
+from chi_edge_coordinator.coordinator import main
+
+main()
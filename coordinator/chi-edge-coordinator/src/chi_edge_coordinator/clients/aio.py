@@ -0,0 +1,59 @@
+"""Asyncio variants of the coordinator's HTTP clients.
+
+The underlying clients are built on blocking ``requests`` sessions, so each call is
+run in a worker thread. This lets independent requests be awaited concurrently
+while still sharing the synchronous clients' keystone session and connection pool.
+"""
+
+import asyncio
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from chi_edge_coordinator.clients.balena import BalenaSupervisorClient
+    from chi_edge_coordinator.clients.openstack import (
+        BlazarClient,
+        DoniClient,
+        TuneloClient,
+    )
+
+
+class AsyncClient(object):
+    def __init__(self, client) -> None:
+        self.client = client
+
+    async def _call(self, method, *args, **kwargs):
+        return await asyncio.to_thread(method, *args, **kwargs)
+
+
+class AsyncDoniClient(AsyncClient):
+    client: "DoniClient"
+
+    async def get_hardware(self, uuid):
+        return await self._call(self.client.get_hardware, uuid)
+
+    async def patch_hardware(self, uuid, jsonpatch):
+        return await self._call(self.client.patch_hardware, uuid=uuid, jsonpatch=jsonpatch)
+
+
+class AsyncTuneloClient(AsyncClient):
+    client: "TuneloClient"
+
+    async def get_channel(self, uuid):
+        return await self._call(self.client.get_channel, uuid)
+
+
+class AsyncBlazarClient(AsyncClient):
+    client: "BlazarClient"
+
+    async def get_device_id(self, device_name):
+        return await self._call(self.client.get_device_id, device_name)
+
+    async def get_device_allocations(self, device_id):
+        return await self._call(self.client.get_device_allocations, device_id)
+
+
+class AsyncSupervisorClient(AsyncClient):
+    client: "BalenaSupervisorClient"
+
+    async def sync_device_hostname(self, name):
+        return await self._call(self.client.sync_device_hostname, name=name)
@@ -1,11 +1,85 @@
 import logging
 import os
+import time
 from urllib.parse import urljoin
 
 import requests
 
+from chi_edge_coordinator import deadline, metrics
+
 LOG = logging.getLogger(__name__)
 
+# (connect, read) timeouts; the supervisor is local, so a slow answer means trouble
+SUPERVISOR_TIMEOUT = (
+    float(os.getenv("SUPERVISOR_CONNECT_TIMEOUT", "3.05")),
+    float(os.getenv("SUPERVISOR_READ_TIMEOUT", "10")),
+)
+MAX_RETRIES = 2
+RETRY_BACKOFF = 0.5
+RETRY_STATUSES = frozenset([502, 503, 504])
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "OPTIONS", "PUT", "DELETE"])
+# consecutive failures before calls fail fast, and for how long
+CIRCUIT_FAILURE_THRESHOLD = 3
+CIRCUIT_RESET_TIMEOUT = 30.0
+
+
+class SupervisorUnavailable(Exception):
+    """The supervisor has been failing, so calls are refused until it recovers."""
+
+
+class CircuitBreaker(object):
+    """Fails calls fast after repeated failures, letting one through now and then.
+
+    While open, callers get an immediate error instead of each waiting out its
+    own timeouts, so a dead supervisor doesn't hold up other reconciliation work.
+    """
+
+    def __init__(
+        self,
+        failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+        reset_timeout=CIRCUIT_RESET_TIMEOUT,
+        clock=time.monotonic,
+    ) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self.failures = 0
+        self.opened_at = None
+
+    @property
+    def open(self) -> bool:
+        return self.opened_at is not None
+
+    def check(self):
+        """Raise SupervisorUnavailable unless a call should be attempted."""
+
+        if self.opened_at is None:
+            return
+        waited = self._clock() - self.opened_at
+        if waited < self.reset_timeout:
+            raise SupervisorUnavailable(
+                f"Supervisor unavailable after {self.failures} failures, "
+                f"retrying in {self.reset_timeout - waited:.0f}s"
+            )
+        # half open: let this call through as a probe
+
+    def record_success(self):
+        if self.opened_at is not None:
+            LOG.info("Supervisor reachable again")
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                LOG.warning(
+                    "Supervisor failed %d times in a row, failing fast for %.0fs",
+                    self.failures,
+                    self.reset_timeout,
+                )
+            self.opened_at = self._clock()
+
 
 class BalenaSupervisorClient(object):
     """Implements REST API communication with balena supervisor.
@@ -16,7 +90,7 @@ class BalenaSupervisorClient(object):
     supervisor_address = ""
     supervisor_api_key = ""
 
-    def __init__(self, supervisor_api_address, supervisor_api_key):
+    def __init__(self, supervisor_api_address, supervisor_api_key, breaker=None):
         """Initialize URL and api key for supervisor"""
 
         self.supervisor_address = supervisor_api_address
@@ -25,24 +99,78 @@ class BalenaSupervisorClient(object):
         if not (self.supervisor_address and self.supervisor_api_key):
             raise RuntimeError("Missing Balena supervisor configuration")
 
+        # keep-alive connections, rather than a new one for every call
+        self.session = requests.Session()
+        self.breaker = breaker or CircuitBreaker()
+        metrics.SUPERVISOR_CIRCUIT_OPEN.set_function(lambda: float(self.breaker.open))
+
+    def _request(self, method, url, idempotent=None, **kwargs):
+        """Send a request with timeouts, retrying idempotent ones on transient errors."""
+
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        attempts = 1 + MAX_RETRIES if idempotent else 1
+
+        self.breaker.check()
+        for attempt in range(attempts):
+            if attempt:
+                delay = RETRY_BACKOFF * 2 ** (attempt - 1)
+                left = deadline.remaining()
+                if left is not None:
+                    delay = min(delay, max(left, 0))
+                time.sleep(delay)
+
+            try:
+                with metrics.observe_request("supervisor", method) as observe:
+                    response = self.session.request(
+                        method=method,
+                        url=url,
+                        timeout=deadline.timeout(SUPERVISOR_TIMEOUT),
+                        **kwargs,
+                    )
+                    observe(response)
+            except (requests.ConnectionError, requests.Timeout) as exc:
+                LOG.warning("Supervisor %s %s failed: %s", method.upper(), url, exc)
+                if attempt + 1 == attempts:
+                    self.breaker.record_failure()
+                    raise
+                continue
+
+            if response.status_code in RETRY_STATUSES and attempt + 1 < attempts:
+                continue
+            # any server error counts against the supervisor, even one not worth
+            # retrying; client errors mean it's up and answering
+            if response.status_code >= 500:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            return response
+
     def ping(self) -> bool:
         """Checks if we can contact supervisor."""
 
         path = urljoin(self.supervisor_address, "ping")  # type: ignore
-        response = requests.get(url=path)
+        try:
+            response = self._request("get", path)
+        except (requests.RequestException, SupervisorUnavailable):
+            return False
         return response.ok
 
-    def call_supervisor(self, path, method="get", json=None) -> dict:
-        """Send authenticated http request to the supervisor."""
+    def call_supervisor(self, path, method="get", json=None, idempotent=None) -> dict:
+        """Send authenticated http request to the supervisor.
+
+        GETs are retried on transient failures; other methods only if `idempotent`.
+        """
 
         request_path = urljoin(self.supervisor_address, path)  # type: ignore
 
         headers = {"Content-Type": "application/json"}
         params = {"apikey": self.supervisor_api_key}
 
-        response = requests.request(
-            method=method,
-            url=request_path,
+        response = self._request(
+            method,
+            request_path,
+            idempotent=idempotent,
             params=params,
             headers=headers,
             json=json,
@@ -66,30 +194,43 @@ class BalenaSupervisorClient(object):
             path=path, method="post", json={"serviceName": service_name}
         )
 
-    def restart_service(self, service_name):
-        """Ask supervisor to restart a service by name."""
+    def get_state(self) -> "SupervisorState":
+        """Fetch a snapshot of the device's container state."""
 
-        status = self.call_supervisor("/v2/state/status")
-        container_state_list = [
-            s
-            for s in status.get("containers", [])
-            if s.get("serviceName") == service_name
-        ]
+        return SupervisorState(self.call_supervisor("/v2/state/status"))
 
-        for container in container_state_list:
-            containerStatus = container.get("status")
-            if containerStatus == "Running":
-                LOG.info("applying requested restart for service %s", service_name)
-                self._restart_service(
-                    app_id=container["appId"],
-                    service_name=service_name,
-                )
-            else:
-                LOG.warning(
-                    "skipping restart, container %s in state %s",
-                    service_name,
-                    containerStatus,
-                )
+    def restart_service(self, service_name, state=None):
+        """Ask supervisor to restart a service by name."""
+
+        return self.restart_services([service_name], state=state)
+
+    def restart_services(self, service_names, state=None) -> list:
+        """Restart several services, looking all of them up in one state snapshot.
+
+        Returns the names of the services that were restarted.
+        """
+
+        if state is None:
+            state = self.get_state()
+
+        restarted = []
+        for service_name in service_names:
+            for container in state.containers_for(service_name):
+                containerStatus = container.get("status")
+                if containerStatus == "Running":
+                    LOG.info("applying requested restart for service %s", service_name)
+                    self._restart_service(
+                        app_id=container["appId"],
+                        service_name=service_name,
+                    )
+                    restarted.append(service_name)
+                else:
+                    LOG.warning(
+                        "skipping restart, container %s in state %s",
+                        service_name,
+                        containerStatus,
+                    )
+        return restarted
 
     def _set_device_hostname(self, name):
         """Call supervisor to update balena device's hostname."""
@@ -99,6 +240,7 @@ class BalenaSupervisorClient(object):
             path="/v1/device/host-config",
             method="patch",
             json={"network": {"hostname": name}},
+            idempotent=True,
         )
 
     def sync_device_hostname(self, name):
@@ -115,16 +257,34 @@ class BalenaSupervisorClient(object):
             path="/v1/device/host-config",
             method="patch",
             json={"network": {"hostname": name}},
+            idempotent=True,
         )
 
-    def find_k3s_service_name(self) -> str:
+    def find_k3s_service_name(self, state=None) -> str:
         """Return name of k3s service on this device."""
 
-        status: dict = self.call_supervisor("/v2/state/status")
+        if state is None:
+            state = self.get_state()
+        return state.k3s_service_name()
+
+
+class SupervisorState(object):
+    """Snapshot of supervisor's /v2/state/status, shared by lookups in one pass."""
+
+    def __init__(self, status: dict) -> None:
+        self.status = status or {}
+
+    @property
+    def containers(self) -> list:
+        return self.status.get("containers", [])
+
+    def containers_for(self, service_name) -> list:
+        return [c for c in self.containers if c.get("serviceName") == service_name]
 
+    def k3s_service_name(self) -> str:
         k3s_service_names = [
             c.get("serviceName")
-            for c in status.get("containers", [])
+            for c in self.containers
             if c.get("serviceName", "").startswith("k3s")
         ]
 
@@ -1,60 +1,270 @@
+import json
 import logging
+import os
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
 
+from keystoneauth1 import exceptions as ks_exc
 from keystoneauth1.adapter import Adapter
+from keystoneauth1.identity.v3 import application_credential
 from keystoneauth1.session import Session
 
+from chi_edge_coordinator import deadline, metrics, tracing, utils
+
 LOG = logging.getLogger(__name__)
 
+DEVICE_ID_CACHE_TTL = 24 * 60 * 60
+# without ETag/Last-Modified, responses are refetched unless a call opts into a TTL
+DEFAULT_RESPONSE_TTL = 0.0
+FULL_ALLOCATIONS_TTL = 30.0
+# reservations further out than this can't affect the update lock yet
+ALLOCATION_HORIZON = timedelta(days=1)
+# per request, including token requests; the iteration deadline may cut it shorter
+REQUEST_TIMEOUT = float(os.getenv("OS_REQUEST_TIMEOUT", "30"))
+
+
+class CountingApplicationCredential(application_credential.ApplicationCredential):
+    """Application credential auth plugin that counts token issuances and reuses."""
+
+    tokens_issued = 0
+    # authenticated requests sent with a token that was already held
+    tokens_reused = 0
+
+    def get_auth_ref(self, session, **kwargs):
+        self.tokens_issued += 1
+        with tracing.span("keystone_auth"):
+            return super().get_auth_ref(session, **kwargs)
+
+    def get_headers(self, session, **kwargs):
+        # called once per authenticated request
+        issued = self.tokens_issued
+        headers = super().get_headers(session, **kwargs)
+        if self.tokens_issued == issued:
+            self.tokens_reused += 1
+        return headers
+
+
+class DeadlineSession(Session):
+    """Session whose requests never outlive the current iteration deadline."""
+
+    def __init__(self, auth=None, timeout=REQUEST_TIMEOUT, **kwargs) -> None:
+        super().__init__(auth=auth, timeout=timeout, **kwargs)
+
+    def request(self, url, method, **kwargs):
+        kwargs["timeout"] = deadline.timeout(kwargs.get("timeout") or self.timeout)
+        return super().request(url, method, **kwargs)
+
 
 class OpenstackClient(Adapter):
-    def __init__(self, auth, service_type) -> None:
+    # label for this client's request metrics
+    metrics_name = "openstack"
+
+    def __init__(self, auth=None, service_type=None, session=None) -> None:
+        # Clients built from a shared session reuse its token and connection pool
+        if session is None:
+            session = DeadlineSession(auth)
         super().__init__(
-            session=Session(auth),
+            session=session,
             interface="public",
             service_type=service_type,
         )
+        self._response_cache = {}
+        self.cache_stats = {}
+
+    def request(self, url, method, **kwargs):
+        with metrics.observe_request(self.metrics_name, method) as observe:
+            response = super().request(url, method, **kwargs)
+            observe(response)
+        return response
+
+    def get_json(self, path, ttl=DEFAULT_RESPONSE_TTL):
+        """GET a JSON document, reusing the cached body if the server says it's unchanged.
+
+        Cached responses with an ETag or Last-Modified header are revalidated with a
+        conditional request; others are reused without a request for `ttl` seconds.
+        """
+
+        stats = self.cache_stats.setdefault(path, Counter())
+        entry = self._response_cache.get(path)
+
+        headers = {}
+        if entry:
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+            if not headers and time.monotonic() - entry["fetched_at"] < ttl:
+                stats["hits"] += 1
+                stats["bytes_saved"] += entry["size"]
+                return entry["body"]
+
+        if headers:
+            result = self.get(url=path, headers=headers)
+        else:
+            result = self.get(url=path)
+
+        if entry and result.status_code == 304:
+            entry["fetched_at"] = time.monotonic()
+            stats["hits"] += 1
+            stats["bytes_saved"] += entry["size"]
+            return entry["body"]
+
+        body = result.json()
+        self._response_cache[path] = {
+            "etag": result.headers.get("ETag"),
+            "last_modified": result.headers.get("Last-Modified"),
+            "body": body,
+            "size": len(result.content),
+            "fetched_at": time.monotonic(),
+        }
+        stats["misses"] += 1
+        return body
+
+    def invalidate(self, path):
+        self._response_cache.pop(path, None)
 
 
 class DoniClient(OpenstackClient):
-    def __init__(self, auth) -> None:
-        super().__init__(auth, service_type="inventory")
+    metrics_name = "doni"
+
+    def __init__(self, auth=None, session=None) -> None:
+        super().__init__(auth, service_type="inventory", session=session)
 
     def get_hardware(self, uuid):
         path = "/v1/hardware/{}".format(uuid)
-        result = self.get(url=path)
-        return result.json()
+        return self.get_json(path)
 
     def patch_hardware(self, uuid, jsonpatch):
         LOG.debug("sending patch: %s", jsonpatch)
         path = "/v1/hardware/{}".format(uuid)
         result = self.patch(url=path, json=jsonpatch)
+        self.invalidate(path)
         return result.json()
 
 
 class TuneloClient(OpenstackClient):
-    def __init__(self, auth) -> None:
-        super().__init__(auth, service_type="channel")
+    metrics_name = "tunelo"
+
+    def __init__(self, auth=None, session=None) -> None:
+        super().__init__(auth, service_type="channel", session=session)
 
     def get_channel(self, uuid):
         path = "/channels/{}".format(uuid)
-        result = self.get(url=path)
-        return result.json()
+        return self.get_json(path)
 
 
 class BlazarClient(OpenstackClient):
-    def __init__(self, auth) -> None:
-        super().__init__(auth, service_type="reservation")
+    metrics_name = "blazar"
+
+    def __init__(self, auth=None, session=None, device_id_cache=None) -> None:
+        super().__init__(auth, service_type="reservation", session=session)
+        # device name -> id rarely changes, so remember it across restarts
+        self.device_id_cache = Path(device_id_cache) if device_id_cache else None
+        self._device_ids = self._load_device_ids()
+        # cleared if the server can't look up a single device's allocation
+        self._scoped_allocations = True
+
+    def _load_device_ids(self) -> dict:
+        if not self.device_id_cache:
+            return {}
+        try:
+            return json.loads(self.device_id_cache.read_text())
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            LOG.warning("Ignoring unreadable device cache %s", self.device_id_cache)
+            return {}
+
+    def _save_device_ids(self):
+        if not self.device_id_cache:
+            return
+        try:
+            utils.atomic_write(
+                self.device_id_cache, json.dumps(self._device_ids), mode=0o644
+            )
+        except OSError:
+            LOG.exception("Failed to write device cache")
 
     def get_device_id(self, device_name):
-        result = self.get(url="/devices")
-        for device in result.json()["devices"]:
+        cached = self._device_ids.get(device_name)
+        if cached and time.time() - cached["fetched_at"] < DEVICE_ID_CACHE_TTL:
+            return cached["id"]
+
+        for device in self.get_json("/devices")["devices"]:
             if device.get("name") == device_name:
+                self._device_ids[device_name] = {
+                    "id": device["id"],
+                    "fetched_at": time.time(),
+                }
+                self._save_device_ids()
                 return device["id"]
+
+        if self._device_ids.pop(device_name, None):
+            self._save_device_ids()
         return None
 
-    def get_device_allocations(self, device_id):
-        result = self.get(url="/devices/allocations")
-        for device in result.json()["allocations"]:
+    def _forget_device_id(self, device_id):
+        """Drop a cached id blazar no longer knows, so the next lookup is by name."""
+
+        stale = [
+            name for name, cached in self._device_ids.items() if cached["id"] == device_id
+        ]
+        for name in stale:
+            LOG.info("Device %s is no longer %s in blazar", name, device_id)
+            del self._device_ids[name]
+        if stale:
+            self._save_device_ids()
+
+    def _get_all_device_allocations(self, device_id):
+        allocations = self.get_json("/devices/allocations", ttl=FULL_ALLOCATIONS_TTL)
+        for device in allocations["allocations"]:
             if device["resource_id"] == device_id:
                 return device.get("reservations", [])
-        return []
+        return None
+
+    def get_device_allocations(self, device_id, horizon=ALLOCATION_HORIZON):
+        """Return reservations for a device that overlap the next `horizon`.
+
+        A horizon of None returns every reservation blazar knows about. Returns
+        None if blazar doesn't know the device, e.g. because it was re-enrolled
+        under a new id since get_device_id cached it.
+        """
+
+        reservations = None
+        if self._scoped_allocations:
+            try:
+                result = self.get_json("/devices/{}/allocation".format(device_id))
+                reservations = result["allocation"].get("reservations", [])
+            except (ks_exc.NotFound, ks_exc.MethodNotAllowed, ks_exc.BadRequest):
+                # either this device is unknown, or the server doesn't support
+                # the per-device lookup; the full list tells the two apart
+                reservations = self._get_all_device_allocations(device_id)
+                if reservations is not None:
+                    LOG.info("Per-device allocation lookup unsupported, using full list")
+                    self._scoped_allocations = False
+        else:
+            reservations = self._get_all_device_allocations(device_id)
+
+        if reservations is None:
+            self._forget_device_id(device_id)
+            return None
+        if horizon is None:
+            return reservations
+        return _within_horizon(reservations, horizon)
+
+
+def _within_horizon(reservations, horizon, now=None):
+    if now is None:
+        now = datetime.now(timezone.utc)
+    horizon_end = now + horizon
+
+    def parse(value):
+        return datetime.fromisoformat(value).replace(tzinfo=timezone.utc)
+
+    return [
+        res
+        for res in reservations
+        if parse(res["end_date"]) > now and parse(res["start_date"]) < horizon_end
+    ]
@@ -0,0 +1,101 @@
+import logging
+import subprocess
+from typing import NamedTuple, Optional
+
+LOG = logging.getLogger(__name__)
+
+
+class LiveApplyError(Exception):
+    """The running interface could not be inspected or reconfigured."""
+
+
+class Peer(NamedTuple):
+    public_key: str
+    endpoint: Optional[str]
+    allowed_ips: frozenset
+    persistent_keepalive: Optional[int]
+
+
+class InterfaceState(NamedTuple):
+    private_key: str
+    peers: dict
+    addresses: frozenset
+
+
+class WgCommand(object):
+    """Inspects and reconfigures a running wireguard interface with `wg` and `ip`.
+
+    WireguardManager only talks to the interface through this class, so tests can
+    substitute a fake interface.
+    """
+
+    def _run(self, cmd, input=None) -> str:
+        try:
+            proc = subprocess.run(
+                cmd, input=input, capture_output=True, check=True, text=True
+            )
+        except (OSError, subprocess.CalledProcessError) as exc:
+            stderr = getattr(exc, "stderr", None) or ""
+            raise LiveApplyError(f"{' '.join(cmd[:3])} failed: {stderr.strip() or exc}")
+        return proc.stdout
+
+    def show(self, interface) -> InterfaceState:
+        """Return the interface's current key, peers and addresses."""
+
+        lines = self._run(["wg", "show", interface, "dump"]).splitlines()
+        if not lines:
+            raise LiveApplyError(f"No state reported for {interface}")
+
+        # first line describes the interface, the rest one peer each
+        private_key = lines[0].split("\t")[0]
+        peers = {}
+        for line in lines[1:]:
+            fields = line.split("\t")
+            public_key, endpoint, allowed_ips, keepalive = (
+                fields[0],
+                fields[2],
+                fields[3],
+                fields[7],
+            )
+            peers[public_key] = Peer(
+                public_key=public_key,
+                endpoint=None if endpoint == "(none)" else endpoint,
+                allowed_ips=frozenset(
+                    [] if allowed_ips == "(none)" else allowed_ips.split(",")
+                ),
+                persistent_keepalive=None if keepalive == "off" else int(keepalive),
+            )
+
+        return InterfaceState(private_key, peers, self._addresses(interface))
+
+    def _addresses(self, interface) -> frozenset:
+        output = self._run(["ip", "-o", "-4", "address", "show", "dev", interface])
+        addresses = []
+        for line in output.splitlines():
+            fields = line.split()
+            if "inet" in fields:
+                addresses.append(fields[fields.index("inet") + 1])
+        return frozenset(addresses)
+
+    def set_private_key(self, interface, private_key):
+        self._run(
+            ["wg", "set", interface, "private-key", "/dev/stdin"], input=private_key
+        )
+
+    def set_peer(self, interface, peer: Peer):
+        cmd = ["wg", "set", interface, "peer", peer.public_key]
+        cmd += ["allowed-ips", ",".join(sorted(peer.allowed_ips))]
+        if peer.endpoint:
+            cmd += ["endpoint", peer.endpoint]
+        if peer.persistent_keepalive:
+            cmd += ["persistent-keepalive", str(peer.persistent_keepalive)]
+        self._run(cmd)
+
+    def remove_peer(self, interface, public_key):
+        self._run(["wg", "set", interface, "peer", public_key, "remove"])
+
+    def add_address(self, interface, address):
+        self._run(["ip", "address", "add", address, "dev", interface])
+
+    def remove_address(self, interface, address):
+        self._run(["ip", "address", "del", address, "dev", interface])
@@ -1,13 +1,246 @@
+import hashlib
 import logging
+import os
+import re
+import socket
 import subprocess
-from ipaddress import IPv4Network
+from functools import lru_cache
+from ipaddress import IPv4Address, ip_address
 from pathlib import Path
+from typing import NamedTuple
+
+from chi_edge_coordinator import utils, x25519
+from chi_edge_coordinator.clients.wgcommand import Peer, WgCommand
 
 LOG = logging.getLogger(__name__)
 
 WIREGUARD_CONF = "/etc/wireguard"
 WIREGUARD_INTERFACE = "wg-calico"
 SUBNET_SIZE = 24
+PERSISTENT_KEEPALIVE = 15
+# longest interface name the kernel accepts
+IFNAMSIZ = 15
+# channel names used as-is in an interface name; anything else is hashed
+_PLAIN_CHANNEL_NAME = re.compile(r"[A-Za-z0-9_-]+")
+
+
+def interface_for_channel(channel_name) -> str:
+    """The wireguard interface carrying a channel; k3s expects the user channel's.
+
+    Short names made of letters, digits, "-" and "_" give wg-<name>. Any other name,
+    including one that would clash with the user channel's wg-calico, gives
+    wg-<prefix>.<hash of the name>. Plain names can't contain ".", so the two forms
+    never collide.
+    """
+
+    if channel_name == utils.USER_CHANNEL:
+        return WIREGUARD_INTERFACE
+
+    interface = f"wg-{channel_name}"
+    if (
+        _PLAIN_CHANNEL_NAME.fullmatch(channel_name)
+        and len(interface) <= IFNAMSIZ
+        and interface != WIREGUARD_INTERFACE
+    ):
+        return interface
+
+    suffix = "." + hashlib.sha256(channel_name.encode()).hexdigest()[:6]
+    prefix = "".join(_PLAIN_CHANNEL_NAME.findall(channel_name))
+    return f"wg-{prefix}"[: IFNAMSIZ - len(suffix)] + suffix
+
+
+class ChangeSet(NamedTuple):
+    """What changed in the tunnel config, so callers can pick the least disruptive fix.
+
+    Peer and key changes can be applied to the running interface. Only a new bind
+    address affects k3s, which uses it as its node IP.
+    """
+
+    interface_key: bool = False
+    peers_added: tuple = ()
+    peers_removed: tuple = ()
+    peers_changed: tuple = ()
+    bind_ip: bool = False
+
+    def __bool__(self) -> bool:
+        return bool(
+            self.interface_key
+            or self.peers_added
+            or self.peers_removed
+            or self.peers_changed
+            or self.bind_ip
+        )
+
+
+def _digest(text: str) -> bytes:
+    return hashlib.sha256(text.encode()).digest()
+
+
+def _parse_config(config_text):
+    """Parse a config written by sync_config into (private key, peers by key)."""
+
+    private_key = None
+    peers = {}
+    peer = None
+
+    def add_peer(fields):
+        if "PublicKey" in fields:
+            keepalive = fields.get("PersistentKeepalive")
+            peers[fields["PublicKey"]] = Peer(
+                public_key=fields["PublicKey"],
+                endpoint=fields.get("Endpoint"),
+                allowed_ips=frozenset(
+                    ip.strip() for ip in fields.get("AllowedIPs", "").split(",") if ip
+                ),
+                persistent_keepalive=int(keepalive) if keepalive else None,
+            )
+
+    for line in config_text.splitlines():
+        line = line.strip()
+        if line == "[Peer]":
+            if peer is not None:
+                add_peer(peer)
+            peer = {}
+        elif "=" in line:
+            key, _, value = line.partition("=")
+            key, value = key.strip(), value.strip()
+            if peer is not None:
+                peer[key] = value
+            elif key == "PrivateKey":
+                private_key = value
+    if peer is not None:
+        add_peer(peer)
+
+    return private_key, peers
+
+
+@lru_cache(maxsize=65536)
+def _allowed_ips(ip, subnet_mask) -> str:
+    """The network of `ip`, e.g. 10.20.0.0/24 for 10.20.0.5.
+
+    Done with integer masking rather than IPv4Network, which is most of the cost
+    of building a hub's peers.
+    """
+
+    # TODO: this is hacky; netmask should be on the peer somehow
+    try:
+        # strict dotted-quad; inet_aton alone also takes shorthand like "10.1"
+        address = int(IPv4Address(ip))
+    except (ValueError, TypeError):
+        raise ValueError(f"Invalid peer address {ip!r}")
+    network = address & (0xFFFFFFFF << (32 - subnet_mask)) & 0xFFFFFFFF
+    return f"{socket.inet_ntoa(network.to_bytes(4, 'big'))}/{subnet_mask}"
+
+
+class _PeerEntry(object):
+    __slots__ = ("source", "peer", "section")
+
+    def __init__(self, source, peer) -> None:
+        # the channel properties the peer was built from, None if read from disk
+        self.source = source
+        self.peer = peer
+        self.section = None
+
+
+class PeerTable(object):
+    """Peers keyed by public key, each with its rendered config section.
+
+    Updating the table only rebuilds peers whose properties changed and reports
+    which peers were added, removed or changed, so a hub with thousands of spokes
+    can rewrite its config, or apply just the difference to the running interface,
+    without redoing every peer.
+    """
+
+    def __init__(
+        self,
+        subnet_mask=SUBNET_SIZE,
+        persistent_keepalive=PERSISTENT_KEEPALIVE,
+        require_endpoint=True,
+    ) -> None:
+        self.subnet_mask = subnet_mask
+        self.persistent_keepalive = persistent_keepalive
+        self.require_endpoint = require_endpoint
+        self._entries = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def peers(self) -> dict:
+        return {public_key: entry.peer for public_key, entry in self._entries.items()}
+
+    def get(self, public_key) -> Peer:
+        return self._entries[public_key].peer
+
+    def load(self, peers: dict):
+        """Start from peers already configured, e.g. parsed from the config on disk."""
+
+        self._entries = {
+            public_key: _PeerEntry(None, peer) for public_key, peer in peers.items()
+        }
+
+    def snapshot(self):
+        """The current peers, to restore() if what follows an update() fails."""
+
+        # update() replaces the entries rather than changing them, so no copy needed
+        return self._entries
+
+    def restore(self, snapshot):
+        self._entries = snapshot
+
+    def update(self, channel_peers) -> ChangeSet:
+        """Replace the peers with a channel's, returning which ones changed."""
+
+        entries = {}
+        added, changed = [], []
+        for channel_peer in channel_peers:
+            properties = channel_peer.get("properties", {})
+            public_key = properties.get("public_key")
+            endpoint = properties.get("endpoint")
+            if not public_key or (self.require_endpoint and not endpoint):
+                LOG.info("WARNING: Peer missing pubkey or endpoint: %s", channel_peer)
+                continue
+
+            source = (endpoint, properties.get("ip"), self.subnet_mask)
+            entry = self._entries.get(public_key)
+            if entry is not None and entry.source == source:
+                entries[public_key] = entry
+                continue
+
+            peer = Peer(
+                public_key=public_key,
+                endpoint=endpoint,
+                allowed_ips=frozenset([_allowed_ips(source[1], self.subnet_mask)]),
+                persistent_keepalive=self.persistent_keepalive,
+            )
+            if entry is None:
+                added.append(public_key)
+            elif entry.peer != peer:
+                changed.append(public_key)
+            entries[public_key] = _PeerEntry(source, peer)
+
+        removed = tuple(k for k in self._entries if k not in entries)
+        self._entries = entries
+        return ChangeSet(
+            peers_added=tuple(added), peers_removed=removed, peers_changed=tuple(changed)
+        )
+
+    def _section(self, entry) -> str:
+        if entry.section is None:
+            peer = entry.peer
+            lines = ["", "[Peer]", f"PublicKey = {peer.public_key}"]
+            lines.extend(f"AllowedIPs = {ip}" for ip in sorted(peer.allowed_ips))
+            if peer.endpoint:
+                lines.append(f"Endpoint = {peer.endpoint}")
+            if peer.persistent_keepalive:
+                lines.append(f"PersistentKeepalive = {peer.persistent_keepalive}")
+            entry.section = "\n".join(lines) + "\n"
+        return entry.section
+
+    def render(self, private_key) -> str:
+        """Config text for the interface, in the format `wg syncconf` reads."""
+
+        header = f"[Interface]\nPrivateKey = {private_key}\n"
+        return header + "".join(self._section(e) for e in self._entries.values())
 
 
 class WireguardManager(object):
@@ -16,17 +249,51 @@ class WireguardManager(object):
     wg_subnet_mask: int
     wg_private_key_path: Path
     wg_public_key_path: Path
+    use_wg_binary: bool
+    wg_command: WgCommand
 
     def __init__(
         self,
         wg_config_dir=WIREGUARD_CONF,
         wg_interface_name=WIREGUARD_INTERFACE,
         wg_subnet_mask=SUBNET_SIZE,
+        use_wg_binary=None,
+        wg_command=None,
+        hub=False,
     ) -> None:
         self.wg_config_dir = wg_config_dir
         self.wg_interface_name = wg_interface_name
+        self.wg_subnet_mask = wg_subnet_mask
+        self.hub = hub
+
+        # keys are handled in-process unless the `wg` tool is explicitly requested
+        if use_wg_binary is None:
+            use_wg_binary = os.getenv("WG_USE_BINARY") == "1"
+        self.use_wg_binary = use_wg_binary
+        self.wg_command = wg_command or WgCommand()
+
+        # (digest of private key, public key) from the last derivation
+        self._public_key_memo = (None, None)
+        # the peers, private key and digests of what sync_config last wrote to disk
+        self._peer_table = self._new_peer_table()
+        self._written_config = None
+        self._written_private_key = None
+        self._written_ipv4_digest = None
+
+    def _new_peer_table(self, channel=None) -> PeerTable:
+        if self.hub:
+            # spokes are reached at their own address, and keep the tunnel alive
+            # themselves; many are behind NAT and have no endpoint to dial
+            return PeerTable(
+                subnet_mask=32, persistent_keepalive=None, require_endpoint=False
+            )
+        subnet_mask = self._subnet_mask(channel) if channel else self.wg_subnet_mask
+        return PeerTable(subnet_mask=subnet_mask)
 
     def _generate_private_key(self):
+        if not self.use_wg_binary:
+            return x25519.generate_private_key()
+
         proc = subprocess.run(
             ["wg", "genkey"], capture_output=True, check=True, text=True
         )
@@ -34,10 +301,12 @@ class WireguardManager(object):
 
     def _write_key_to_file(self, key_path: Path, key_value: str):
         LOG.info("New private key written to file!")
-        key_path.write_text(key_value)
-        key_path.chmod(0o600)
+        utils.atomic_write(key_path, key_value, mode=0o600)
 
     def _generate_public_key(self, private_key):
+        if not self.use_wg_binary:
+            return x25519.public_key(private_key)
+
         proc = subprocess.run(
             ["wg", "pubkey"],
             input=private_key,
@@ -63,66 +332,207 @@ class WireguardManager(object):
             private_key = self._generate_private_key()
             self._write_key_to_file(key_path=private_key_file, key_value=private_key)
 
-        # always generate public key from private key, one less thing to sync
-        public_key = self._generate_public_key(private_key=private_key)
+        # always derive public key from private key, one less thing to sync;
+        # the derivation is only repeated when the private key changes
+        digest = _digest(private_key)
+        memo_digest, public_key = self._public_key_memo
+        if digest != memo_digest:
+            public_key = self._generate_public_key(private_key=private_key)
+            self._public_key_memo = (digest, public_key)
         return private_key, public_key
 
-    def sync_config(self, channel, private_key_s):
+    def _channel_peers(self, channel) -> list:
+        peers = channel.get("peers")
+        if not peers and not self.hub:
+            raise RuntimeError("Missing peer configuration")
+        return peers or []
+
+    def _desired_peers(self, channel) -> dict:
+        """Map each usable peer's public key to its desired configuration."""
+
+        table = self._new_peer_table(channel)
+        table.update(self._channel_peers(channel))
+        return table.peers()
+
+    def _subnet_mask(self, channel) -> int:
+        """The channel's prefix length, if its address is given as ip/prefix."""
+
+        channel_bind_ip = channel.get("properties", {}).get("ip") or ""
+        _, _, prefix = channel_bind_ip.partition("/")
+        return int(prefix) if prefix else self.wg_subnet_mask
+
+    def _bind_address(self, channel) -> str:
+        channel_properties = channel.get("properties", {})
+        channel_bind_ip = (channel_properties.get("ip") or "").partition("/")[0]
+        return f"{channel_bind_ip}/{self._subnet_mask(channel)}"
+
+    def forget_written(self):
+        """Compare the next sync against the files on disk, not what we last wrote."""
+
+        self._written_config = None
+
+    def sync_config(self, channel, private_key_s) -> "ChangeSet":
+        """Write the channel's tunnel config to disk and classify what changed.
+
+        Only peers whose properties changed are rebuilt, and the config is only
+        rendered when something changed, so a tick with no changes does no file I/O
+        and costs little even with thousands of peers.
+        """
+
         if not channel:
-            raise RuntimeError("User channel not configured!")
+            raise RuntimeError(f"Channel for {self.wg_interface_name} not configured!")
 
-        config_lines = [
-            "[Interface]",
-            f"PrivateKey = {private_key_s}",
-            "",
-        ]
+        wg_conf = Path(self.wg_config_dir, f"{self.wg_interface_name}.conf")
+        wg_ipv4 = Path(self.wg_config_dir, f"{self.wg_interface_name}.ipv4")
 
-        peers = channel.get("peers")
-        if not peers:
-            raise RuntimeError("Missing peer configuration")
+        ipv4_text = self._bind_address(channel)
+        ipv4_digest = _digest(ipv4_text)
 
-        for peer in peers:
-            properties = peer.get("properties", {})
-            pubkey = properties.get("public_key")
-            endpoint = properties.get("endpoint")
-            ip_address = properties.get("ip")
+        # the files are only read on the first sync; after that the peer table
+        # and digests remember what we wrote
+        first_sync = self._written_config is None
+        if first_sync:
+            old_config_text = wg_conf.read_text() if wg_conf.exists() else ""
+            old_private_key, old_peers = _parse_config(old_config_text)
+            self._peer_table.load(old_peers)
+            self._written_config = _digest(old_config_text)
+            self._written_private_key = old_private_key
+            self._written_ipv4_digest = (
+                _digest(wg_ipv4.read_text()) if wg_ipv4.exists() else None
+            )
+
+        # the table has to match what's on disk, so if the write fails it goes
+        # back to the old peers and the next sync finds the same changes again
+        written_peers = self._peer_table.snapshot()
+        if not self.hub:
+            # peers are routed by the channel's network; a new prefix rebuilds them
+            self._peer_table.subnet_mask = self._subnet_mask(channel)
+        peer_changes = self._peer_table.update(self._channel_peers(channel))
+        changes = peer_changes._replace(
+            interface_key=self._written_private_key != private_key_s,
+            bind_ip=self._written_ipv4_digest != ipv4_digest,
+        )
+
+        if first_sync or changes.interface_key or peer_changes:
+            config_text = self._peer_table.render(private_key_s)
+            config_digest = _digest(config_text)
+            if config_digest == self._written_config:
+                # what's on disk is already up to date
+                changes = ChangeSet(bind_ip=changes.bind_ip)
+                self._written_private_key = private_key_s
+            else:
+                LOG.info("Writing tunnel configuration")
+                try:
+                    utils.atomic_write(wg_conf, config_text, mode=0o600)
+                except Exception:
+                    self._peer_table.restore(written_peers)
+                    raise
+                self._written_config = config_digest
+                self._written_private_key = private_key_s
+
+        if changes.bind_ip:
+            LOG.info("Writing new IPv4 configuration")
+            utils.atomic_write(wg_ipv4, ipv4_text, mode=0o644)
+            self._written_ipv4_digest = ipv4_digest
+        return changes
+
+    def apply_peer_changes(self, changes: ChangeSet) -> int:
+        """Apply the peer changes sync_config reported to the running interface.
+
+        Unlike apply_live, this doesn't read back the interface's state, so its cost
+        follows the number of changed peers rather than the size of the table.
+        Returns the number of peers updated.
+        """
+
+        interface = self.wg_interface_name
+        for public_key in changes.peers_removed:
+            self.wg_command.remove_peer(interface, public_key)
+        for public_key in changes.peers_added + changes.peers_changed:
+            self.wg_command.set_peer(interface, self._peer_table.get(public_key))
+        return len(changes.peers_removed + changes.peers_added + changes.peers_changed)
 
-            if not pubkey or not endpoint:
-                LOG.info("WARNING: Peer missing pubkey or endpoint: %s", peer)
+    def apply_live(self, channel, private_key_s) -> dict:
+        """Reconfigure the running interface in place to match the channel.
+
+        Like `wg syncconf`, only the differences are applied, so existing sessions
+        with unchanged peers are not disturbed. Raises LiveApplyError if the
+        interface can't be inspected or changed. Returns what was changed.
+        """
+
+        interface = self.wg_interface_name
+        desired_peers = self._desired_peers(channel)
+        address = self._bind_address(channel)
+        current = self.wg_command.show(interface)
+
+        changes = {
+            "private_key": False,
+            "added": [],
+            "removed": [],
+            "changed": [],
+            "address": False,
+        }
+
+        if current.private_key != private_key_s.strip():
+            self.wg_command.set_private_key(interface, private_key_s)
+            changes["private_key"] = True
+
+        for public_key in current.peers.keys() - desired_peers.keys():
+            self.wg_command.remove_peer(interface, public_key)
+            changes["removed"].append(public_key)
+
+        for public_key, peer in desired_peers.items():
+            running = current.peers.get(public_key)
+            if running is None:
+                changes["added"].append(public_key)
+            elif _peer_differs(running, peer):
+                changes["changed"].append(public_key)
+            else:
                 continue
+            self.wg_command.set_peer(interface, peer)
 
-            # TODO: this is hacky; netmask should be on the peer somehow
-            allowed_ips = str(IPv4Network(f"{ip_address}/{SUBNET_SIZE}", strict=False))
-
-            config_lines.extend(
-                [
-                    "[Peer]",
-                    f"PublicKey = {pubkey}",
-                    f"AllowedIPs = {allowed_ips}",
-                    f"Endpoint = {endpoint}",
-                    "PersistentKeepalive = 15",
-                    "",
-                ]
-            )
+        if current.addresses != {address}:
+            # add the new address before dropping old ones, so the interface
+            # always has one
+            if address not in current.addresses:
+                self.wg_command.add_address(interface, address)
+            for old_address in current.addresses - {address}:
+                self.wg_command.remove_address(interface, old_address)
+            changes["address"] = True
 
-        wg_conf = Path(WIREGUARD_CONF, f"{WIREGUARD_INTERFACE}.conf")
-        wg_ipv4 = Path(WIREGUARD_CONF, f"{WIREGUARD_INTERFACE}.ipv4")
-        wg_restart = False
+        LOG.info(
+            "Applied live tunnel changes: %d peers added, %d removed, %d changed",
+            len(changes["added"]),
+            len(changes["removed"]),
+            len(changes["changed"]),
+        )
+        return changes
 
-        config_text = "\n".join(config_lines)
 
-        channel_properties = channel.get("properties", {})
-        channel_bind_ip = channel_properties.get("ip")
-        ipv4_text = f"{channel_bind_ip}/{SUBNET_SIZE}"
+def _resolve_endpoint(endpoint):
+    """Resolve a host:port endpoint the way `wg` reports it, i.e. as ip:port."""
 
-        if not wg_conf.exists() or wg_conf.read_text() != config_text:
-            LOG.info("Writing tunnel configuration")
-            wg_conf.write_text(config_text)
-            wg_conf.chmod(0o600)
-            wg_restart = True
+    host, _, port = endpoint.rpartition(":")
+    try:
+        ip_address(host.strip("[]"))
+        return endpoint
+    except ValueError:
+        pass
+    try:
+        info = socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_DGRAM)
+    except (OSError, UnicodeError):
+        return endpoint
+    resolved_ip, resolved_port = info[0][4][:2]
+    return f"{resolved_ip}:{resolved_port}"
 
-        if not wg_ipv4.exists() or wg_ipv4.read_text() != ipv4_text:
-            LOG.info("Writing new IPv4 configuration")
-            wg_ipv4.write_text(ipv4_text)
-            wg_restart = True
-        return wg_restart
+
+def _peer_differs(running: Peer, desired: Peer) -> bool:
+    # a peer without an endpoint (a hub's spoke behind NAT) keeps whatever endpoint
+    # the interface learned from its handshakes
+    return (
+        running.allowed_ips != desired.allowed_ips
+        or running.persistent_keepalive != desired.persistent_keepalive
+        or (
+            desired.endpoint is not None
+            and running.endpoint != _resolve_endpoint(desired.endpoint)
+        )
+    )
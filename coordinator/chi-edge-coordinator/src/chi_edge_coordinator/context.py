@@ -0,0 +1,428 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+from chi_edge_coordinator import metrics, tracing, utils
+from chi_edge_coordinator.clients.wgconfig import (
+    WIREGUARD_CONF,
+    WireguardManager,
+    interface_for_channel,
+)
+from chi_edge_coordinator.reconcile import Reconciler
+from chi_edge_coordinator.update_lock import ReservationIndex, UpdateLock
+
+LOG = logging.getLogger(__name__)
+
+STATE_DIR = "/var/lib/chi-edge-coordinator"
+TOKEN_CACHE_FILE = "keystone-token.json"
+DEVICE_ID_CACHE_FILE = "blazar-devices.json"
+# tasks scheduled close together share one hardware fetch
+HARDWARE_MAX_AGE = 10.0
+# rough service downtime caused by a restart, in seconds
+RESTART_DOWNTIME = {"wireguard": 10.0, "k3s": 30.0}
+
+SNAPSHOT_FILE = "last-known-good.json"
+SNAPSHOT_FORMAT = 1
+SNAPSHOT_PARTS = ("hardware", "channels", "allocations")
+SNAPSHOT_REFRESH_INTERVAL = 15 * 60
+# warn when decisions are based on state older than this
+SNAPSHOT_STALE_AFTER = 5 * 60
+
+
+class TokenCache(object):
+    """Persists keystone auth state so a restarted container can reuse its token."""
+
+    def __init__(self, path) -> None:
+        self.path = Path(path)
+        self._saved_state = None
+
+    def load(self, auth) -> bool:
+        """Restore cached auth state into the plugin, returning True if still valid."""
+
+        try:
+            data = json.loads(self.path.read_text())
+        except FileNotFoundError:
+            return False
+        except ValueError:
+            LOG.warning("Ignoring unreadable token cache %s", self.path)
+            return False
+
+        # credentials may have been rotated since the token was cached
+        if data.get("cache_id") != auth.get_cache_id():
+            LOG.info("Token cache belongs to different credentials, ignoring")
+            return False
+
+        auth.set_auth_state(data.get("auth_state"))
+        self._saved_state = data.get("auth_state")
+        if not auth.auth_ref or auth.auth_ref.will_expire_soon(
+            auth.MIN_TOKEN_LIFE_SECONDS
+        ):
+            return False
+
+        LOG.info("Reusing cached keystone token until %s", auth.auth_ref.expires)
+        return True
+
+    def save(self, auth) -> bool:
+        """Write auth state to disk if the token changed since the last save."""
+
+        auth_state = auth.get_auth_state()
+        if not auth_state or auth_state == self._saved_state:
+            return False
+
+        data = {"cache_id": auth.get_cache_id(), "auth_state": auth_state}
+        utils.atomic_write(self.path, json.dumps(data), mode=0o600)
+        self._saved_state = auth_state
+        return True
+
+
+class StateSnapshot(object):
+    """Last known good hardware record, tunnel channels and allocations.
+
+    Persisted so that at boot the tunnel and update lock can be brought up from the
+    previous state without waiting for Keystone or Doni to answer. Each part records
+    when it was last fetched from a live service, so stale decisions are visible.
+    """
+
+    def __init__(self, path=None) -> None:
+        self.path = Path(path) if path else None
+        self.generation = 0
+        self._parts = {}
+        self._dirty = False
+        self._saved_at = 0.0
+
+    def load(self) -> bool:
+        if not self.path:
+            return False
+        try:
+            data = json.loads(self.path.read_text())
+        except FileNotFoundError:
+            return False
+        except ValueError:
+            LOG.warning("Ignoring unreadable state snapshot %s", self.path)
+            return False
+
+        if data.get("format") != SNAPSHOT_FORMAT:
+            LOG.warning("Ignoring state snapshot in format %s", data.get("format"))
+            return False
+
+        self.generation = data.get("generation", 0)
+        parts = data.get("parts", {})
+        # parts no longer written (e.g. the single "channel") are dropped, and
+        # refetched on the next iteration
+        self._parts = {
+            name: part for name, part in parts.items() if name in SNAPSHOT_PARTS
+        }
+        self._saved_at = time.time()
+        return bool(self._parts)
+
+    def get(self, name):
+        part = self._parts.get(name)
+        return part["value"] if part else None
+
+    def update(self, name, value):
+        """Record a value just fetched from a live service."""
+
+        part = self._parts.get(name)
+        if part is None or part["value"] != value:
+            self._dirty = True
+        self._parts[name] = {"value": value, "fetched_at": time.time()}
+
+    def age(self, name=None, now=None):
+        """Seconds since a part (or the oldest part) was fetched, None if never."""
+
+        if now is None:
+            now = time.time()
+        names = [name] if name else list(self._parts)
+        fetched = [self._parts[n]["fetched_at"] for n in names if n in self._parts]
+        if not fetched:
+            return None
+        return max(now - min(fetched), 0.0)
+
+    def save(self) -> bool:
+        """Write the snapshot if it changed, or to refresh its fetch times now and then.
+
+        Unchanged values are only rewritten every SNAPSHOT_REFRESH_INTERVAL, to spare
+        the device's storage a write every iteration.
+        """
+
+        if not self.path or not self._parts:
+            return False
+        if not self._dirty and time.time() - self._saved_at < SNAPSHOT_REFRESH_INTERVAL:
+            return False
+
+        self.generation += 1
+        data = {
+            "format": SNAPSHOT_FORMAT,
+            "generation": self.generation,
+            "parts": self._parts,
+        }
+        utils.atomic_write(self.path, json.dumps(data), mode=0o600)
+        self._dirty = False
+        self._saved_at = time.time()
+        return True
+
+
+def connection_stats(session):
+    """Return (requests, new connections) across the session's connection pools."""
+
+    num_requests = num_connections = 0
+    for adapter in session.session.adapters.values():
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            num_requests += pool.num_requests
+            num_connections += pool.num_connections
+    return num_requests, num_connections
+
+
+class CoordinatorContext(object):
+    """Clients and state that live for the whole coordinator process.
+
+    All OpenStack clients share one keystone session, so the token and the
+    connection pool are reused across iterations instead of being rebuilt
+    every minute. Clients are only created when first used: keystoneauth1 and
+    requests are slow to import on the device, and the tunnel config can be
+    written from the state snapshot without them.
+    """
+
+    def __init__(self, state_dir=None) -> None:
+        self.state_dir = Path(state_dir or os.getenv("COORDINATOR_STATE_DIR", STATE_DIR))
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+
+        self.device_uuid = utils.uuid_hex_to_dashed(os.getenv("BALENA_DEVICE_UUID", ""))
+
+        self.token_cache = TokenCache(self.state_dir / TOKEN_CACHE_FILE)
+        self.tokens_from_cache = 0
+        self._supervisor = None
+        self._openstack_clients = None
+        self._openstack_lock = threading.Lock()
+
+        self.snapshot = StateSnapshot(self.state_dir / SNAPSHOT_FILE)
+        self.snapshot.load()
+        metrics.SNAPSHOT_AGE.set_function(self._snapshot_age)
+
+        self.wg_config_dir = WIREGUARD_CONF
+        self.wg_managers = {}
+        self.update_lock = UpdateLock()
+        self.reconciler = Reconciler()
+        self.iterations = 0
+        self.restart_stats = Counter()
+        self._reservation_index = (None, None)
+
+        self._hardware = None
+        self._hardware_fetched_at = 0.0
+
+    def tunnel_manager(self, channel_name) -> WireguardManager:
+        """The manager of a channel's interface, config and key material."""
+
+        if channel_name not in self.wg_managers:
+            interface = interface_for_channel(channel_name)
+            for other_name, other in self.wg_managers.items():
+                if other.wg_interface_name == interface:
+                    raise RuntimeError(
+                        f"Channels {other_name} and {channel_name} both map to "
+                        f"interface {interface}"
+                    )
+            self.wg_managers[channel_name] = WireguardManager(
+                wg_config_dir=self.wg_config_dir,
+                wg_interface_name=interface,
+            )
+        return self.wg_managers[channel_name]
+
+    @property
+    def supervisor(self):
+        if self._supervisor is None:
+            from chi_edge_coordinator.clients.balena import BalenaSupervisorClient
+
+            # initialize supervisor client from env vars
+            self._supervisor = BalenaSupervisorClient(
+                supervisor_api_address=os.getenv("BALENA_SUPERVISOR_ADDRESS"),
+                supervisor_api_key=os.getenv("BALENA_SUPERVISOR_API_KEY"),
+            )
+        return self._supervisor
+
+    def _openstack(self) -> dict:
+        with self._openstack_lock:
+            if self._openstack_clients is None:
+                from chi_edge_coordinator.clients import openstack
+
+                # initialize openstack clients from env vars
+                keystone_auth = openstack.CountingApplicationCredential(
+                    auth_url=os.getenv("OS_AUTH_URL"),  # type: ignore
+                    application_credential_id=os.getenv("OS_APPLICATION_CREDENTIAL_ID"),  # type: ignore
+                    application_credential_secret=os.getenv("OS_APPLICATION_CREDENTIAL_SECRET"),  # type: ignore
+                )
+                self.tokens_from_cache = int(self.token_cache.load(keystone_auth))
+
+                session = openstack.DeadlineSession(auth=keystone_auth)
+                self._openstack_clients = {
+                    "keystone_auth": keystone_auth,
+                    "session": session,
+                    "doni": openstack.DoniClient(session=session),
+                    "tunelo": openstack.TuneloClient(session=session),
+                    "blazar": openstack.BlazarClient(
+                        session=session,
+                        device_id_cache=self.state_dir / DEVICE_ID_CACHE_FILE,
+                    ),
+                }
+            return self._openstack_clients
+
+    @property
+    def keystone_auth(self):
+        return self._openstack()["keystone_auth"]
+
+    @property
+    def session(self):
+        return self._openstack()["session"]
+
+    @property
+    def doni(self):
+        return self._openstack()["doni"]
+
+    @property
+    def tunelo(self):
+        return self._openstack()["tunelo"]
+
+    @property
+    def blazar(self):
+        return self._openstack()["blazar"]
+
+    def get_hardware(self, max_age=HARDWARE_MAX_AGE) -> dict:
+        """Return this device's Doni hardware record, refetching once it is stale."""
+
+        if (
+            self._hardware is None
+            or time.monotonic() - self._hardware_fetched_at > max_age
+        ):
+            with tracing.span("doni_fetch"):
+                self.set_hardware(self.doni.get_hardware(self.device_uuid))
+        return self._hardware
+
+    def restore_hardware(self, hardware: dict):
+        """Use a snapshot's hardware record until the live one can be fetched."""
+
+        self._hardware = hardware
+        self._hardware_fetched_at = float("-inf")
+
+    def set_hardware(self, hardware: dict):
+        self._hardware = hardware
+        self._hardware_fetched_at = time.monotonic()
+        self.snapshot.update("hardware", hardware)
+
+    def hardware_name_hint(self):
+        """Best guess at the device's Doni name without calling Doni."""
+
+        if self._hardware is not None:
+            return self._hardware["name"]
+        # the balena device name is kept in sync with doni by sync_hostname
+        return os.getenv("BALENA_DEVICE_NAME_AT_INIT")
+
+    def invalidate_hardware(self):
+        # keep the stale record around, it still serves hardware_name_hint
+        self._hardware_fetched_at = float("-inf")
+
+    def get_reservation_index(self, allocations, guard_minutes) -> ReservationIndex:
+        """Return the index for these allocations, only rebuilding it when they change."""
+
+        key, index = self._reservation_index
+        if index is None or key != (allocations, guard_minutes):
+            index = ReservationIndex(allocations, guard_minutes)
+            self._reservation_index = ((allocations, guard_minutes), index)
+        return index
+
+    def record_restarts(self, restarted=(), avoided=()):
+        """Count service restarts, and the restarts (and downtime) a lighter fix avoided."""
+
+        for service_name in restarted:
+            kind = "k3s" if service_name.startswith("k3s") else service_name
+            self.restart_stats[f"{kind}_restarts"] += 1
+            metrics.SERVICE_RESTARTS.inc(service=kind)
+        for kind in avoided:
+            self.restart_stats[f"{kind}_restarts_avoided"] += 1
+            metrics.SERVICE_RESTARTS_AVOIDED.inc(service=kind)
+            self.restart_stats["downtime_avoided_seconds"] += RESTART_DOWNTIME.get(kind, 0)
+
+        LOG.info("Service restarts: %s", dict(self.restart_stats))
+
+    def end_iteration(self, duration=None):
+        """Persist any new token and report how much session reuse saved."""
+
+        self.iterations += 1
+        if duration is not None:
+            metrics.ITERATION_DURATION.observe(duration)
+        try:
+            self.token_cache.save(self.keystone_auth)
+        except OSError:
+            LOG.exception("Failed to write token cache")
+        try:
+            self.snapshot.save()
+        except OSError:
+            LOG.exception("Failed to write state snapshot")
+
+        snapshot_age = self.snapshot.age()
+        if snapshot_age is not None and snapshot_age > SNAPSHOT_STALE_AFTER:
+            LOG.warning(
+                "Live state not refreshed for %.0fs: %s",
+                snapshot_age,
+                {name: self.snapshot.age(name) for name in SNAPSHOT_PARTS},
+            )
+
+        stats = self.stats()
+        LOG.info(
+            "Session reuse: %d token issuances avoided, %d connection handshakes avoided",
+            stats["tokens_avoided"],
+            stats["handshakes_avoided"],
+        )
+        LOG.info(
+            "Response cache: %d hits, %d misses, %d bytes saved",
+            stats["cache_hits"],
+            stats["cache_misses"],
+            stats["cache_bytes_saved"],
+        )
+        for path, path_stats in self.response_cache_stats().items():
+            LOG.debug("Response cache %s: %s", path, dict(path_stats))
+        LOG.info(
+            "Reconcile steps: %s",
+            ", ".join(
+                f"{name} {counts['executed']} run/{counts['skipped']} skipped"
+                for name, counts in sorted(stats["reconcile"].items())
+            ),
+        )
+
+    def response_cache_stats(self) -> dict:
+        """Per-endpoint hit/miss counters of the OpenStack clients' response caches."""
+
+        cache_stats = {}
+        for client in (self.doni, self.tunelo, self.blazar):
+            cache_stats.update(client.cache_stats)
+        return cache_stats
+
+    def _snapshot_age(self) -> float:
+        age = self.snapshot.age()
+        return float("nan") if age is None else age
+
+    def stats(self) -> dict:
+        num_requests, num_connections = connection_stats(self.session)
+        tokens_issued = self.keystone_auth.tokens_issued
+        cache_totals = sum(self.response_cache_stats().values(), Counter())
+        return {
+            "iterations": self.iterations,
+            "tokens_issued": tokens_issued,
+            "tokens_from_cache": self.tokens_from_cache,
+            # authenticated requests that would otherwise have needed a new token
+            "tokens_avoided": self.keystone_auth.tokens_reused,
+            "requests": num_requests,
+            "connections": num_connections,
+            "handshakes_avoided": num_requests - num_connections,
+            "cache_hits": cache_totals["hits"],
+            "cache_misses": cache_totals["misses"],
+            "cache_bytes_saved": cache_totals["bytes_saved"],
+            "snapshot_age": self.snapshot.age(),
+            "reconcile": self.reconciler.stats(),
+        }
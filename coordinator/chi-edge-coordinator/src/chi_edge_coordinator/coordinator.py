@@ -1,93 +1,533 @@
 import logging
 import os
 import time
-import traceback
+from datetime import datetime, timezone
+from typing import NamedTuple
 
-from keystoneauth1.identity.v3 import application_credential
-
-from chi_edge_coordinator import utils
-from chi_edge_coordinator.clients.balena import BalenaSupervisorClient
-from chi_edge_coordinator.clients.openstack import BlazarClient, DoniClient, TuneloClient
-from chi_edge_coordinator.update_lock import UpdateLock, device_should_lock
-from chi_edge_coordinator.clients.wgconfig import WireguardManager
+from chi_edge_coordinator import deadline, metrics, reconcile, tracing, utils
+from chi_edge_coordinator.clients.wgcommand import LiveApplyError
+from chi_edge_coordinator.clients.wgconfig import ChangeSet
+from chi_edge_coordinator.context import CoordinatorContext
+from chi_edge_coordinator.scheduler import Scheduler, Task
 
 LOG = logging.getLogger(__name__)
 
+LOCK_TRANSITION_MARGIN = 1.0
+# longest a task (or async iteration) may wait on the network before giving up
+ITERATION_DEADLINE = float(os.getenv("COORDINATOR_ITERATION_DEADLINE", "120"))
 
-def mainLoop(update_lock):
-    # initialize supervisor client from env vars
-    supervisor = BalenaSupervisorClient(
-        supervisor_api_address=os.getenv("BALENA_SUPERVISOR_ADDRESS"),
-        supervisor_api_key=os.getenv("BALENA_SUPERVISOR_API_KEY"),
-    )
 
-    # initialize openstack clients from env vars
-    keystone_auth = application_credential.ApplicationCredential(
-        auth_url=os.getenv("OS_AUTH_URL"),  # type: ignore
-        application_credential_id=os.getenv("OS_APPLICATION_CREDENTIAL_ID"),  # type: ignore
-        application_credential_secret=os.getenv("OS_APPLICATION_CREDENTIAL_SECRET"),  # type: ignore
-    )
-    doni = DoniClient(auth=keystone_auth)
-    tunelo = TuneloClient(auth=keystone_auth)
-    blazar = BlazarClient(auth=keystone_auth)
+class TunnelUpdate(NamedTuple):
+    """A channel's config as just written, and what changed in it."""
+
+    changes: ChangeSet
+    channel: dict
+    private_key: str
+
+
+def hostname_inputs(hardware) -> dict:
+    return {"name": hardware["name"]}
+
 
+def key_inputs(hardware, keys) -> dict:
+    return {
+        "channels": hardware["properties"].get("channels"),
+        "private_keys": {
+            name: reconcile.digest(private_key) for name, (private_key, _) in keys.items()
+        },
+    }
+
+
+def tunnel_inputs(hardware, channel_name, wg_private_key) -> dict:
+    # the channel as Doni sees it, including the tunelo worker's state_details
+    return {
+        "channel": utils.get_channel(hardware, channel_name),
+        "private_key": reconcile.digest(wg_private_key),
+    }
+
+
+def sync_hostname(ctx: CoordinatorContext):
     # ensure that balena hostname matches doni "name"
-    device_uuid = utils.uuid_hex_to_dashed(os.getenv("BALENA_DEVICE_UUID", ""))
-    hardware = doni.get_hardware(device_uuid)
-    supervisor.sync_device_hostname(name=hardware["name"])
+    hardware = ctx.get_hardware()
+    if not ctx.reconciler.due("hostname", hostname_inputs(hardware)):
+        return
+    with tracing.span("hostname_sync"):
+        ctx.supervisor.sync_device_hostname(name=hardware["name"])
+    ctx.reconciler.done("hostname")
+
+
+def apply_update_lock(ctx: CoordinatorContext, device_name, allocations):
+    """Take or release the update lock; allocations is None if blazar has no device.
 
+    Returns the seconds until the lock next needs to change, or None if no
+    reservation will change it.
+    """
+
+    if allocations is None:
+        LOG.warning("Device %s not found in blazar, skipping lock check", device_name)
+        return None
+
+    with tracing.span("lock_evaluation", reservations=len(allocations)):
+        guard_minutes = int(os.getenv("UPDATE_GUARD_MINUTES", "15"))
+        index = ctx.get_reservation_index(allocations, guard_minutes)
+        now = datetime.now(timezone.utc)
+        if index.locked(now):
+            ctx.update_lock.acquire()
+        else:
+            ctx.update_lock.release()
+
+        next_transition = index.next_transition(now)
+    if next_transition is None:
+        return None
+    # wake just after the boundary, so the check lands on the new side of it
+    return (next_transition - now).total_seconds() + LOCK_TRANSITION_MARGIN
+
+
+def sync_update_lock(ctx: CoordinatorContext):
     # manage update lock based on device reservations
-    guard_minutes = int(os.getenv("UPDATE_GUARD_MINUTES", "15"))
-    blazar_device_id = blazar.get_device_id(hardware["name"])
-    if blazar_device_id:
-        allocations = blazar.get_device_allocations(blazar_device_id)
-        if device_should_lock(allocations, guard_minutes):
-            update_lock.acquire()
+    hardware = ctx.get_hardware()
+    allocations = None
+    with tracing.span("blazar_lookup"):
+        blazar_device_id = ctx.blazar.get_device_id(hardware["name"])
+        if blazar_device_id:
+            allocations = ctx.blazar.get_device_allocations(blazar_device_id)
+            if allocations is not None:
+                ctx.snapshot.update("allocations", allocations)
+    return apply_update_lock(ctx, hardware["name"], allocations)
+
+
+def get_keys(ctx: CoordinatorContext, channel_names) -> dict:
+    """Private and public key of each channel, generating any that are missing."""
+
+    with tracing.span("key_handling", channels=len(channel_names)):
+        return {
+            name: ctx.tunnel_manager(name).get_wireguard_keys() for name in channel_names
+        }
+
+
+def publish_wireguard_key(ctx: CoordinatorContext):
+    # ensure that every channel has a wireguard private key, generating it if necessary
+    hardware = ctx.get_hardware()
+    keys = get_keys(ctx, utils.get_channel_names(hardware))
+    if not ctx.reconciler.due("key_publication", key_inputs(hardware, keys)):
+        return
+
+    # if we have new private keys, tell Doni to update the hub ports in one patch
+    # on the first run, this might change the assigned IP address for our spoke ports
+    channels_patch = utils.get_channels_patch(
+        hardware, {name: public_key for name, (_, public_key) in keys.items()}
+    )
+    if channels_patch:
+        LOG.info(
+            "Updating channel public keys: %s",
+            ", ".join(op["path"] for op in channels_patch),
+        )
+        with tracing.span("doni_patch"):
+            ctx.doni.patch_hardware(uuid=ctx.device_uuid, jsonpatch=channels_patch)
+        ctx.invalidate_hardware()
+    ctx.reconciler.done("key_publication")
+
+
+def restart_tunnel_services(ctx: CoordinatorContext, restart_k3s=True):
+    """Restart wireguard and k3s, looking both up in a single supervisor snapshot."""
+
+    supervisor = ctx.supervisor
+    state = supervisor.get_state()
+    service_names = ["wireguard"]
+
+    # look up name of k3s service. Could be different depending on device
+    k3s_error = None
+    if restart_k3s:
+        try:
+            service_names.append(state.k3s_service_name())
+        except RuntimeError as exc:
+            k3s_error = exc
+
+    LOG.info("restarting services %s", service_names)
+    with tracing.span("restarts", services=service_names):
+        restarted = supervisor.restart_services(service_names, state=state)
+    ctx.record_restarts(restarted=restarted, avoided=[] if restart_k3s else ["k3s"])
+
+    # wireguard still needs its restart even if k3s can't be found
+    if k3s_error:
+        raise k3s_error
+
+
+def apply_tunnel_changes(ctx: CoordinatorContext, updates: dict):
+    """Take the least disruptive action that applies each channel's config changes.
+
+    Peer and key changes are applied to the running interfaces. k3s is only restarted
+    for a new user channel address, since it uses it as the node IP. If an interface
+    can't be updated in place, wireguard is restarted, and k3s too if the user
+    channel changed.
+    """
+
+    changed = {name: update for name, update in updates.items() if update.changes}
+    if not changed:
+        return
+
+    if os.getenv("WG_LIVE_APPLY", "1") == "1":
+        restart_k3s = False
+        try:
+            for name, update in sorted(changed.items()):
+                with tracing.span("live_apply", channel=name):
+                    live_changes = ctx.tunnel_manager(name).apply_live(
+                        update.channel, update.private_key
+                    )
+                if name == utils.USER_CHANNEL and (
+                    update.changes.bind_ip or live_changes["address"]
+                ):
+                    restart_k3s = True
+        except LiveApplyError:
+            LOG.exception("Live tunnel update failed, restarting services instead")
         else:
-            update_lock.release()
-    else:
-        LOG.warning("Device %s not found in blazar, skipping lock check", hardware["name"])
+            if restart_k3s:
+                state = ctx.supervisor.get_state()
+                k3s_name = state.k3s_service_name()
+                LOG.info(f"restarting k3s service {k3s_name} for new node IP")
+                with tracing.span("restarts", services=[k3s_name]):
+                    restarted = ctx.supervisor.restart_service(k3s_name, state=state)
+                ctx.record_restarts(restarted=restarted, avoided=["wireguard"])
+            else:
+                ctx.record_restarts(avoided=["wireguard", "k3s"])
+            return
+
+    # restart services to pick up new config; other channels don't carry k3s
+    restart_tunnel_services(ctx, restart_k3s=utils.USER_CHANNEL in changed)
+
+
+def due_channels(ctx: CoordinatorContext, hardware, keys, force=False) -> dict:
+    """Tunelo channel UUIDs of the channels whose tunnels need reconciling."""
+
+    due = {}
+    for name, (wg_private_key, _) in keys.items():
+        inputs = tunnel_inputs(hardware, name, wg_private_key)
+        if not ctx.reconciler.due(f"tunnel/{name}", inputs, force=force):
+            continue
+        if ctx.reconciler.is_full(f"tunnel/{name}"):
+            # repair config files edited or removed since we last wrote them
+            ctx.tunnel_manager(name).forget_written()
+        channel_uuid = utils.get_channel(hardware, name).get("uuid")
+        if not channel_uuid:
+            LOG.info("Channel %s has not been set up by tunelo yet", name)
+            continue
+        due[name] = channel_uuid
+    return due
+
 
-    # ensure that wireguard private key is present, generating it if necessary
-    wg_manager = WireguardManager()
-    wg_private_key, wg_public_key = wg_manager.get_wireguard_keys()
+def record_channels(ctx: CoordinatorContext, fetched, channel_names):
+    """Keep the snapshot's channels in step with the hardware record."""
 
-    # if we have a new private key, tell Doni to update the hub port
-    # on the first run, this might change the assigned IP address for our spoke port
-    user_channel_patch = utils.get_channel_patch(hardware, "user", wg_public_key)
-    if user_channel_patch:
-        LOG.info(f"Updating channel public key to {wg_public_key}")
-        doni.patch_hardware(uuid=device_uuid, jsonpatch=user_channel_patch)
+    channels = dict(ctx.snapshot.get("channels") or {})
+    channels.update(fetched)
+    ctx.snapshot.update(
+        "channels", {name: channels[name] for name in channel_names if name in channels}
+    )
+
+
+def sync_configs(ctx: CoordinatorContext, channels, keys) -> dict:
+    """Write each channel's tunnel config, returning what changed per channel."""
 
-    # ensure that we synchronize our end to the spoke port config.
-    # Fetch this from tunelo, as it has more up to date information than Doni
+    updates = {}
+    for name, channel in channels.items():
+        wg_private_key, _ = keys[name]
+        with tracing.span("config_sync", channel=name):
+            changes = ctx.tunnel_manager(name).sync_config(channel, wg_private_key)
+        updates[name] = TunnelUpdate(changes, channel, wg_private_key)
+    return updates
 
-    channel_uuid = utils.get_channel(hardware, "user").get("uuid")
-    tunelo_channel = tunelo.get_channel(channel_uuid)
+
+def sync_tunnel(ctx: CoordinatorContext):
+    hardware = ctx.get_hardware()
+    channel_names = utils.get_channel_names(hardware)
+    keys = get_keys(ctx, channel_names)
+
+    # ensure that we synchronize our end to the spoke port config of each channel.
+    # Fetch these from tunelo, as it has more up to date information than Doni
+    fetched = {}
+    for name, channel_uuid in due_channels(ctx, hardware, keys).items():
+        with tracing.span("tunelo_fetch", channel=name):
+            fetched[name] = ctx.tunelo.get_channel(channel_uuid)
+    record_channels(ctx, fetched, channel_names)
 
     # update local side of configuration to match any updated peers or IP changes
-    wg_changed = wg_manager.sync_config(tunelo_channel, wg_private_key)
+    updates = sync_configs(ctx, fetched, keys)
+    apply_tunnel_changes(ctx, updates)
+    for name in updates:
+        ctx.reconciler.done(f"tunnel/{name}")
 
-    # restart services to pick up new config
-    if wg_changed:
-        LOG.info("restarting wg service")
-        supervisor.restart_service("wireguard")
 
-        # look up name of k3s service. Could be different depending on device
-        k3s_name = supervisor.find_k3s_service_name()
-        LOG.info(f"restarting k3s service {k3s_name}")
-        supervisor.restart_service(k3s_name)
+def boot_from_snapshot(ctx: CoordinatorContext):
+    """Bring up the update lock and tunnels from the last known good state.
 
+    This needs no cloud services, so the tunnels come back at boot even if Keystone
+    or Doni can't be reached. Live reconciliation then takes over as usual.
+    """
 
-if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO)
-    update_lock = UpdateLock()
+    snapshot = ctx.snapshot
+    hardware = snapshot.get("hardware")
+    if hardware is None:
+        LOG.info("No state snapshot, waiting for live services")
+        return
+
+    LOG.warning(
+        "Starting from state snapshot %d, last refreshed %.0fs ago",
+        snapshot.generation,
+        snapshot.age(),
+    )
+    with tracing.span("snapshot_boot", generation=snapshot.generation):
+        ctx.restore_hardware(hardware)
+
+        allocations = snapshot.get("allocations")
+        if allocations is not None:
+            apply_update_lock(ctx, hardware["name"], allocations)
+
+        channels = snapshot.get("channels")
+        if channels:
+            keys = get_keys(ctx, list(channels))
+            apply_tunnel_changes(ctx, sync_configs(ctx, channels, keys))
+
+
+def mainLoop(ctx: CoordinatorContext):
+    """Run every reconciliation concern once, in order."""
+
+    sync_hostname(ctx)
+    sync_update_lock(ctx)
+    publish_wireguard_key(ctx)
+    sync_tunnel(ctx)
+
+
+async def _traced(name, awaitable, **attrs):
+    with tracing.span(name, **attrs):
+        return await awaitable
+
+
+async def mainLoopAsync(ctx: CoordinatorContext):
+    """Run one reconciliation like mainLoop, issuing independent requests concurrently.
+
+    Returns the seconds until the update lock next needs to change, if known.
+    """
 
-    while True:
+    # the async engine is opt-in, so don't pay for its imports at startup
+    import asyncio
+
+    from chi_edge_coordinator.clients.aio import (
+        AsyncBlazarClient,
+        AsyncDoniClient,
+        AsyncSupervisorClient,
+        AsyncTuneloClient,
+    )
+
+    doni = AsyncDoniClient(ctx.doni)
+    tunelo = AsyncTuneloClient(ctx.tunelo)
+    blazar = AsyncBlazarClient(ctx.blazar)
+    supervisor = AsyncSupervisorClient(ctx.supervisor)
+
+    async def get_allocations(device_name):
+        with tracing.span("blazar_lookup"):
+            blazar_device_id = await blazar.get_device_id(device_name)
+            if not blazar_device_id:
+                return None
+            allocations = await blazar.get_device_allocations(blazar_device_id)
+            if allocations is not None:
+                ctx.snapshot.update("allocations", allocations)
+            return allocations
+
+    async def get_allocations_or_error(device_name):
+        # a blazar failure shouldn't hold up the doni fetch; it's raised later
         try:
-            mainLoop(update_lock)
-        except Exception:
-            traceback.print_exc()
+            return await get_allocations(device_name)
+        except Exception as exc:
+            return exc
+
+    # The blazar lookup only needs the device name, which rarely changes, so start
+    # it alongside the doni fetch and redo it if the name turns out to differ.
+    name_hint = ctx.hardware_name_hint()
+    hardware, allocations = await asyncio.gather(
+        _traced("doni_fetch", doni.get_hardware(ctx.device_uuid)),
+        get_allocations_or_error(name_hint) if name_hint else asyncio.sleep(0),
+    )
+    ctx.set_hardware(hardware)
+
+    channel_names = utils.get_channel_names(hardware)
+    keys = await asyncio.to_thread(get_keys, ctx, channel_names)
+
+    reconciler = ctx.reconciler
+    channels_patch = []
+    key_due = reconciler.due("key_publication", key_inputs(hardware, keys))
+    if key_due:
+        channels_patch = utils.get_channels_patch(
+            hardware, {name: public_key for name, (_, public_key) in keys.items()}
+        )
+    # the tunelo fetches must follow a key update, as doni may assign us new addresses
+    due = due_channels(ctx, hardware, keys, force=bool(channels_patch))
+
+    # each concern is observed as the same phase the scheduler runs it in, so both
+    # engines export the same series
+    async def sync_hostname():
+        with metrics.observe_phase("hostname"):
+            if reconciler.due("hostname", hostname_inputs(hardware)):
+                with tracing.span("hostname_sync"):
+                    await supervisor.sync_device_hostname(name=hardware["name"])
+                reconciler.done("hostname")
+
+    async def sync_update_lock():
+        # the lookup under the name hint overlaps the doni fetch, so only a repeat
+        # lookup counts towards this phase's duration
+        with metrics.observe_phase("update_lock"):
+            lookup = allocations
+            if hardware["name"] != name_hint:
+                lookup = await get_allocations(hardware["name"])
+            elif isinstance(lookup, BaseException):
+                # without reservations to go on, the lock is left as it was
+                raise lookup
+            return apply_update_lock(ctx, hardware["name"], lookup)
+
+    async def publish_keys():
+        with metrics.observe_phase("key_publication"):
+            if channels_patch:
+                LOG.info(
+                    "Updating channel public keys: %s",
+                    ", ".join(op["path"] for op in channels_patch),
+                )
+                with tracing.span("doni_patch"):
+                    await doni.patch_hardware(
+                        uuid=ctx.device_uuid, jsonpatch=channels_patch
+                    )
+                ctx.invalidate_hardware()
+            if key_due:
+                reconciler.done("key_publication")
+
+    async def sync_tunnels():
+        await publish_keys()
+        with metrics.observe_phase("tunnel_sync"):
+            fetched = await asyncio.gather(
+                *(
+                    _traced("tunelo_fetch", tunelo.get_channel(channel_uuid), channel=name)
+                    for name, channel_uuid in due.items()
+                )
+            )
+            fetched = dict(zip(due, fetched))
+            record_channels(ctx, fetched, channel_names)
 
-        # poll for changes every 60 seconds
-        time.sleep(60.0)
+            # update local side of configuration to match any updated peers or IP
+            # changes
+            updates = await asyncio.to_thread(sync_configs, ctx, fetched, keys)
+            await asyncio.to_thread(apply_tunnel_changes, ctx, updates)
+            for name in updates:
+                reconciler.done(f"tunnel/{name}")
+
+    # hostname and blazar failures shouldn't hold up the tunnel, but still fail
+    # the iteration
+    tunnel_result, hostname_result, next_lock_transition = await asyncio.gather(
+        sync_tunnels(),
+        sync_hostname(),
+        sync_update_lock(),
+        return_exceptions=True,
+    )
+    for result in (tunnel_result, hostname_result, next_lock_transition):
+        if isinstance(result, BaseException):
+            raise result
+
+    return next_lock_transition
+
+
+def run_async_forever(ctx: CoordinatorContext):
+    import asyncio
+
+    async def loop():
+        while True:
+            next_lock_transition = None
+            start = time.monotonic()
+            try:
+                with tracing.iteration(engine="async", number=ctx.iterations):
+                    with metrics.observe_phase("iteration"), deadline.deadline(
+                        ITERATION_DEADLINE
+                    ):
+                        next_lock_transition = await mainLoopAsync(ctx)
+            except Exception:
+                LOG.exception("Coordinator iteration failed")
+            finally:
+                ctx.end_iteration(duration=time.monotonic() - start)
+
+            # poll for changes every 60 seconds, or sooner for a lock transition
+            delay = 60.0
+            if next_lock_transition is not None:
+                delay = min(delay, next_lock_transition)
+            await asyncio.sleep(delay)
+
+    asyncio.run(loop())
+
+
+def build_scheduler(ctx: CoordinatorContext) -> Scheduler:
+    """Schedule each concern independently, so a failing service only delays its own work."""
+
+    def interval(name, default):
+        return float(os.getenv(f"{name}_INTERVAL", default))
+
+    def phase(name, func):
+        def run():
+            with tracing.span(name), metrics.observe_phase(name):
+                with deadline.deadline(ITERATION_DEADLINE):
+                    return func(ctx)
+
+        return run
+
+    # registration order matters on the first pass: publish our key before
+    # syncing the tunnel, as Doni may assign a new address for it
+    return Scheduler(
+        [
+            Task(
+                "hostname",
+                phase("hostname", sync_hostname),
+                interval("HOSTNAME_SYNC", 300),
+            ),
+            Task(
+                "update_lock",
+                phase("update_lock", sync_update_lock),
+                interval("UPDATE_LOCK", 60),
+            ),
+            Task(
+                "key_publication",
+                phase("key_publication", publish_wireguard_key),
+                interval("KEY_PUBLICATION", 300),
+            ),
+            Task(
+                "tunnel_sync",
+                phase("tunnel_sync", sync_tunnel),
+                interval("TUNNEL_SYNC", 60),
+            ),
+        ]
+    )
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    ctx = CoordinatorContext()
+    tracing.configure(tracing.Tracer.from_env(ctx.state_dir))
+
+    metrics_port = os.getenv("COORDINATOR_METRICS_PORT")
+    if metrics_port:
+        metrics.start_http_server(int(metrics_port))
+
+    try:
+        boot_from_snapshot(ctx)
+    except Exception:
+        LOG.exception("Failed to start from state snapshot")
+
+    if os.getenv("COORDINATOR_ENGINE") == "async":
+        run_async_forever(ctx)
+    else:
+        scheduler = build_scheduler(ctx)
+        scheduler.run_forever(
+            after_pass=lambda ran: ctx.end_iteration(
+                duration=sum(task.last_duration for task in ran)
+            ),
+            around_pass=lambda: tracing.iteration(
+                engine="scheduler", number=ctx.iterations
+            ),
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""Deadlines bounding how long a reconciliation can spend waiting on the network.
+
+A deadline is set around each task (or each async iteration), and every HTTP call
+made within it uses at most the time remaining as its timeout. The deadline is kept
+in a context variable, so calls handed to worker threads with asyncio.to_thread
+still see it.
+"""
+
+import contextvars
+import time
+from contextlib import contextmanager
+
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    """The iteration ran out of time before a request could be made."""
+
+
+@contextmanager
+def deadline(seconds):
+    """Give everything in this block at most `seconds`, or less if nested in a
+    shorter deadline. None means no limit."""
+
+    if seconds is None:
+        yield
+        return
+
+    expires = time.monotonic() + seconds
+    outer = _deadline.get()
+    if outer is not None:
+        expires = min(expires, outer)
+    token = _deadline.set(expires)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining():
+    """Seconds left before the current deadline, or None if there isn't one."""
+
+    expires = _deadline.get()
+    if expires is None:
+        return None
+    return expires - time.monotonic()
+
+
+def timeout(per_call):
+    """Return the timeout for a request, bounded by the current deadline.
+
+    `per_call` is a number of seconds, or a (connect, read) tuple as accepted by
+    requests.
+    """
+
+    left = remaining()
+    if left is None:
+        return per_call
+    if left <= 0:
+        raise DeadlineExceeded("Iteration deadline exceeded")
+    if isinstance(per_call, tuple):
+        return tuple(min(t, left) for t in per_call)
+    if per_call is None:
+        return left
+    return min(per_call, left)
@@ -0,0 +1,281 @@
+"""Minimal Prometheus metrics for the coordinator.
+
+Metrics are always collected (it's just a few counters), but only served over HTTP
+if COORDINATOR_METRICS_PORT is set. This avoids pulling a metrics library into the
+image for a handful of series.
+"""
+
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = [
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in pairs
+    ]
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if value != value:
+        return "NaN"
+    return repr(float(value))
+
+
+class _Metric(object):
+    metric_type = ""
+
+    def __init__(self, name, documentation, labelnames=(), registry=None) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def collect(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.metric_type}",
+        ]
+        with self._lock:
+            lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    metric_type = "counter"
+    _function = None
+
+    def inc(self, amount=1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels):
+        if self._function is not None:
+            return self._function()
+        return self._values.get(self._key(labels), 0.0)
+
+    def set_function(self, func):
+        """Compute the (unlabelled) value when scraped, instead of storing it."""
+        self._function = func
+
+    def _samples(self):
+        if self._function is not None:
+            yield f"{self.name} {_format_value(self._function())}"
+            return
+        for key, value in sorted(self._values.items()):
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}{labels} {_format_value(value)}"
+
+
+class Gauge(Counter):
+    metric_type = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+
+class Histogram(_Metric):
+    metric_type = "histogram"
+
+    def __init__(
+        self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None
+    ):
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        super().__init__(name, documentation, labelnames, registry=registry)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def count(self, **labels):
+        counts, _ = self._values.get(self._key(labels), ([0], 0.0))
+        return sum(counts)
+
+    def _samples(self):
+        for key, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(
+                    self.labelnames, key, [("le", _format_value(bound))]
+                )
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class Registry(object):
+    def __init__(self) -> None:
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def exposition(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUEST_DURATION = Histogram(
+    "coordinator_request_duration_seconds",
+    "Latency of requests to CHI@Edge and supervisor APIs.",
+    ["client", "method"],
+)
+REQUEST_ERRORS = Counter(
+    "coordinator_request_errors_total",
+    "Requests that failed without a response, or with an error status.",
+    ["client"],
+)
+REQUEST_BYTES = Counter(
+    "coordinator_request_bytes_total",
+    "Response body bytes received from each API.",
+    ["client"],
+)
+ITERATION_DURATION = Histogram(
+    "coordinator_iteration_duration_seconds",
+    "Time spent on one pass of reconciliation work.",
+)
+PHASE_DURATION = Histogram(
+    "coordinator_phase_duration_seconds",
+    "Time spent in each reconciliation phase.",
+    ["phase"],
+)
+PHASE_FAILURES = Counter(
+    "coordinator_iteration_failures_total",
+    "Reconciliation failures, by the phase that failed.",
+    ["phase"],
+)
+RECONCILE_STEPS = Counter(
+    "coordinator_reconcile_steps_total",
+    "Reconciliation steps run or skipped because their inputs were unchanged.",
+    ["step", "outcome"],
+)
+UPDATE_LOCK_HELD = Gauge(
+    "coordinator_update_lock_held",
+    "Whether the balena update lock is currently held.",
+)
+UPDATE_LOCK_HELD_SECONDS = Counter(
+    "coordinator_update_lock_held_seconds_total",
+    "Total time the balena update lock has been held.",
+)
+UPDATE_LOCK_TRANSITIONS = Counter(
+    "coordinator_update_lock_transitions_total",
+    "Update lock acquisitions and releases.",
+    ["state"],
+)
+SUPERVISOR_CIRCUIT_OPEN = Gauge(
+    "coordinator_supervisor_circuit_open",
+    "Whether supervisor calls are failing fast after repeated failures.",
+)
+SNAPSHOT_AGE = Gauge(
+    "coordinator_snapshot_age_seconds",
+    "Time since the oldest part of the last known good state was fetched live.",
+)
+SERVICE_RESTARTS = Counter(
+    "coordinator_service_restarts_total",
+    "Service restarts requested from the supervisor.",
+    ["service"],
+)
+SERVICE_RESTARTS_AVOIDED = Counter(
+    "coordinator_service_restarts_avoided_total",
+    "Service restarts avoided by applying tunnel changes in place.",
+    ["service"],
+)
+
+
+@contextmanager
+def observe_request(client, method):
+    """Time an API request. Call the yielded function with the response, if any."""
+
+    start = time.perf_counter()
+    result = {}
+    try:
+        yield lambda response: result.setdefault("response", response)
+    except Exception:
+        REQUEST_ERRORS.inc(client=client)
+        raise
+    finally:
+        REQUEST_DURATION.observe(
+            time.perf_counter() - start, client=client, method=method.upper()
+        )
+        response = result.get("response")
+        if response is not None:
+            if not response.ok:
+                REQUEST_ERRORS.inc(client=client)
+            # only count bodies that were already read, streamed ones are left alone
+            content = getattr(response, "_content", None)
+            if isinstance(content, bytes):
+                REQUEST_BYTES.inc(len(content), client=client)
+
+
+@contextmanager
+def observe_phase(phase):
+    """Time a reconciliation phase, counting it as failed if it raises."""
+
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        PHASE_FAILURES.inc(phase=phase)
+        raise
+    finally:
+        PHASE_DURATION.observe(time.perf_counter() - start, phase=phase)
+
+
+def start_http_server(port, addr="0.0.0.0"):
+    """Serve /metrics from a daemon thread."""
+
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = REGISTRY.exposition().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            LOG.debug("metrics: " + format, *args)
+
+    server = ThreadingHTTPServer((addr, port), MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    LOG.info("Serving metrics on %s:%d", addr, server.server_address[1])
+    return server
@@ -0,0 +1,113 @@
+import logging
+import random
+import time
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_RETRY_DELAY = 5.0
+DEFAULT_MAX_BACKOFF = 300.0
+DEFAULT_JITTER = 0.2
+
+
+class Task(object):
+    """A periodic reconciliation task with its own interval and failure backoff."""
+
+    def __init__(
+        self,
+        name,
+        func,
+        interval,
+        retry_delay=DEFAULT_RETRY_DELAY,
+        max_backoff=DEFAULT_MAX_BACKOFF,
+        jitter=DEFAULT_JITTER,
+    ) -> None:
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.retry_delay = retry_delay
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+
+        self.failures = 0
+        self.last_success = None
+        self.last_duration = 0.0
+        self.next_run = 0.0
+
+    def backoff_delay(self) -> float:
+        """Exponential delay for the current failure streak, with random jitter."""
+
+        delay = min(self.retry_delay * 2 ** (self.failures - 1), self.max_backoff)
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def run(self, now: float):
+        """Run the task and schedule its next run.
+
+        The task may return a number of seconds to run again sooner than its
+        interval, e.g. to act exactly at a known deadline.
+        """
+
+        start = time.monotonic()
+        try:
+            result = self.func()
+        except Exception:
+            self.last_duration = time.monotonic() - start
+            self.failures += 1
+            delay = self.backoff_delay()
+            self.next_run = now + delay
+            LOG.exception(
+                "Task %s failed (%d in a row), retrying in %.0fs",
+                self.name,
+                self.failures,
+                delay,
+            )
+            return False
+
+        self.last_duration = time.monotonic() - start
+        self.failures = 0
+        self.last_success = time.time()
+        delay = self.interval
+        if isinstance(result, (int, float)) and result >= 0:
+            delay = min(delay, result)
+        self.next_run = now + delay
+        return True
+
+
+class Scheduler(object):
+    """Runs independent tasks so that one failing task does not delay the others."""
+
+    def __init__(self, tasks, clock=time.monotonic, sleep=time.sleep) -> None:
+        self.tasks = list(tasks)
+        self._clock = clock
+        self._sleep = sleep
+
+    def run_pending(self) -> list:
+        """Run every task that is due, in registration order."""
+
+        ran = []
+        for task in self.tasks:
+            now = self._clock()
+            if task.next_run <= now:
+                task.run(now)
+                ran.append(task)
+        return ran
+
+    def seconds_until_next(self) -> float:
+        next_run = min(task.next_run for task in self.tasks)
+        return max(next_run - self._clock(), 0.0)
+
+    def run_forever(self, after_pass=None, around_pass=None):
+        """Run due tasks until interrupted.
+
+        `around_pass` may return a context manager to wrap each pass in, and
+        `after_pass` is called with the tasks a pass ran.
+        """
+
+        while True:
+            if around_pass:
+                with around_pass():
+                    ran = self.run_pending()
+            else:
+                ran = self.run_pending()
+            if ran and after_pass:
+                after_pass(ran)
+            self._sleep(self.seconds_until_next())
@@ -0,0 +1,200 @@
+"""Named spans around each phase of an iteration, and profiles of slow iterations.
+
+Spans are written as JSON lines to COORDINATOR_TRACE_FILE ("-" for stdout) if it is
+set. If COORDINATOR_PROFILE_THRESHOLD is set, iterations run under cProfile, and the
+profile of any iteration slower than that many seconds is kept in a bounded spool
+directory. cProfile only sees the thread it was started on, so with the async engine
+the profile covers the event loop but not the blocking calls it hands to threads.
+"""
+
+import contextvars
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+LOG = logging.getLogger(__name__)
+
+PROFILE_SPOOL_SIZE = 20
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def _new_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+class Span(object):
+    def __init__(self, name, trace_id, parent_id=None, attrs=None) -> None:
+        self.name = name
+        self.trace_id = trace_id
+        self.parent_id = parent_id
+        self.span_id = _new_id()
+        self.attrs = dict(attrs or {})
+        self.start = time.time()
+        self._start = time.perf_counter()
+        self.duration = None
+        self.error = None
+
+    def finish(self, error=None):
+        self.duration = time.perf_counter() - self._start
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+
+    def to_dict(self) -> dict:
+        record = {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": round(self.start, 6),
+            "duration": round(self.duration, 6),
+            "status": "error" if self.error else "ok",
+        }
+        if self.error:
+            record["error"] = self.error
+        if self.attrs:
+            record["attrs"] = self.attrs
+        return record
+
+
+class Tracer(object):
+    def __init__(
+        self,
+        trace_file=None,
+        profile_threshold=None,
+        profile_dir=None,
+        spool_size=PROFILE_SPOOL_SIZE,
+    ) -> None:
+        self.trace_file = trace_file
+        self.profile_threshold = profile_threshold
+        self.profile_dir = Path(profile_dir) if profile_dir else None
+        self.spool_size = spool_size
+        self._stream = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, state_dir) -> "Tracer":
+        threshold = os.getenv("COORDINATOR_PROFILE_THRESHOLD")
+        return cls(
+            trace_file=os.getenv("COORDINATOR_TRACE_FILE"),
+            profile_threshold=float(threshold) if threshold else None,
+            profile_dir=os.getenv(
+                "COORDINATOR_PROFILE_DIR", os.path.join(state_dir, "profiles")
+            ),
+            spool_size=int(os.getenv("COORDINATOR_PROFILE_SPOOL_SIZE", PROFILE_SPOOL_SIZE)),
+        )
+
+    def _emit(self, span: Span):
+        if not self.trace_file:
+            return
+        line = json.dumps(span.to_dict(), sort_keys=True) + "\n"
+        with self._lock:
+            try:
+                if self._stream is None:
+                    if self.trace_file == "-":
+                        self._stream = sys.stdout
+                    else:
+                        self._stream = open(self.trace_file, "a")
+                self._stream.write(line)
+                self._stream.flush()
+            except OSError:
+                LOG.exception("Failed to write span to %s", self.trace_file)
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """Time a phase, nested under whichever span is current."""
+
+        parent = _current_span.get()
+        span = Span(
+            name,
+            trace_id=parent.trace_id if parent else _new_id(),
+            parent_id=parent.span_id if parent else None,
+            attrs=attrs,
+        )
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as exc:
+            span.finish(error=exc)
+            raise
+        else:
+            span.finish()
+        finally:
+            _current_span.reset(token)
+            self._emit(span)
+
+    @contextmanager
+    def iteration(self, **attrs):
+        """Trace one iteration, keeping a profile of it if it's slower than the threshold."""
+
+        profile = None
+        if self.profile_threshold is not None:
+            import cProfile
+
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # another profiler is already active on this thread
+                profile = None
+
+        span = None
+        try:
+            with self.span("iteration", **attrs) as span:
+                yield span
+        finally:
+            if profile is not None:
+                profile.disable()
+                if span is not None and span.duration > self.profile_threshold:
+                    self._save_profile(profile, span)
+
+    def _save_profile(self, profile, span: Span):
+        path = self.profile_dir / "iteration-{}-{}.prof".format(
+            time.strftime("%Y%m%dT%H%M%S", time.gmtime(span.start)), span.trace_id
+        )
+        try:
+            self.profile_dir.mkdir(parents=True, exist_ok=True)
+            profile.dump_stats(path)
+        except OSError:
+            LOG.exception("Failed to save profile of slow iteration")
+            return
+
+        LOG.warning(
+            "Iteration took %.1fs (threshold %.1fs), profile saved to %s",
+            span.duration,
+            self.profile_threshold,
+            path,
+        )
+        self._prune_spool()
+
+    def _prune_spool(self):
+        profiles = sorted(
+            self.profile_dir.glob("iteration-*.prof"), key=lambda p: p.stat().st_mtime
+        )
+        for old_profile in profiles[: max(len(profiles) - self.spool_size, 0)]:
+            try:
+                old_profile.unlink()
+            except FileNotFoundError:
+                pass
+
+
+TRACER = Tracer()
+
+
+def configure(tracer: Tracer):
+    global TRACER
+    TRACER = tracer
+
+
+def span(name, **attrs):
+    return TRACER.span(name, **attrs)
+
+
+def iteration(**attrs):
+    return TRACER.iteration(**attrs)
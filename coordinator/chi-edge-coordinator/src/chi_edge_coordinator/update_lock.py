@@ -1,28 +1,76 @@
 import logging
+import time
+from bisect import bisect_right
 from datetime import datetime, timedelta, timezone
 
 from lockfile import LockFile
 
+from chi_edge_coordinator import metrics
+
 LOG = logging.getLogger(__name__)
 
 LOCKFILE_PATH = "/tmp/balena/updates"
 DEFAULT_GUARD_MINUTES = 15
 
 
-def device_should_lock(allocations, guard_minutes=DEFAULT_GUARD_MINUTES, now=None):
-    if now is None:
-        now = datetime.now(timezone.utc)
-    guard = timedelta(minutes=guard_minutes)
+def _parse_date(value):
+    return datetime.fromisoformat(value).replace(tzinfo=timezone.utc)
+
+
+class ReservationIndex(object):
+    """Sorted, merged intervals during which the update lock should be held.
+
+    Each reservation locks from `guard_minutes` before its start until its end.
+    Overlapping or touching intervals are merged, so lookups are a binary search.
+    """
+
+    def __init__(self, allocations, guard_minutes=DEFAULT_GUARD_MINUTES):
+        guard = timedelta(minutes=guard_minutes)
+        intervals = sorted(
+            (_parse_date(res["start_date"]) - guard, _parse_date(res["end_date"]))
+            for res in allocations
+        )
+
+        self._starts = []
+        self._ends = []
+        for start, end in intervals:
+            if end <= start:
+                continue
+            if self._ends and start <= self._ends[-1]:
+                self._ends[-1] = max(self._ends[-1], end)
+            else:
+                self._starts.append(start)
+                self._ends.append(end)
 
-    for res in allocations:
-        start = datetime.fromisoformat(res["start_date"]).replace(tzinfo=timezone.utc)
-        end = datetime.fromisoformat(res["end_date"]).replace(tzinfo=timezone.utc)
+    def __len__(self):
+        return len(self._starts)
 
-        # Active reservation, or one starting within guard window
-        if end > now and (start - guard) <= now:
-            return True
+    def _interval_at(self, now):
+        # index of the last interval starting at or before now, or -1
+        return bisect_right(self._starts, now) - 1
 
-    return False
+    def locked(self, now=None) -> bool:
+        if now is None:
+            now = datetime.now(timezone.utc)
+        i = self._interval_at(now)
+        return i >= 0 and now < self._ends[i]
+
+    def next_transition(self, now=None):
+        """Return when locked() next changes value, or None if it never will."""
+
+        if now is None:
+            now = datetime.now(timezone.utc)
+        i = self._interval_at(now)
+        if i >= 0 and now < self._ends[i]:
+            return self._ends[i]
+        if i + 1 < len(self._starts):
+            return self._starts[i + 1]
+        return None
+
+
+def device_should_lock(allocations, guard_minutes=DEFAULT_GUARD_MINUTES, now=None):
+    # Active reservation, or one starting within guard window
+    return ReservationIndex(allocations, guard_minutes).locked(now)
 
 
 class UpdateLock:
@@ -32,19 +80,35 @@ class UpdateLock:
         if self._lock.is_locked():
             LOG.info("Breaking stale update lock from previous run")
             self._lock.break_lock()
+        self._held_since = None
+        self._held_seconds = 0.0
+        metrics.UPDATE_LOCK_HELD.set_function(lambda: float(self.held))
+        metrics.UPDATE_LOCK_HELD_SECONDS.set_function(self.held_seconds)
 
     @property
     def held(self):
         return self._lock.is_locked()
 
+    def held_seconds(self) -> float:
+        """Total time this process has held the lock, including the current hold."""
+
+        if self._held_since is None:
+            return self._held_seconds
+        return self._held_seconds + time.monotonic() - self._held_since
+
     def acquire(self):
         if self._lock.is_locked():
             return
         self._lock.acquire()
+        self._held_since = time.monotonic()
+        metrics.UPDATE_LOCK_TRANSITIONS.inc(state="acquired")
         LOG.info("Update lock acquired")
 
     def release(self):
         if not self._lock.is_locked():
             return
         self._lock.release()
+        self._held_seconds = self.held_seconds()
+        self._held_since = None
+        metrics.UPDATE_LOCK_TRANSITIONS.inc(state="released")
         LOG.info("Update lock released")
@@ -1,5 +1,33 @@
+import os
+import tempfile
+from pathlib import Path
+
+# the channel k3s runs over; it always exists, as we publish its key ourselves
+USER_CHANNEL = "user"
+
+
+def _channel_workers(hardware):
+    return [w for w in hardware.get("workers", []) if w["worker_type"] == "tunelo"]
+
+
+def get_channel_names(hardware) -> list:
+    """Names of the wireguard channels this device should have a tunnel for."""
+
+    channels = dict(hardware["properties"].get("channels") or {})
+    for worker in _channel_workers(hardware):
+        for name, state in worker["state_details"].get("channels", {}).items():
+            channels.setdefault(name, state)
+    channels.setdefault(USER_CHANNEL, {})
+
+    return sorted(
+        name
+        for name, channel in channels.items()
+        if channel.get("channel_type", "wireguard") == "wireguard"
+    )
+
+
 def get_channel(hardware, channel_name):
-    channel_workers = [w for w in hardware["workers"] if w["worker_type"] == "tunelo"]
+    channel_workers = _channel_workers(hardware)
     if not channel_workers:
         raise RuntimeError("Missing information for tunnel configuration")
 
@@ -13,31 +41,36 @@ def get_channel(hardware, channel_name):
 
 
 def get_channel_patch(hardware, channel_name, pubkey):
-    expected_channel = {"channel_type": "wireguard", "public_key": pubkey}
+    return get_channels_patch(hardware, {channel_name: pubkey})
+
+
+def get_channels_patch(hardware, pubkeys: dict):
+    """One JSON patch publishing the public key of every channel in `pubkeys`."""
+
+    expected = {
+        name: {"channel_type": "wireguard", "public_key": pubkey}
+        for name, pubkey in pubkeys.items()
+    }
 
     channels = hardware["properties"].get("channels")
     if channels is None:
         # Corner case, no channels defined at all (Doni should really default this to
         # an empty obj better)
-        return [
-            {
-                "op": "add",
-                "path": "/properties/channels",
-                "value": {channel_name: expected_channel},
-            }
-        ]
+        return [{"op": "add", "path": "/properties/channels", "value": expected}]
 
-    existing_channel = channels.get(channel_name)
-    if not existing_channel or existing_channel.get("public_key") != pubkey:
-        return [
-            {
-                "op": "replace" if existing_channel else "add",
-                "path": f"/properties/channels/{channel_name}",
-                "value": expected_channel,
-            }
-        ]
+    patch = []
+    for channel_name, expected_channel in sorted(expected.items()):
+        existing_channel = channels.get(channel_name)
+        if not existing_channel or existing_channel.get("public_key") != pubkeys[channel_name]:
+            patch.append(
+                {
+                    "op": "replace" if existing_channel else "add",
+                    "path": f"/properties/channels/{channel_name}",
+                    "value": expected_channel,
+                }
+            )
 
-    return []
+    return patch
 
 
 def uuid_hex_to_dashed(uuid_hex: str):
@@ -54,3 +87,23 @@ def uuid_hex_to_dashed(uuid_hex: str):
     )
 
     return dashed_uuid
+
+
+def atomic_write(path, text: str, mode=0o600):
+    """Replace a file's contents without exposing a partially written file."""
+
+    path = Path(path)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, "w") as f:
+            os.fchmod(f.fileno(), mode)
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
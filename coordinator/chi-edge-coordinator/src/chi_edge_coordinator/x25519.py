@@ -0,0 +1,81 @@
+"""Pure-python X25519 key handling, compatible with `wg genkey` and `wg pubkey`.
+
+Implements the Montgomery ladder from RFC 7748. It's not constant-time, which is
+acceptable here since it only ever runs on the device's own key, and only when that
+key changes.
+"""
+
+import base64
+import os
+
+_P = 2**255 - 19
+_A24 = 121665
+_BASE_POINT = 9
+
+
+def _clamp(scalar: bytes) -> int:
+    k = bytearray(scalar)
+    k[0] &= 248
+    k[31] &= 127
+    k[31] |= 64
+    return int.from_bytes(k, "little")
+
+
+def x25519(scalar: bytes, u_coordinate: int) -> bytes:
+    """Multiply a point (by its u-coordinate) by a 32 byte scalar."""
+
+    k = _clamp(scalar)
+    x_1 = u_coordinate
+    x_2, z_2, x_3, z_3 = 1, 0, u_coordinate, 1
+    swap = 0
+
+    for t in reversed(range(255)):
+        k_t = (k >> t) & 1
+        swap ^= k_t
+        if swap:
+            x_2, x_3 = x_3, x_2
+            z_2, z_3 = z_3, z_2
+        swap = k_t
+
+        a = (x_2 + z_2) % _P
+        aa = a * a % _P
+        b = (x_2 - z_2) % _P
+        bb = b * b % _P
+        e = (aa - bb) % _P
+        c = (x_3 + z_3) % _P
+        d = (x_3 - z_3) % _P
+        da = d * a % _P
+        cb = c * b % _P
+        x_3 = (da + cb) ** 2 % _P
+        z_3 = x_1 * (da - cb) ** 2 % _P
+        x_2 = aa * bb % _P
+        z_2 = e * (aa + _A24 * e) % _P
+
+    if swap:
+        x_2, z_2 = x_3, z_3
+
+    return (x_2 * pow(z_2, _P - 2, _P) % _P).to_bytes(32, "little")
+
+
+def _decode_key(key_b64: str) -> bytes:
+    key = base64.b64decode(key_b64.strip(), validate=True)
+    if len(key) != 32:
+        raise ValueError("Wireguard keys must be 32 bytes")
+    return key
+
+
+def generate_private_key() -> str:
+    """Return a new base64 encoded private key, equivalent to `wg genkey`."""
+
+    key = bytearray(os.urandom(32))
+    key[0] &= 248
+    key[31] &= 127
+    key[31] |= 64
+    return base64.b64encode(bytes(key)).decode()
+
+
+def public_key(private_key_b64: str) -> str:
+    """Derive the base64 encoded public key, equivalent to `wg pubkey`."""
+
+    private_key = _decode_key(private_key_b64)
+    return base64.b64encode(x25519(private_key, _BASE_POINT)).decode()
@@ -1,3 +1,5 @@
+from chi_edge_coordinator.clients.wgcommand import InterfaceState
+
 FAKE_BALENA_SERVICE_NAME = "wireguard"
 FAKE_BALENA_SERVICE_MISSING = "wireguard-foo"
 
@@ -61,6 +63,9 @@ FAKE_BLAZAR_ALLOCATIONS_RESPONSE = {
         {"resource_id": "aaaaaaaa-bbbb-cccc-dddd-eeeeeeeeeeee", "reservations": []},
     ]
 }
+FAKE_BLAZAR_ALLOCATION_RESPONSE = {
+    "allocation": FAKE_BLAZAR_ALLOCATIONS_RESPONSE["allocations"][0],
+}
 
 FAKE_CHANNEL_NAME = "fake_channel"
 FAKE_CHANNEL = {}
@@ -77,3 +82,51 @@ FAKE_HARDWARE = {
         },
     },
 }
+
+FAKE_WG_PRIVKEY = "cHJpdmF0ZS1rZXktcHJpdmF0ZS1rZXktcHJpdmF0ZS0="
+FAKE_HUB_PUBKEY = "aHViLWtleS1odWIta2V5LWh1Yi1rZXktaHViLWtleS0="
+FAKE_TUNELO_CHANNEL = {
+    "properties": {"ip": "10.20.0.5"},
+    "peers": [
+        {
+            "properties": {
+                "public_key": FAKE_HUB_PUBKEY,
+                "endpoint": "192.0.2.10:51820",
+                "ip": "10.20.0.1",
+            }
+        }
+    ],
+}
+
+
+class FakeWgCommand(object):
+    """In-memory stand-in for a running wireguard interface."""
+
+    def __init__(self, private_key="", peers=None, addresses=()):
+        self.private_key = private_key
+        self.peers = dict(peers or {})
+        self.addresses = set(addresses)
+        self.calls = []
+
+    def show(self, interface):
+        return InterfaceState(self.private_key, dict(self.peers), frozenset(self.addresses))
+
+    def set_private_key(self, interface, private_key):
+        self.calls.append("set_private_key")
+        self.private_key = private_key
+
+    def set_peer(self, interface, peer):
+        self.calls.append("set_peer")
+        self.peers[peer.public_key] = peer
+
+    def remove_peer(self, interface, public_key):
+        self.calls.append("remove_peer")
+        del self.peers[public_key]
+
+    def add_address(self, interface, address):
+        self.calls.append("add_address")
+        self.addresses.add(address)
+
+    def remove_address(self, interface, address):
+        self.calls.append("remove_address")
+        self.addresses.discard(address)
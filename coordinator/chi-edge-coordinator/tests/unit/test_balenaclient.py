@@ -1,7 +1,14 @@
 import unittest
 from unittest.mock import Mock, patch
 
-from chi_edge_coordinator.clients.balena import BalenaSupervisorClient
+import requests
+
+from chi_edge_coordinator import deadline
+from chi_edge_coordinator.clients.balena import (
+    BalenaSupervisorClient,
+    CircuitBreaker,
+    SupervisorUnavailable,
+)
 
 from tests.unit import fakes
 
@@ -20,7 +27,7 @@ class TestBalena(unittest.TestCase):
             FAKE_BALENA_SUPERVISOR_API_KEY,
         )
 
-    @patch("chi_edge_coordinator.clients.balena.requests.request")
+    @patch("chi_edge_coordinator.clients.balena.requests.Session.request")
     def test_call_supervisor_empty_response(self, mock_request):
         # mock the response from request to supervisor
         # in this case, we don't throw a status code, but still have empty response
@@ -32,7 +39,7 @@ class TestBalena(unittest.TestCase):
         self.assertEqual(response, {})
         self.assertRaises(ValueError)
 
-    @patch("chi_edge_coordinator.clients.balena.requests.request")
+    @patch("chi_edge_coordinator.clients.balena.requests.Session.request")
     def test_call_supervisor_valid_response(self, mock_request):
         mock_response = Mock(status_code=200)
         mock_response.json.return_value = self.fake_response
@@ -87,3 +94,96 @@ class TestBalena(unittest.TestCase):
         mock_call_supervisor.return_value = mock_status
         with self.assertRaises(RuntimeError):
             self.client.find_k3s_service_name()
+
+    @patch.object(BalenaSupervisorClient, "call_supervisor")
+    def test_restart_services_single_snapshot(self, mock_call_supervisor: Mock):
+        mock_status = {
+            "containers": [
+                {"serviceName": "wireguard", "status": "Running", "appId": 1},
+                {"serviceName": "k3s-fake-01", "status": "Running", "appId": 1},
+            ]
+        }
+        mock_call_supervisor.return_value = mock_status
+
+        state = self.client.get_state()
+        k3s_name = self.client.find_k3s_service_name(state)
+        restarted = self.client.restart_services(["wireguard", k3s_name], state=state)
+
+        self.assertEqual(restarted, ["wireguard", "k3s-fake-01"])
+        status_calls = [
+            c for c in mock_call_supervisor.call_args_list if c.args == ("/v2/state/status",)
+        ]
+        self.assertEqual(len(status_calls), 1)
+        self.assertEqual(mock_call_supervisor.call_count, 3)
+
+
+@patch("chi_edge_coordinator.clients.balena.time.sleep")
+class TestSupervisorResilience(unittest.TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.now = 0.0
+        self.client = BalenaSupervisorClient(
+            FAKE_BALENA_SUPERVISOR_ADDRESS,
+            FAKE_BALENA_SUPERVISOR_API_KEY,
+            breaker=CircuitBreaker(clock=lambda: self.now),
+        )
+        self.client.session.request = Mock()
+        self.ok = Mock(status_code=200)
+        self.ok.json.return_value = {}
+
+    def test_get_retried_on_connection_error(self, sleep):
+        self.client.session.request.side_effect = [requests.ConnectionError(), self.ok]
+
+        self.assertEqual(self.client.call_supervisor(FAKE_SUPERVISOR_PATH), {})
+        self.assertEqual(self.client.session.request.call_count, 2)
+        sleep.assert_called_once()
+
+    def test_post_not_retried(self, sleep):
+        self.client.session.request.side_effect = requests.ConnectionError()
+
+        with self.assertRaises(requests.ConnectionError):
+            self.client.call_supervisor(FAKE_SUPERVISOR_PATH, method="post")
+        self.client.session.request.assert_called_once()
+
+    def test_requests_have_timeouts(self, sleep):
+        self.client.session.request.return_value = self.ok
+
+        with deadline.deadline(1.0):
+            self.client.call_supervisor(FAKE_SUPERVISOR_PATH)
+
+        connect, read = self.client.session.request.call_args.kwargs["timeout"]
+        self.assertLessEqual(connect, 1.0)
+        self.assertLessEqual(read, 1.0)
+
+    def test_circuit_opens_and_recovers(self, sleep):
+        self.client.session.request.side_effect = requests.Timeout()
+        for _ in range(3):
+            with self.assertRaises(requests.Timeout):
+                self.client.call_supervisor(FAKE_SUPERVISOR_PATH)
+        calls = self.client.session.request.call_count
+
+        # open: fail fast without touching the network
+        with self.assertRaises(SupervisorUnavailable):
+            self.client.call_supervisor(FAKE_SUPERVISOR_PATH)
+        self.assertFalse(self.client.ping())
+        self.assertEqual(self.client.session.request.call_count, calls)
+
+        # after the reset timeout, one probe is let through
+        self.now += 60
+        self.client.session.request.side_effect = None
+        self.client.session.request.return_value = self.ok
+        self.client.call_supervisor(FAKE_SUPERVISOR_PATH)
+        self.assertFalse(self.client.breaker.open)
+
+    def test_server_errors_open_circuit(self, sleep):
+        error = Mock(status_code=500)
+        error.raise_for_status.side_effect = requests.HTTPError("500 Server Error")
+        self.client.session.request.return_value = error
+
+        for _ in range(3):
+            with self.assertRaises(requests.HTTPError):
+                self.client.call_supervisor(FAKE_SUPERVISOR_PATH)
+
+        # 500 isn't retried, but still counts as a failure
+        self.assertEqual(self.client.session.request.call_count, 3)
+        self.assertTrue(self.client.breaker.open)
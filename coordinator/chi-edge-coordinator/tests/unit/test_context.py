@@ -0,0 +1,112 @@
+import json
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest.mock import Mock
+
+from chi_edge_coordinator.context import SNAPSHOT_FORMAT, StateSnapshot, TokenCache
+
+FAKE_CACHE_ID = "fake-cache-id"
+FAKE_AUTH_STATE = '{"auth_token": "tok", "body": {}}'
+
+
+class TestTokenCache(unittest.TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.cache = TokenCache(Path(self.tmpdir.name, "token.json"))
+
+        self.auth = Mock(MIN_TOKEN_LIFE_SECONDS=120)
+        self.auth.get_cache_id.return_value = FAKE_CACHE_ID
+        self.auth.get_auth_state.return_value = FAKE_AUTH_STATE
+        self.auth.auth_ref.will_expire_soon.return_value = False
+
+    def test_load_missing(self):
+        self.assertFalse(self.cache.load(self.auth))
+        self.auth.set_auth_state.assert_not_called()
+
+    def test_save_and_load(self):
+        self.assertTrue(self.cache.save(self.auth))
+        self.assertEqual(self.cache.path.stat().st_mode & 0o777, 0o600)
+
+        restored = TokenCache(self.cache.path)
+        self.assertTrue(restored.load(self.auth))
+        self.auth.set_auth_state.assert_called_once_with(FAKE_AUTH_STATE)
+
+    def test_save_unchanged(self):
+        self.assertTrue(self.cache.save(self.auth))
+        self.assertFalse(self.cache.save(self.auth))
+
+    def test_load_expired(self):
+        self.cache.save(self.auth)
+        self.auth.auth_ref.will_expire_soon.return_value = True
+        self.assertFalse(TokenCache(self.cache.path).load(self.auth))
+
+    def test_load_other_credentials(self):
+        self.cache.save(self.auth)
+        self.auth.get_cache_id.return_value = "rotated"
+        self.assertFalse(TokenCache(self.cache.path).load(self.auth))
+        self.auth.set_auth_state.assert_not_called()
+
+
+class TestStateSnapshot(unittest.TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.path = Path(self.tmpdir.name, "snapshot.json")
+        self.snapshot = StateSnapshot(self.path)
+
+    def test_load_missing(self):
+        self.assertFalse(self.snapshot.load())
+        self.assertIsNone(self.snapshot.get("hardware"))
+        self.assertIsNone(self.snapshot.age())
+
+    def test_save_and_load(self):
+        self.snapshot.update("hardware", {"name": "iot-rpi4-0015"})
+        self.snapshot.update("allocations", [])
+        self.assertTrue(self.snapshot.save())
+        self.assertEqual(self.path.stat().st_mode & 0o777, 0o600)
+
+        restored = StateSnapshot(self.path)
+        self.assertTrue(restored.load())
+        self.assertEqual(restored.generation, 1)
+        self.assertEqual(restored.get("hardware"), {"name": "iot-rpi4-0015"})
+        self.assertEqual(restored.get("allocations"), [])
+        self.assertLess(restored.age(), 5)
+
+    def test_unchanged_not_rewritten(self):
+        self.snapshot.update("channels", {"user": {"peers": []}})
+        self.assertTrue(self.snapshot.save())
+        self.snapshot.update("channels", {"user": {"peers": []}})
+        self.assertFalse(self.snapshot.save())
+        self.snapshot.update("channels", {"user": {"peers": [{"properties": {}}]}})
+        self.assertTrue(self.snapshot.save())
+        self.assertEqual(self.snapshot.generation, 2)
+
+    def test_age_of_oldest_part(self):
+        now = time.time()
+        self.snapshot.update("hardware", {})
+        self.snapshot.update("allocations", [])
+        self.snapshot._parts["allocations"]["fetched_at"] = now - 600
+
+        self.assertAlmostEqual(self.snapshot.age(now=now), 600, delta=1)
+        self.assertAlmostEqual(self.snapshot.age("hardware", now=now), 0, delta=1)
+
+    def test_drops_unknown_parts(self):
+        parts = {
+            "hardware": {"value": {}, "fetched_at": time.time()},
+            "channel": {"value": {"peers": []}, "fetched_at": time.time()},
+        }
+        self.path.write_text(json.dumps({"format": SNAPSHOT_FORMAT, "parts": parts}))
+
+        self.assertTrue(self.snapshot.load())
+        self.assertIsNone(self.snapshot.get("channel"))
+        self.assertIsNone(self.snapshot.get("channels"))
+
+    def test_ignores_other_format(self):
+        self.path.write_text(json.dumps({"format": 99, "parts": {"hardware": {}}}))
+        self.assertFalse(self.snapshot.load())
+        self.assertIsNone(self.snapshot.get("hardware"))
@@ -0,0 +1,520 @@
+import asyncio
+import os
+import tempfile
+import threading
+import time
+import unittest
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from unittest.mock import Mock, patch
+
+from chi_edge_coordinator import metrics
+from chi_edge_coordinator.clients.balena import SupervisorState
+from chi_edge_coordinator.clients.wgcommand import LiveApplyError
+from chi_edge_coordinator.clients.wgconfig import ChangeSet, WireguardManager
+from chi_edge_coordinator.coordinator import (
+    TunnelUpdate,
+    apply_tunnel_changes,
+    apply_update_lock,
+    boot_from_snapshot,
+    mainLoop,
+    mainLoopAsync,
+)
+from chi_edge_coordinator.context import CoordinatorContext, StateSnapshot
+from chi_edge_coordinator.reconcile import Reconciler
+
+from tests.unit import fakes
+
+# simulated round trip time of a high-latency edge uplink
+FAKE_LATENCY = 0.05
+FAKE_CHANNEL_UUID = "f6b5c0e2-8f43-4d5e-9a41-0d2b1c3e4f50"
+FAKE_HARDWARE = dict(
+    fakes.FAKE_HARDWARE,
+    name=fakes.FAKE_DEVICE_NAME,
+    workers=[
+        {
+            "worker_type": "tunelo",
+            "state_details": {"channels": {"user": {"uuid": FAKE_CHANNEL_UUID}}},
+        }
+    ],
+)
+
+
+class InFlight(object):
+    """Counts the fake requests running at once, to check which ones overlap."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.current = 0
+        self.peak = 0
+
+    def __enter__(self):
+        with self._lock:
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+
+    def __exit__(self, *exc_info):
+        with self._lock:
+            self.current -= 1
+
+
+IN_FLIGHT = InFlight()
+
+
+def _slow(return_value=None):
+    def call(*args, **kwargs):
+        with IN_FLIGHT:
+            time.sleep(FAKE_LATENCY)
+        return return_value
+
+    return Mock(side_effect=call)
+
+
+def _wg_manager(private_key, public_key):
+    manager = Mock()
+    manager.get_wireguard_keys.return_value = (private_key, public_key)
+    manager.sync_config.return_value = ChangeSet()
+    return manager
+
+
+class FakeContext(object):
+    device_uuid = fakes.FAKE_HARDWARE_UUID
+
+    def __init__(self):
+        self.doni = Mock(get_hardware=_slow(FAKE_HARDWARE), patch_hardware=_slow())
+        self.tunelo = Mock(get_channel=_slow(fakes.FAKE_CHANNEL))
+        self.blazar = Mock(
+            get_device_id=_slow(fakes.FAKE_DEVICE_ID),
+            get_device_allocations=_slow([]),
+        )
+        self.supervisor = Mock(sync_device_hostname=_slow())
+        self.update_lock = Mock()
+        # the user channel's manager; other channels get their own
+        self.wg_manager = _wg_manager("priv", "pub")
+        self.wg_managers = {"user": self.wg_manager}
+        self._hardware = None
+        self._stale = True
+        self.snapshot = StateSnapshot()
+        self.reconciler = Reconciler()
+        self.restart_stats = Counter()
+        self._reservation_index = (None, None)
+
+    record_restarts = CoordinatorContext.record_restarts
+    get_reservation_index = CoordinatorContext.get_reservation_index
+
+    def tunnel_manager(self, channel_name):
+        if channel_name not in self.wg_managers:
+            self.wg_managers[channel_name] = _wg_manager(
+                f"{channel_name}-priv", f"{channel_name}-pub"
+            )
+        return self.wg_managers[channel_name]
+
+    def get_hardware(self):
+        if self._stale:
+            self.set_hardware(self.doni.get_hardware(self.device_uuid))
+        return self._hardware
+
+    def set_hardware(self, hardware):
+        self._hardware = hardware
+        self._stale = False
+        self.snapshot.update("hardware", hardware)
+
+    def restore_hardware(self, hardware):
+        self._hardware = hardware
+        self._stale = True
+
+    def invalidate_hardware(self):
+        self._stale = True
+
+    def hardware_name_hint(self):
+        return self._hardware["name"] if self._hardware else None
+
+
+class TestMainLoop(unittest.TestCase):
+    def test_sync_and_async_agree(self):
+        sync_ctx, async_ctx = FakeContext(), FakeContext()
+        mainLoop(sync_ctx)
+        asyncio.run(mainLoopAsync(async_ctx))
+
+        for ctx in (sync_ctx, async_ctx):
+            ctx.doni.patch_hardware.assert_called_once()
+            ctx.tunelo.get_channel.assert_called_once()
+            ctx.supervisor.sync_device_hostname.assert_called_once_with(
+                name=fakes.FAKE_DEVICE_NAME
+            )
+            ctx.update_lock.release.assert_called_once()
+            ctx.wg_manager.sync_config.assert_called_once_with(fakes.FAKE_CHANNEL, "priv")
+
+    def test_async_iteration_overlaps_requests(self):
+        """Independent requests are in flight together in an async tick only."""
+
+        def peak_in_flight(run):
+            ctx = FakeContext()
+            run(ctx)  # first pass publishes our key and learns the device name
+            ctx.doni.get_hardware.side_effect = _slow(
+                dict(FAKE_HARDWARE, properties={"channels": {"user": {"public_key": "pub"}}})
+            ).side_effect
+            ctx.invalidate_hardware()
+            IN_FLIGHT.peak = 0
+            run(ctx)
+            return IN_FLIGHT.peak
+
+        self.assertEqual(peak_in_flight(mainLoop), 1)
+        # at least the doni fetch overlaps the blazar lookup
+        self.assertGreaterEqual(
+            peak_in_flight(lambda ctx: asyncio.run(mainLoopAsync(ctx))), 2
+        )
+
+    def test_async_phases_observed(self):
+        phases = ("hostname", "update_lock", "key_publication", "tunnel_sync")
+        before = {phase: metrics.PHASE_DURATION.count(phase=phase) for phase in phases}
+
+        asyncio.run(mainLoopAsync(FakeContext()))
+
+        for phase in phases:
+            self.assertEqual(
+                metrics.PHASE_DURATION.count(phase=phase), before[phase] + 1, phase
+            )
+
+    def test_async_hostname_failure_still_syncs_tunnel(self):
+        ctx = FakeContext()
+        ctx.supervisor.sync_device_hostname.side_effect = Exception("update lock is set")
+
+        with self.assertRaises(Exception):
+            asyncio.run(mainLoopAsync(ctx))
+        ctx.wg_manager.sync_config.assert_called_once()
+
+    def test_async_blazar_failure_still_syncs_tunnel(self):
+        ctx = FakeContext()
+        ctx.blazar.get_device_id.side_effect = Exception("blazar unavailable")
+
+        with self.assertRaisesRegex(Exception, "blazar unavailable"):
+            asyncio.run(mainLoopAsync(ctx))
+        ctx.wg_manager.sync_config.assert_called_once()
+        # without reservations to go on, the lock is left as it was
+        ctx.update_lock.acquire.assert_not_called()
+        ctx.update_lock.release.assert_not_called()
+
+
+class TestIncrementalReconcile(unittest.TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.now = 0.0
+        self.ctx = FakeContext()
+        self.ctx.reconciler = Reconciler(full_reconcile_interval=600, clock=lambda: self.now)
+
+    def _assert_second_pass_skipped(self, run):
+        run(self.ctx)
+        self.ctx.invalidate_hardware()
+        run(self.ctx)
+
+        self.ctx.supervisor.sync_device_hostname.assert_called_once()
+        self.ctx.doni.patch_hardware.assert_called_once()
+        self.ctx.tunelo.get_channel.assert_called_once()
+        self.ctx.wg_manager.sync_config.assert_called_once()
+        self.assertEqual(
+            self.ctx.reconciler.stats()["tunnel/user"], {"executed": 1, "skipped": 1}
+        )
+
+    def test_unchanged_inputs_skipped(self):
+        self._assert_second_pass_skipped(mainLoop)
+
+    def test_unchanged_inputs_skipped_async(self):
+        self._assert_second_pass_skipped(lambda ctx: asyncio.run(mainLoopAsync(ctx)))
+
+    def test_changed_channel_reruns_tunnel(self):
+        mainLoop(self.ctx)
+        state_details = {
+            "channels": {"user": {"uuid": FAKE_CHANNEL_UUID, "ip": "10.0.0.2"}}
+        }
+        hardware = dict(
+            FAKE_HARDWARE,
+            workers=[{"worker_type": "tunelo", "state_details": state_details}],
+        )
+        self.ctx.doni.get_hardware.side_effect = _slow(hardware).side_effect
+        self.ctx.invalidate_hardware()
+        mainLoop(self.ctx)
+
+        self.assertEqual(self.ctx.tunelo.get_channel.call_count, 2)
+        self.ctx.supervisor.sync_device_hostname.assert_called_once()
+
+    def test_periodic_full_reconcile(self):
+        mainLoop(self.ctx)
+        self.now += 600
+        self.ctx.invalidate_hardware()
+        mainLoop(self.ctx)
+
+        self.assertEqual(self.ctx.supervisor.sync_device_hostname.call_count, 2)
+        self.assertEqual(self.ctx.tunelo.get_channel.call_count, 2)
+
+    def test_full_reconcile_repairs_edited_config(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        manager = WireguardManager(
+            wg_config_dir=tmpdir.name, wg_command=fakes.FakeWgCommand()
+        )
+        manager.get_wireguard_keys = Mock(return_value=("priv", "pub"))
+        self.ctx.wg_manager = self.ctx.wg_managers["user"] = manager
+        self.ctx.tunelo.get_channel = _slow(fakes.FAKE_TUNELO_CHANNEL)
+        # the first sync brings up the node IP, which restarts k3s
+        self.ctx.supervisor.get_state.return_value = SupervisorState(
+            {"containers": [{"serviceName": "k3s"}]}
+        )
+        self.ctx.supervisor.restart_service.return_value = ["k3s"]
+        wg_conf = Path(tmpdir.name, "wg-calico.conf")
+
+        mainLoop(self.ctx)
+        written = wg_conf.read_text()
+        wg_conf.write_text("[Interface]\nPrivateKey = edited\n")
+
+        # inputs are unchanged, so the edit is only noticed by a full reconcile
+        self.ctx.invalidate_hardware()
+        mainLoop(self.ctx)
+        self.assertNotEqual(wg_conf.read_text(), written)
+
+        self.now += 600
+        self.ctx.invalidate_hardware()
+        mainLoop(self.ctx)
+        self.assertEqual(wg_conf.read_text(), written)
+
+    def test_failed_step_retried(self):
+        self.ctx.wg_manager.sync_config.side_effect = [
+            RuntimeError("disk full"),
+            ChangeSet(),
+        ]
+        with self.assertRaises(RuntimeError):
+            mainLoop(self.ctx)
+        self.ctx.invalidate_hardware()
+        mainLoop(self.ctx)
+
+        self.assertEqual(self.ctx.wg_manager.sync_config.call_count, 2)
+
+
+class TestMultiChannel(unittest.TestCase):
+    MGMT_CHANNEL_UUID = "0c9d8e7f-6a5b-4c3d-8e2f-1a0b9c8d7e6f"
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.hardware = dict(
+            FAKE_HARDWARE,
+            workers=[
+                {
+                    "worker_type": "tunelo",
+                    "state_details": {
+                        "channels": {
+                            "user": {"uuid": FAKE_CHANNEL_UUID},
+                            "mgmt": {"uuid": self.MGMT_CHANNEL_UUID},
+                        }
+                    },
+                }
+            ],
+            properties={"channels": {"mgmt": {}, "serial": {"channel_type": "serial"}}},
+        )
+        self.ctx = FakeContext()
+        self.ctx.doni.get_hardware.side_effect = _slow(self.hardware).side_effect
+
+    def _assert_each_channel_reconciled(self):
+        self.assertEqual(sorted(self.ctx.wg_managers), ["mgmt", "user"])
+        # both keys go out in a single patch
+        self.ctx.doni.patch_hardware.assert_called_once()
+        patch_paths = sorted(
+            op["path"] for op in self.ctx.doni.patch_hardware.call_args.kwargs["jsonpatch"]
+        )
+        self.assertEqual(
+            patch_paths, ["/properties/channels/mgmt", "/properties/channels/user"]
+        )
+        self.assertEqual(
+            sorted(c.args[0] for c in self.ctx.tunelo.get_channel.call_args_list),
+            sorted([FAKE_CHANNEL_UUID, self.MGMT_CHANNEL_UUID]),
+        )
+        self.ctx.wg_managers["user"].sync_config.assert_called_once_with(
+            fakes.FAKE_CHANNEL, "priv"
+        )
+        self.ctx.wg_managers["mgmt"].sync_config.assert_called_once_with(
+            fakes.FAKE_CHANNEL, "mgmt-priv"
+        )
+
+    def test_each_channel_reconciled(self):
+        mainLoop(self.ctx)
+        self._assert_each_channel_reconciled()
+
+    def test_each_channel_reconciled_async(self):
+        asyncio.run(mainLoopAsync(self.ctx))
+        self._assert_each_channel_reconciled()
+
+    def test_only_user_channel_address_restarts_k3s(self):
+        mgmt = self.ctx.tunnel_manager("mgmt")
+        mgmt.apply_live.return_value = {"address": True}
+        self.ctx.wg_manager.apply_live.return_value = {"address": False}
+
+        with patch.dict(os.environ, {"WG_LIVE_APPLY": "1"}):
+            apply_tunnel_changes(
+                self.ctx,
+                {
+                    "mgmt": TunnelUpdate(ChangeSet(bind_ip=True), {}, "mgmt-priv"),
+                    "user": TunnelUpdate(ChangeSet(peers_changed=("hub",)), {}, "priv"),
+                },
+            )
+
+        mgmt.apply_live.assert_called_once()
+        self.ctx.wg_manager.apply_live.assert_called_once()
+        self.ctx.supervisor.restart_service.assert_not_called()
+        self.assertEqual(self.ctx.restart_stats["k3s_restarts_avoided"], 1)
+
+
+class TestApplyTunnelChanges(unittest.TestCase):
+    """The coordinator picks the least disruptive action for each kind of change."""
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.ctx = FakeContext()
+        self.state = SupervisorState({"containers": [{"serviceName": "k3s-fake-01"}]})
+        self.ctx.supervisor.get_state.return_value = self.state
+        self.ctx.supervisor.restart_service.return_value = ["k3s-fake-01"]
+        self.ctx.wg_manager.apply_live.return_value = {"address": False}
+
+    def _apply(self, changes):
+        with patch.dict(os.environ, {"WG_LIVE_APPLY": "1"}):
+            apply_tunnel_changes(
+                self.ctx, {"user": TunnelUpdate(changes, fakes.FAKE_TUNELO_CHANNEL, "priv")}
+            )
+
+    def test_no_changes(self):
+        self._apply(ChangeSet())
+        self.ctx.wg_manager.apply_live.assert_not_called()
+
+    def test_peer_change_applied_live(self):
+        self._apply(ChangeSet(peers_changed=("hub",)))
+
+        self.ctx.wg_manager.apply_live.assert_called_once()
+        self.ctx.supervisor.restart_service.assert_not_called()
+        self.ctx.supervisor.restart_services.assert_not_called()
+        self.assertEqual(self.ctx.restart_stats["k3s_restarts_avoided"], 1)
+        self.assertEqual(self.ctx.restart_stats["wireguard_restarts_avoided"], 1)
+
+    def test_bind_ip_restarts_only_k3s(self):
+        self._apply(ChangeSet(bind_ip=True))
+
+        # the service is found and restarted from one supervisor state fetch
+        self.ctx.supervisor.get_state.assert_called_once()
+        self.ctx.supervisor.restart_service.assert_called_once_with(
+            "k3s-fake-01", state=self.state
+        )
+        self.ctx.supervisor.restart_services.assert_not_called()
+        self.assertEqual(self.ctx.restart_stats["k3s_restarts"], 1)
+
+    def test_live_apply_failure_restarts_both(self):
+        self.ctx.wg_manager.apply_live.side_effect = LiveApplyError("no interface")
+        self.ctx.supervisor.restart_services.return_value = ["wireguard", "k3s-fake-01"]
+
+        self._apply(ChangeSet(peers_changed=("hub",)))
+
+        self.ctx.supervisor.restart_services.assert_called_once()
+        self.assertEqual(
+            self.ctx.supervisor.restart_services.call_args.args[0],
+            ["wireguard", "k3s-fake-01"],
+        )
+        self.assertEqual(self.ctx.restart_stats["wireguard_restarts"], 1)
+
+    def test_new_channel_restarts_only_wireguard(self):
+        """A new non-user channel has no interface yet, but k3s doesn't use it."""
+
+        mgmt = self.ctx.tunnel_manager("mgmt")
+        mgmt.apply_live.side_effect = LiveApplyError("no interface")
+        self.ctx.supervisor.restart_services.return_value = ["wireguard"]
+
+        with patch.dict(os.environ, {"WG_LIVE_APPLY": "1"}):
+            apply_tunnel_changes(
+                self.ctx,
+                {
+                    "mgmt": TunnelUpdate(
+                        ChangeSet(bind_ip=True), fakes.FAKE_TUNELO_CHANNEL, "priv"
+                    )
+                },
+            )
+
+        self.assertEqual(
+            self.ctx.supervisor.restart_services.call_args.args[0], ["wireguard"]
+        )
+        self.assertEqual(self.ctx.restart_stats["k3s_restarts_avoided"], 1)
+
+
+class TestApplyUpdateLock(unittest.TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.ctx = FakeContext()
+        self.now = datetime.now(timezone.utc).replace(tzinfo=None)
+
+    def _reservation(self, start, end):
+        return {"start_date": start.isoformat(), "end_date": end.isoformat()}
+
+    def test_wakes_at_guard_boundary(self):
+        allocations = [
+            self._reservation(self.now + timedelta(minutes=20), self.now + timedelta(hours=1))
+        ]
+        delay = apply_update_lock(self.ctx, fakes.FAKE_DEVICE_NAME, allocations)
+
+        self.ctx.update_lock.release.assert_called_once()
+        # 20 minutes to the start, minus the 15 minute guard
+        self.assertAlmostEqual(delay, 5 * 60, delta=5)
+
+    def test_wakes_at_reservation_end(self):
+        allocations = [
+            self._reservation(self.now - timedelta(hours=1), self.now + timedelta(minutes=2))
+        ]
+        delay = apply_update_lock(self.ctx, fakes.FAKE_DEVICE_NAME, allocations)
+
+        self.ctx.update_lock.acquire.assert_called_once()
+        self.assertAlmostEqual(delay, 2 * 60, delta=5)
+
+    def test_no_reservations(self):
+        self.assertIsNone(apply_update_lock(self.ctx, fakes.FAKE_DEVICE_NAME, []))
+        self.assertIsNone(apply_update_lock(self.ctx, fakes.FAKE_DEVICE_NAME, None))
+
+
+class TestBootFromSnapshot(unittest.TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.ctx = FakeContext()
+        self.ctx.doni.get_hardware.side_effect = ConnectionError("keystone unreachable")
+        self.ctx.wg_manager.sync_config.return_value = ChangeSet(bind_ip=True)
+
+    def test_live_iteration_records_snapshot(self):
+        ctx = FakeContext()
+        mainLoop(ctx)
+
+        self.assertEqual(ctx.snapshot.get("hardware"), FAKE_HARDWARE)
+        self.assertEqual(ctx.snapshot.get("channels"), {"user": fakes.FAKE_CHANNEL})
+        self.assertEqual(ctx.snapshot.get("allocations"), [])
+
+    def test_boots_without_cloud(self):
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        active = {
+            "start_date": (now - timedelta(hours=1)).isoformat(),
+            "end_date": (now + timedelta(hours=1)).isoformat(),
+        }
+        self.ctx.snapshot.update("hardware", FAKE_HARDWARE)
+        self.ctx.snapshot.update("channels", {"user": fakes.FAKE_TUNELO_CHANNEL})
+        self.ctx.snapshot.update("allocations", [active])
+
+        with patch("chi_edge_coordinator.coordinator.apply_tunnel_changes") as apply:
+            boot_from_snapshot(self.ctx)
+
+        self.ctx.doni.get_hardware.assert_not_called()
+        self.ctx.tunelo.get_channel.assert_not_called()
+        self.ctx.update_lock.acquire.assert_called_once()
+        self.ctx.wg_manager.sync_config.assert_called_once_with(
+            fakes.FAKE_TUNELO_CHANNEL, "priv"
+        )
+        apply.assert_called_once()
+        # the snapshot's record stands in until doni answers
+        self.assertEqual(self.ctx.hardware_name_hint(), fakes.FAKE_DEVICE_NAME)
+        self.assertTrue(self.ctx._stale)
+
+    def test_no_snapshot(self):
+        boot_from_snapshot(self.ctx)
+
+        self.ctx.wg_manager.sync_config.assert_not_called()
+        self.ctx.update_lock.acquire.assert_not_called()
+        self.ctx.update_lock.release.assert_not_called()
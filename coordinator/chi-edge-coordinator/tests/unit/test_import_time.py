@@ -0,0 +1,50 @@
+import os
+import subprocess
+import sys
+import unittest
+
+MODULE = "chi_edge_coordinator.coordinator"
+# generous for a developer machine; a regression here is far slower on the device
+IMPORT_BUDGET_MS = float(os.getenv("COORDINATOR_IMPORT_BUDGET_MS", "150"))
+# only needed once a live service is contacted, or by the opt-in async engine
+DEFERRED_MODULES = ("keystoneauth1", "requests", "asyncio")
+
+
+def _run(code, *args):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    return subprocess.run(
+        [sys.executable, *args, "-c", code],
+        capture_output=True,
+        check=True,
+        text=True,
+        env=env,
+    )
+
+
+def _import_time_ms() -> float:
+    """Cumulative import time of the coordinator, as reported by -X importtime."""
+
+    stderr = _run(f"import {MODULE}", "-X", "importtime").stderr
+    for line in stderr.splitlines():
+        fields = [field.strip() for field in line.split("|")]
+        if len(fields) == 3 and fields[2] == MODULE:
+            return int(fields[1]) / 1000
+    raise AssertionError(f"{MODULE} missing from -X importtime output")
+
+
+class TestImportTime(unittest.TestCase):
+    def test_heavy_imports_deferred(self):
+        code = (
+            f"import sys, {MODULE}; "
+            f"print(','.join(m for m in {DEFERRED_MODULES!r} if m in sys.modules))"
+        )
+        self.assertEqual(_run(code).stdout.strip(), "")
+
+    def test_import_time_budget(self):
+        # best of a few runs, to ignore a cold disk cache
+        elapsed = min(_import_time_ms() for _ in range(3))
+        self.assertLess(
+            elapsed,
+            IMPORT_BUDGET_MS,
+            f"importing {MODULE} took {elapsed:.0f}ms, budget is {IMPORT_BUDGET_MS:.0f}ms",
+        )
@@ -0,0 +1,98 @@
+import unittest
+import urllib.request
+from unittest.mock import Mock, patch
+
+from chi_edge_coordinator import metrics
+from chi_edge_coordinator.clients.balena import BalenaSupervisorClient
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.registry = metrics.Registry()
+
+    def test_counter_exposition(self):
+        counter = metrics.Counter(
+            "restarts_total", "Restarts.", ["service"], registry=self.registry
+        )
+        counter.inc(service="k3s")
+        counter.inc(2, service="wireguard")
+
+        self.assertEqual(
+            self.registry.exposition(),
+            "# HELP restarts_total Restarts.\n"
+            "# TYPE restarts_total counter\n"
+            'restarts_total{service="k3s"} 1.0\n'
+            'restarts_total{service="wireguard"} 2.0\n',
+        )
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = metrics.Histogram(
+            "latency_seconds", "Latency.", buckets=(0.1, 1.0), registry=self.registry
+        )
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+
+        lines = self.registry.exposition().splitlines()
+        self.assertIn('latency_seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('latency_seconds_bucket{le="1.0"} 2', lines)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 3', lines)
+        self.assertIn("latency_seconds_count 3", lines)
+        self.assertIn("latency_seconds_sum 5.55", lines)
+
+    def test_rejects_wrong_labels(self):
+        counter = metrics.Counter(
+            "restarts_total", "Restarts.", ["service"], registry=self.registry
+        )
+        with self.assertRaises(ValueError):
+            counter.inc(phase="tunnel_sync")
+
+    def test_function_value(self):
+        gauge = metrics.Gauge("held", "Held.", registry=self.registry)
+        gauge.set_function(lambda: True)
+
+        self.assertIn("held 1.0", self.registry.exposition().splitlines())
+
+    def test_supervisor_requests_are_observed(self):
+        client = BalenaSupervisorClient("http://supervisor", "key")
+        response = Mock(ok=False, status_code=400, _content=b"{}")
+        response.json.return_value = {}
+        before_count = metrics.REQUEST_DURATION.count(client="supervisor", method="GET")
+        before_errors = metrics.REQUEST_ERRORS.value(client="supervisor")
+        before_bytes = metrics.REQUEST_BYTES.value(client="supervisor")
+
+        with patch.object(client.session, "request", return_value=response):
+            client.call_supervisor("/v2/state/status")
+
+        self.assertEqual(
+            metrics.REQUEST_DURATION.count(client="supervisor", method="GET"),
+            before_count + 1,
+        )
+        self.assertEqual(
+            metrics.REQUEST_ERRORS.value(client="supervisor"), before_errors + 1
+        )
+        self.assertEqual(
+            metrics.REQUEST_BYTES.value(client="supervisor"), before_bytes + 2
+        )
+
+    def test_phase_failures_are_counted(self):
+        before = metrics.PHASE_FAILURES.value(phase="test_phase")
+
+        with self.assertRaises(RuntimeError):
+            with metrics.observe_phase("test_phase"):
+                raise RuntimeError("tunelo unavailable")
+
+        self.assertEqual(metrics.PHASE_FAILURES.value(phase="test_phase"), before + 1)
+        self.assertEqual(metrics.PHASE_DURATION.count(phase="test_phase"), 1)
+
+    def test_http_server(self):
+        server = metrics.start_http_server(0, addr="127.0.0.1")
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        port = server.server_address[1]
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+            body = response.read().decode()
+
+        self.assertIn("# TYPE coordinator_request_duration_seconds histogram", body)
@@ -1,11 +1,21 @@
+from chi_edge_coordinator import deadline
 from chi_edge_coordinator.clients.openstack import (
     BlazarClient,
+    CountingApplicationCredential,
+    DeadlineSession,
     DoniClient,
     TuneloClient,
 )
+import json
+import tempfile
+import time
 import unittest
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
 from unittest.mock import Mock, patch
 
+from keystoneauth1 import exceptions as ks_exc
+
 from tests.unit import fakes
 
 
@@ -28,6 +38,53 @@ class TestTuneloClient(unittest.TestCase):
             patched_request.assert_called_with(url="/channels/fake_channel")
 
 
+class TestDeadlineSession(unittest.TestCase):
+    @patch("chi_edge_coordinator.clients.openstack.Session.request")
+    def test_timeout_bounded_by_deadline(self, patched_request: Mock):
+        session = DeadlineSession(timeout=30)
+
+        session.request("http://doni/v1/hardware/", "GET")
+        self.assertEqual(patched_request.call_args.kwargs["timeout"], 30)
+
+        with deadline.deadline(5):
+            session.request("http://doni/v1/hardware/", "GET")
+        self.assertLessEqual(patched_request.call_args.kwargs["timeout"], 5)
+
+    @patch("chi_edge_coordinator.clients.openstack.Session.request")
+    def test_expired_deadline(self, patched_request: Mock):
+        session = DeadlineSession(timeout=30)
+
+        with deadline.deadline(0), self.assertRaises(deadline.DeadlineExceeded):
+            session.request("http://doni/v1/hardware/", "GET")
+        patched_request.assert_not_called()
+
+
+class TestCountingApplicationCredential(unittest.TestCase):
+    @patch(
+        "chi_edge_coordinator.clients.openstack"
+        ".application_credential.ApplicationCredential.get_auth_ref"
+    )
+    def test_counts_reused_tokens(self, patched_get_auth_ref: Mock):
+        auth_ref = Mock(auth_token="token")
+        auth_ref.will_expire_soon.return_value = False
+        patched_get_auth_ref.return_value = auth_ref
+        auth = CountingApplicationCredential(
+            auth_url="http://keystone/v3",
+            application_credential_id="id",
+            application_credential_secret="secret",
+        )
+
+        for _ in range(3):
+            self.assertEqual(auth.get_headers(Mock()), {"X-Auth-Token": "token"})
+        self.assertEqual(auth.tokens_issued, 1)
+        self.assertEqual(auth.tokens_reused, 2)
+
+        auth_ref.will_expire_soon.return_value = True
+        auth.get_headers(Mock())
+        self.assertEqual(auth.tokens_issued, 2)
+        self.assertEqual(auth.tokens_reused, 2)
+
+
 class TestDoniClient(unittest.TestCase):
     """Tests for Doni hardware/inventory client implementation."""
 
@@ -56,6 +113,71 @@ class TestDoniClient(unittest.TestCase):
         )
 
 
+class TestResponseCache(unittest.TestCase):
+    """Tests for conditional GET caching shared by the OpenStack clients."""
+
+    def setUp(self) -> None:
+        self.client = DoniClient(fakes.FAKE_APP_CREDENTIAL)
+        self.path = "/v1/hardware/22-33-44-55"
+        super().setUp()
+
+    @patch("chi_edge_coordinator.clients.openstack.Adapter.get")
+    def test_etag_revalidation(self, patched_get: Mock):
+        patched_get.side_effect = [
+            _response(fakes.FAKE_HARDWARE, headers={"ETag": '"v1"'}),
+            _response(None, status_code=304),
+        ]
+
+        first = self.client.get_hardware(fakes.FAKE_HARDWARE_UUID)
+        second = self.client.get_hardware(fakes.FAKE_HARDWARE_UUID)
+
+        self.assertEqual(second, first)
+        patched_get.assert_called_with(url=self.path, headers={"If-None-Match": '"v1"'})
+        stats = self.client.cache_stats[self.path]
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+        self.assertEqual(stats["bytes_saved"], len(json.dumps(fakes.FAKE_HARDWARE)))
+
+    @patch("chi_edge_coordinator.clients.openstack.Adapter.get")
+    def test_last_modified_changed(self, patched_get: Mock):
+        updated = dict(fakes.FAKE_HARDWARE, name="renamed")
+        patched_get.side_effect = [
+            _response(fakes.FAKE_HARDWARE, headers={"Last-Modified": "yesterday"}),
+            _response(updated, headers={"Last-Modified": "today"}),
+        ]
+
+        self.client.get_hardware(fakes.FAKE_HARDWARE_UUID)
+        result = self.client.get_hardware(fakes.FAKE_HARDWARE_UUID)
+
+        self.assertEqual(result, updated)
+        patched_get.assert_called_with(
+            url=self.path, headers={"If-Modified-Since": "yesterday"}
+        )
+        self.assertEqual(self.client.cache_stats[self.path]["misses"], 2)
+
+    @patch("chi_edge_coordinator.clients.openstack.Adapter.get")
+    def test_ttl_without_validators(self, patched_get: Mock):
+        patched_get.return_value = _response(fakes.FAKE_HARDWARE)
+
+        self.client.get_json(self.path, ttl=60)
+        self.client.get_json(self.path, ttl=60)
+        patched_get.assert_called_once_with(url=self.path)
+
+        # the default is to always refetch when the server gives no validators
+        self.client.get_json(self.path)
+        self.assertEqual(patched_get.call_count, 2)
+
+    @patch("chi_edge_coordinator.clients.openstack.Adapter.patch")
+    @patch("chi_edge_coordinator.clients.openstack.Adapter.get")
+    def test_patch_invalidates(self, patched_get: Mock, patched_patch: Mock):
+        patched_get.return_value = _response(fakes.FAKE_HARDWARE, headers={"ETag": '"v1"'})
+
+        self.client.get_hardware(fakes.FAKE_HARDWARE_UUID)
+        self.client.patch_hardware(fakes.FAKE_HARDWARE_UUID, fakes.FAKE_HARDWARE_PATCH)
+        self.client.get_hardware(fakes.FAKE_HARDWARE_UUID)
+
+        patched_get.assert_called_with(url=self.path)
+
+
 class TestBlazarClient(unittest.TestCase):
 
     def setUp(self):
@@ -73,15 +195,136 @@ class TestBlazarClient(unittest.TestCase):
         result = self.client.get_device_id("nonexistent-device")
         self.assertIsNone(result)
 
+    @patch("chi_edge_coordinator.clients.openstack.Adapter.get")
+    def test_get_device_id_cached(self, patched_get: Mock):
+        patched_get.return_value.json.return_value = fakes.FAKE_BLAZAR_DEVICES_RESPONSE
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_path = Path(tmpdir, "devices.json")
+            client = BlazarClient(fakes.FAKE_APP_CREDENTIAL, device_id_cache=cache_path)
+            client.get_device_id(fakes.FAKE_DEVICE_NAME)
+
+            # a new client, e.g. after a container restart, reads the cache
+            restarted = BlazarClient(fakes.FAKE_APP_CREDENTIAL, device_id_cache=cache_path)
+            result = restarted.get_device_id(fakes.FAKE_DEVICE_NAME)
+
+        self.assertEqual(result, fakes.FAKE_DEVICE_ID)
+        patched_get.assert_called_once_with(url="/devices")
+
+    @patch("chi_edge_coordinator.clients.openstack.Adapter.get")
+    def test_get_device_allocations_scoped(self, patched_get: Mock):
+        patched_get.return_value.json.return_value = fakes.FAKE_BLAZAR_ALLOCATION_RESPONSE
+        result = self.client.get_device_allocations(fakes.FAKE_DEVICE_ID, horizon=None)
+
+        patched_get.assert_called_once_with(
+            url="/devices/{}/allocation".format(fakes.FAKE_DEVICE_ID)
+        )
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0]["id"], "res-1")
+
     @patch("chi_edge_coordinator.clients.openstack.Adapter.get")
     def test_get_device_allocations(self, patched_get: Mock):
-        patched_get.return_value.json.return_value = fakes.FAKE_BLAZAR_ALLOCATIONS_RESPONSE
-        result = self.client.get_device_allocations(fakes.FAKE_DEVICE_ID)
+        """Falls back to the full allocation list if the scoped lookup is missing."""
+        patched_get.side_effect = _blazar_without_scoped_lookup
+        result = self.client.get_device_allocations(fakes.FAKE_DEVICE_ID, horizon=None)
         self.assertEqual(len(result), 1)
         self.assertEqual(result[0]["id"], "res-1")
+        self.assertEqual(
+            _requested_urls(patched_get),
+            [
+                "/devices/{}/allocation".format(fakes.FAKE_DEVICE_ID),
+                "/devices/allocations",
+            ],
+        )
+
+        # the scoped lookup isn't retried once the server is known not to support it
+        patched_get.reset_mock()
+        self.client.get_device_allocations(fakes.FAKE_DEVICE_ID, horizon=None)
+        self.assertEqual(_requested_urls(patched_get), ["/devices/allocations"])
 
     @patch("chi_edge_coordinator.clients.openstack.Adapter.get")
     def test_get_device_allocations_missing(self, patched_get: Mock):
-        patched_get.return_value.json.return_value = fakes.FAKE_BLAZAR_ALLOCATIONS_RESPONSE
-        result = self.client.get_device_allocations("nonexistent-id")
-        self.assertEqual(result, [])
+        patched_get.side_effect = _blazar_without_scoped_lookup
+        result = self.client.get_device_allocations("nonexistent-id", horizon=None)
+        self.assertIsNone(result)
+
+        # an unknown device doesn't mean the server lacks the scoped lookup
+        patched_get.reset_mock()
+        self.client.get_device_allocations(fakes.FAKE_DEVICE_ID, horizon=None)
+        self.assertEqual(
+            _requested_urls(patched_get)[0],
+            "/devices/{}/allocation".format(fakes.FAKE_DEVICE_ID),
+        )
+
+    @patch("chi_edge_coordinator.clients.openstack.Adapter.get")
+    def test_stale_device_id(self, patched_get: Mock):
+        """A device re-enrolled under a new id is looked up again by name."""
+
+        patched_get.side_effect = _blazar_without_scoped_lookup
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_path = Path(tmpdir, "devices.json")
+            cache_path.write_text(
+                json.dumps(
+                    {
+                        fakes.FAKE_DEVICE_NAME: {
+                            "id": "old-device-id",
+                            "fetched_at": time.time(),
+                        }
+                    }
+                )
+            )
+            client = BlazarClient(fakes.FAKE_APP_CREDENTIAL, device_id_cache=cache_path)
+            self.assertEqual(client.get_device_id(fakes.FAKE_DEVICE_NAME), "old-device-id")
+
+            # neither lookup knows the old id: unknown, rather than no reservations
+            self.assertIsNone(client.get_device_allocations("old-device-id"))
+
+            patched_get.side_effect = None
+            patched_get.return_value.json.return_value = (
+                fakes.FAKE_BLAZAR_DEVICES_RESPONSE
+            )
+            self.assertEqual(
+                client.get_device_id(fakes.FAKE_DEVICE_NAME), fakes.FAKE_DEVICE_ID
+            )
+            self.assertNotIn("old-device-id", cache_path.read_text())
+
+    @patch("chi_edge_coordinator.clients.openstack.Adapter.get")
+    def test_get_device_allocations_horizon(self, patched_get: Mock):
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        past = _reservation("past", now - timedelta(hours=3), now - timedelta(hours=1))
+        active = _reservation("active", now - timedelta(hours=1), now + timedelta(hours=1))
+        later = _reservation("later", now + timedelta(days=3), now + timedelta(days=4))
+        patched_get.return_value.json.return_value = {
+            "allocation": {
+                "resource_id": fakes.FAKE_DEVICE_ID,
+                "reservations": [past, active, later],
+            }
+        }
+
+        result = self.client.get_device_allocations(
+            fakes.FAKE_DEVICE_ID, horizon=timedelta(days=1)
+        )
+        self.assertEqual([r["id"] for r in result], ["active"])
+
+
+def _reservation(res_id, start, end):
+    return {"id": res_id, "start_date": start.isoformat(), "end_date": end.isoformat()}
+
+
+def _response(body, status_code=200, headers=None):
+    return Mock(
+        status_code=status_code,
+        headers=headers or {},
+        content=json.dumps(body).encode(),
+        json=Mock(return_value=body),
+    )
+
+
+def _requested_urls(patched_get: Mock):
+    return [c.kwargs["url"] for c in patched_get.call_args_list]
+
+
+def _blazar_without_scoped_lookup(url, headers=None):
+    if url == "/devices/allocations":
+        # with a validator, so a cached copy is still revalidated with a request
+        return _response(fakes.FAKE_BLAZAR_ALLOCATIONS_RESPONSE, headers={"ETag": '"1"'})
+    raise ks_exc.NotFound()
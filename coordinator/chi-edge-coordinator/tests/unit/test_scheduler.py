@@ -0,0 +1,77 @@
+import unittest
+from unittest.mock import Mock
+
+from chi_edge_coordinator.scheduler import Scheduler, Task
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.clock = FakeClock()
+        self.failing = Mock(side_effect=RuntimeError("blazar timed out"))
+        self.healthy = Mock()
+        self.failing_task = Task("lock", self.failing, interval=60, jitter=0)
+        self.healthy_task = Task("tunnel", self.healthy, interval=60, jitter=0)
+        self.scheduler = Scheduler(
+            [self.failing_task, self.healthy_task], clock=self.clock
+        )
+
+    def test_failure_does_not_block_other_tasks(self):
+        self.scheduler.run_pending()
+
+        self.healthy.assert_called_once()
+        self.assertIsNotNone(self.healthy_task.last_success)
+        self.assertIsNone(self.failing_task.last_success)
+        self.assertEqual(self.healthy_task.next_run, 1060.0)
+
+    def test_exponential_backoff(self):
+        delays = []
+        for _ in range(4):
+            self.clock.now = self.failing_task.next_run
+            self.scheduler.run_pending()
+            delays.append(self.failing_task.next_run - self.clock.now)
+
+        self.assertEqual(delays, [5.0, 10.0, 20.0, 40.0])
+        self.assertEqual(self.failing_task.failures, 4)
+
+    def test_backoff_capped(self):
+        self.failing_task.failures = 20
+        self.assertEqual(self.failing_task.backoff_delay(), 300.0)
+
+    def test_backoff_jitter(self):
+        task = Task("jittery", Mock(), interval=60, jitter=0.5)
+        task.failures = 3
+        for _ in range(20):
+            self.assertTrue(10.0 <= task.backoff_delay() <= 30.0)
+
+    def test_recovery_resets_failures(self):
+        self.scheduler.run_pending()
+        self.failing.side_effect = None
+        self.clock.now = self.failing_task.next_run
+        self.scheduler.run_pending()
+
+        self.assertEqual(self.failing_task.failures, 0)
+        self.assertIsNotNone(self.failing_task.last_success)
+
+    def test_seconds_until_next(self):
+        self.scheduler.run_pending()
+        self.assertEqual(self.scheduler.seconds_until_next(), 5.0)
+
+    def test_task_requests_earlier_run(self):
+        self.healthy.return_value = 12.5
+        self.scheduler.run_pending()
+        self.assertEqual(self.healthy_task.next_run, 1012.5)
+
+        # a hint past the interval doesn't delay the regular run
+        self.healthy.return_value = 600
+        self.clock.now = self.healthy_task.next_run
+        self.scheduler.run_pending()
+        self.assertEqual(self.healthy_task.next_run, 1072.5)
@@ -0,0 +1,69 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from chi_edge_coordinator import tracing
+
+
+class TestTracer(unittest.TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmpdir = tmpdir.name
+        self.trace_file = os.path.join(self.tmpdir, "spans.jsonl")
+        self.profile_dir = os.path.join(self.tmpdir, "profiles")
+
+    def _spans(self):
+        with open(self.trace_file) as f:
+            return [json.loads(line) for line in f]
+
+    def test_spans_are_nested_json_lines(self):
+        tracer = tracing.Tracer(trace_file=self.trace_file)
+
+        with tracer.iteration(number=3):
+            with tracer.span("tunelo_fetch", channel="user"):
+                pass
+
+        child, root = self._spans()
+        self.assertEqual(root["name"], "iteration")
+        self.assertEqual(root["attrs"], {"number": 3})
+        self.assertIsNone(root["parent_id"])
+        self.assertEqual(child["name"], "tunelo_fetch")
+        self.assertEqual(child["parent_id"], root["span_id"])
+        self.assertEqual(child["trace_id"], root["trace_id"])
+        self.assertEqual(child["status"], "ok")
+
+    def test_failed_span(self):
+        tracer = tracing.Tracer(trace_file=self.trace_file)
+
+        with self.assertRaises(RuntimeError):
+            with tracer.span("doni_patch"):
+                raise RuntimeError("doni unavailable")
+
+        (span,) = self._spans()
+        self.assertEqual(span["status"], "error")
+        self.assertEqual(span["error"], "RuntimeError: doni unavailable")
+
+    def test_fast_iteration_is_not_profiled(self):
+        tracer = tracing.Tracer(profile_threshold=10, profile_dir=self.profile_dir)
+
+        with tracer.iteration():
+            pass
+
+        self.assertFalse(os.path.exists(self.profile_dir))
+
+    def test_slow_iterations_profiled_to_bounded_spool(self):
+        tracer = tracing.Tracer(
+            profile_threshold=0.0, profile_dir=self.profile_dir, spool_size=2
+        )
+
+        for _ in range(3):
+            with tracer.iteration():
+                time.sleep(0.01)
+
+        profiles = os.listdir(self.profile_dir)
+        self.assertEqual(len(profiles), 2)
+        self.assertTrue(all(p.endswith(".prof") for p in profiles))
@@ -1,6 +1,7 @@
-from datetime import datetime, timezone
+import random
+from datetime import datetime, timedelta, timezone
 
-from chi_edge_coordinator.update_lock import device_should_lock
+from chi_edge_coordinator.update_lock import ReservationIndex, device_should_lock
 
 NOW = datetime(2026, 3, 20, 18, 0, 0, tzinfo=timezone.utc)
 
@@ -31,3 +32,67 @@ def test_upcoming_within_guard():
 def test_upcoming_outside_guard():
     allocs = [_res("2026-03-20T19:00:00.000000", "2026-03-20T20:00:00.000000")]
     assert device_should_lock(allocs, guard_minutes=15, now=NOW) is False
+
+
+def _at(minutes):
+    """Reservation timestamp `minutes` after NOW, in blazar's format."""
+    return (NOW + timedelta(minutes=minutes)).replace(tzinfo=None).isoformat()
+
+
+def test_index_overlapping_merged():
+    allocs = [
+        _res(_at(60), _at(120)),
+        _res(_at(100), _at(180)),
+        # starts within the guard of the previous end, so merges too
+        _res(_at(190), _at(240)),
+    ]
+    index = ReservationIndex(allocs, guard_minutes=15)
+    assert len(index) == 1
+    assert index.locked(NOW + timedelta(minutes=150)) is True
+    assert index.next_transition(NOW) == NOW + timedelta(minutes=45)
+    assert index.next_transition(NOW + timedelta(minutes=45)) == NOW + timedelta(
+        minutes=240
+    )
+
+
+def test_index_gaps():
+    allocs = [_res(_at(60), _at(120)), _res(_at(300), _at(360))]
+    index = ReservationIndex(allocs, guard_minutes=15)
+    assert len(index) == 2
+    assert index.locked(NOW + timedelta(minutes=200)) is False
+    assert index.next_transition(NOW + timedelta(minutes=200)) == NOW + timedelta(
+        minutes=285
+    )
+    assert index.next_transition(NOW + timedelta(minutes=400)) is None
+
+
+def test_index_boundaries():
+    index = ReservationIndex([_res(_at(60), _at(120))], guard_minutes=15)
+    assert index.locked(NOW + timedelta(minutes=45)) is True
+    assert index.locked(NOW + timedelta(minutes=120)) is False
+
+
+def test_index_matches_linear_scan_on_dense_set():
+    rng = random.Random(42)
+    allocs = []
+    for _ in range(500):
+        start = rng.randint(-2000, 2000)
+        allocs.append(_res(_at(start), _at(start + rng.randint(1, 90))))
+    index = ReservationIndex(allocs, guard_minutes=15)
+
+    def linear_scan(now):
+        guard = timedelta(minutes=15)
+        for res in allocs:
+            start = datetime.fromisoformat(res["start_date"]).replace(tzinfo=timezone.utc)
+            end = datetime.fromisoformat(res["end_date"]).replace(tzinfo=timezone.utc)
+            if end > now and (start - guard) <= now:
+                return True
+        return False
+
+    for minute in range(-2100, 2200, 7):
+        now = NOW + timedelta(minutes=minute)
+        assert index.locked(now) is linear_scan(now)
+        transition = index.next_transition(now)
+        if transition is not None:
+            assert transition > now
+            assert index.locked(transition) is not linear_scan(now)
@@ -0,0 +1,86 @@
+import subprocess
+import unittest
+from unittest.mock import Mock, patch
+
+from chi_edge_coordinator.clients.wgcommand import LiveApplyError, Peer, WgCommand
+
+from tests.unit import fakes
+
+FAKE_INTERFACE = "wg-calico"
+FAKE_WG_DUMP = "\t".join(
+    [fakes.FAKE_WG_PRIVKEY, "pubkey", "51820", "off"]
+) + "\n" + "\t".join(
+    [
+        fakes.FAKE_HUB_PUBKEY,
+        "(none)",
+        "192.0.2.10:51820",
+        "10.20.0.0/24",
+        "1700000000",
+        "100",
+        "200",
+        "15",
+    ]
+) + "\n"
+FAKE_IP_ADDR = (
+    "7: wg-calico    inet 10.20.0.5/24 scope global wg-calico\\"
+    "       valid_lft forever preferred_lft forever\n"
+)
+
+
+class TestWgCommand(unittest.TestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.command = WgCommand()
+
+    @patch("chi_edge_coordinator.clients.wgcommand.subprocess.run")
+    def test_show(self, mock_run: Mock):
+        mock_run.side_effect = [Mock(stdout=FAKE_WG_DUMP), Mock(stdout=FAKE_IP_ADDR)]
+
+        state = self.command.show(FAKE_INTERFACE)
+
+        self.assertEqual(state.private_key, fakes.FAKE_WG_PRIVKEY)
+        self.assertEqual(state.addresses, {"10.20.0.5/24"})
+        self.assertEqual(
+            state.peers[fakes.FAKE_HUB_PUBKEY],
+            Peer(
+                public_key=fakes.FAKE_HUB_PUBKEY,
+                endpoint="192.0.2.10:51820",
+                allowed_ips=frozenset(["10.20.0.0/24"]),
+                persistent_keepalive=15,
+            ),
+        )
+
+    @patch("chi_edge_coordinator.clients.wgcommand.subprocess.run")
+    def test_set_peer(self, mock_run: Mock):
+        peer = Peer(
+            public_key=fakes.FAKE_HUB_PUBKEY,
+            endpoint="192.0.2.10:51820",
+            allowed_ips=frozenset(["10.20.0.0/24"]),
+            persistent_keepalive=15,
+        )
+        self.command.set_peer(FAKE_INTERFACE, peer)
+
+        mock_run.assert_called_once()
+        self.assertEqual(
+            mock_run.call_args.args[0],
+            [
+                "wg", "set", FAKE_INTERFACE, "peer", fakes.FAKE_HUB_PUBKEY,
+                "allowed-ips", "10.20.0.0/24",
+                "endpoint", "192.0.2.10:51820",
+                "persistent-keepalive", "15",
+            ],
+        )
+
+    @patch("chi_edge_coordinator.clients.wgcommand.subprocess.run")
+    def test_failure(self, mock_run: Mock):
+        mock_run.side_effect = subprocess.CalledProcessError(
+            1, ["wg"], stderr="Unable to access interface: No such device"
+        )
+        with self.assertRaises(LiveApplyError):
+            self.command.show(FAKE_INTERFACE)
+
+    @patch("chi_edge_coordinator.clients.wgcommand.subprocess.run")
+    def test_missing_binary(self, mock_run: Mock):
+        mock_run.side_effect = FileNotFoundError("wg")
+        with self.assertRaises(LiveApplyError):
+            self.command.remove_peer(FAKE_INTERFACE, fakes.FAKE_HUB_PUBKEY)
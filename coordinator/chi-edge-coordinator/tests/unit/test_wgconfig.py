@@ -1,7 +1,19 @@
+import base64
+import copy
+import tempfile
 import unittest
+from pathlib import Path
 from unittest.mock import Mock, patch
 
-from chi_edge_coordinator.clients.wgconfig import WireguardManager
+from chi_edge_coordinator.clients.wgcommand import Peer
+from chi_edge_coordinator.clients.wgconfig import (
+    ChangeSet,
+    PeerTable,
+    IFNAMSIZ,
+    WireguardManager,
+    _parse_config,
+    interface_for_channel,
+)
 
 from tests.unit import fakes
 
@@ -34,6 +46,7 @@ class TestWireguardManager(unittest.TestCase):
         self.mock_privkey_path = patch(
             "chi_edge_coordinator.clients.wgconfig.Path"
         ).start()
+        self.addCleanup(patch.stopall)
 
     def test_get_wireguard_keys(self):
         """Case where private key file is already populated"""
@@ -53,6 +66,21 @@ class TestWireguardManager(unittest.TestCase):
         self.assertEqual(privkey, FAKE_PRIVKEY)
         self.assertEqual(pubkey, FAKE_PUBKEY)
 
+    def test_get_wireguard_keys_memoized(self):
+        """The public key is only derived again if the private key changes."""
+
+        self.mock_privkey_path.return_value.read_text.return_value = FAKE_PRIVKEY
+        self.mock_gen_pubkey.return_value = FAKE_PUBKEY
+
+        self.client.get_wireguard_keys()
+        _, pubkey = self.client.get_wireguard_keys()
+        self.assertEqual(pubkey, FAKE_PUBKEY)
+        self.mock_gen_pubkey.assert_called_once()
+
+        self.mock_privkey_path.return_value.read_text.return_value = "rotated"
+        self.client.get_wireguard_keys()
+        self.assertEqual(self.mock_gen_pubkey.call_count, 2)
+
     def test_gen_wg_privkey_empty(self):
         self.mock_privkey_path.return_value.read_text.return_value = None
         self.mock_gen_privkey.return_value = FAKE_PRIVKEY
@@ -89,3 +117,363 @@ class TestWireguardManager(unittest.TestCase):
 
         self.assertEqual(privkey, FAKE_PRIVKEY)
         self.assertEqual(pubkey, FAKE_PUBKEY)
+
+
+class TestNativeKeys(unittest.TestCase):
+    """In-process key handling must match what `wg` would produce."""
+
+    # test vector from RFC 7748 section 6.1
+    RFC_PRIVKEY = "dwdtCnMYpX08FsFyUbJmRd9ML4frwJkqsXf7pR25LCo="
+    RFC_PUBKEY = "hSDwCYkwp1R0i33ctD73Wg2/Og0mOBr066SpjqqbTmo="
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.client = WireguardManager(use_wg_binary=False)
+
+    @patch("chi_edge_coordinator.clients.wgconfig.subprocess.run")
+    def test_public_key(self, mock_run: Mock):
+        pubkey = self.client._generate_public_key(self.RFC_PRIVKEY)
+        self.assertEqual(pubkey, self.RFC_PUBKEY)
+        mock_run.assert_not_called()
+
+    def test_public_key_trailing_newline(self):
+        pubkey = self.client._generate_public_key(self.RFC_PRIVKEY + "\n")
+        self.assertEqual(pubkey, self.RFC_PUBKEY)
+
+    def test_public_key_invalid(self):
+        with self.assertRaises(ValueError):
+            self.client._generate_public_key("dG9vIHNob3J0")
+
+    @patch("chi_edge_coordinator.clients.wgconfig.subprocess.run")
+    def test_private_key(self, mock_run: Mock):
+        privkey = self.client._generate_private_key()
+        mock_run.assert_not_called()
+
+        raw = base64.b64decode(privkey)
+        self.assertEqual(len(raw), 32)
+        # clamped as specified by RFC 7748, same as `wg genkey`
+        self.assertEqual(raw[0] & 7, 0)
+        self.assertEqual(raw[31] & 0xC0, 0x40)
+
+    @patch("chi_edge_coordinator.clients.wgconfig.subprocess.run")
+    def test_wg_binary_fallback(self, mock_run: Mock):
+        mock_run.return_value.stdout = FAKE_PUBKEY + "\n"
+        client = WireguardManager(use_wg_binary=True)
+
+        self.assertEqual(client._generate_public_key(FAKE_PRIVKEY), FAKE_PUBKEY)
+        self.assertEqual(mock_run.call_args.args[0], ["wg", "pubkey"])
+
+
+class TestLiveApply(unittest.TestCase):
+    """Diffing the desired channel against a running interface."""
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.hub = Peer(
+            public_key=fakes.FAKE_HUB_PUBKEY,
+            endpoint="192.0.2.10:51820",
+            allowed_ips=frozenset(["10.20.0.0/24"]),
+            persistent_keepalive=15,
+        )
+        self.interface = fakes.FakeWgCommand(
+            private_key=fakes.FAKE_WG_PRIVKEY,
+            peers={self.hub.public_key: self.hub},
+            addresses={"10.20.0.5/24"},
+        )
+        self.client = WireguardManager(wg_command=self.interface)
+
+    def test_in_sync(self):
+        changes = self.client.apply_live(fakes.FAKE_TUNELO_CHANNEL, fakes.FAKE_WG_PRIVKEY)
+
+        self.assertEqual(self.interface.calls, [])
+        self.assertFalse(changes["address"])
+
+    def test_peer_changed(self):
+        self.interface.peers[self.hub.public_key] = self.hub._replace(
+            endpoint="198.51.100.1:51820"
+        )
+
+        changes = self.client.apply_live(fakes.FAKE_TUNELO_CHANNEL, fakes.FAKE_WG_PRIVKEY)
+
+        self.assertEqual(changes["changed"], [self.hub.public_key])
+        self.assertEqual(self.interface.peers[self.hub.public_key], self.hub)
+        self.assertEqual(self.interface.calls, ["set_peer"])
+
+    def test_peers_added_and_removed(self):
+        stale = self.hub._replace(public_key="stale-peer")
+        self.interface.peers = {stale.public_key: stale}
+
+        changes = self.client.apply_live(fakes.FAKE_TUNELO_CHANNEL, fakes.FAKE_WG_PRIVKEY)
+
+        self.assertEqual(changes["added"], [self.hub.public_key])
+        self.assertEqual(changes["removed"], ["stale-peer"])
+        self.assertEqual(list(self.interface.peers), [self.hub.public_key])
+
+    def test_address_and_key_changed(self):
+        self.interface.private_key = "old-key"
+        self.interface.addresses = {"10.20.0.9/24"}
+
+        changes = self.client.apply_live(fakes.FAKE_TUNELO_CHANNEL, fakes.FAKE_WG_PRIVKEY)
+
+        self.assertTrue(changes["private_key"])
+        self.assertTrue(changes["address"])
+        self.assertEqual(self.interface.addresses, {"10.20.0.5/24"})
+        # the new address is added before the old one is dropped
+        self.assertEqual(
+            self.interface.calls, ["set_private_key", "add_address", "remove_address"]
+        )
+
+
+class TestSyncConfig(unittest.TestCase):
+    """sync_config reports which parts of the tunnel config changed."""
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.client = WireguardManager(wg_config_dir=self.tmpdir.name)
+        self.channel = copy.deepcopy(fakes.FAKE_TUNELO_CHANNEL)
+
+    def test_first_sync(self):
+        changes = self.client.sync_config(self.channel, fakes.FAKE_WG_PRIVKEY)
+
+        self.assertTrue(changes.interface_key)
+        self.assertTrue(changes.bind_ip)
+        self.assertEqual(changes.peers_added, (fakes.FAKE_HUB_PUBKEY,))
+
+        wg_conf = Path(self.tmpdir.name, "wg-calico.conf")
+        self.assertIn(f"PrivateKey = {fakes.FAKE_WG_PRIVKEY}", wg_conf.read_text())
+        self.assertEqual(
+            Path(self.tmpdir.name, "wg-calico.ipv4").read_text(), "10.20.0.5/24"
+        )
+
+    def test_unchanged(self):
+        self.client.sync_config(self.channel, fakes.FAKE_WG_PRIVKEY)
+        changes = self.client.sync_config(self.channel, fakes.FAKE_WG_PRIVKEY)
+        self.assertFalse(changes)
+
+    def test_steady_state_no_file_io(self):
+        self.client.sync_config(self.channel, fakes.FAKE_WG_PRIVKEY)
+
+        with patch.object(Path, "read_text") as mock_read, patch(
+            "chi_edge_coordinator.clients.wgconfig.utils.atomic_write"
+        ) as mock_write:
+            changes = self.client.sync_config(self.channel, fakes.FAKE_WG_PRIVKEY)
+
+        self.assertFalse(changes)
+        mock_read.assert_not_called()
+        mock_write.assert_not_called()
+
+    def test_existing_config_read_once(self):
+        """A fresh manager, e.g. after a restart, compares against what's on disk."""
+
+        self.client.sync_config(self.channel, fakes.FAKE_WG_PRIVKEY)
+        restarted = WireguardManager(wg_config_dir=self.tmpdir.name)
+
+        self.assertFalse(restarted.sync_config(self.channel, fakes.FAKE_WG_PRIVKEY))
+
+    def test_file_modes(self):
+        self.client.sync_config(self.channel, fakes.FAKE_WG_PRIVKEY)
+
+        wg_conf = Path(self.tmpdir.name, "wg-calico.conf")
+        self.assertEqual(wg_conf.stat().st_mode & 0o777, 0o600)
+        # no temporary files are left behind
+        self.assertEqual(
+            sorted(p.name for p in Path(self.tmpdir.name).iterdir()),
+            ["wg-calico.conf", "wg-calico.ipv4"],
+        )
+
+    def test_peer_endpoint_changed(self):
+        self.client.sync_config(self.channel, fakes.FAKE_WG_PRIVKEY)
+        self.channel["peers"][0]["properties"]["endpoint"] = "198.51.100.1:51820"
+
+        changes = self.client.sync_config(self.channel, fakes.FAKE_WG_PRIVKEY)
+
+        self.assertEqual(changes.peers_changed, (fakes.FAKE_HUB_PUBKEY,))
+        self.assertFalse(changes.bind_ip)
+        self.assertFalse(changes.interface_key)
+
+    def test_peer_replaced(self):
+        self.client.sync_config(self.channel, fakes.FAKE_WG_PRIVKEY)
+        self.channel["peers"][0]["properties"]["public_key"] = "new-hub-key"
+
+        changes = self.client.sync_config(self.channel, fakes.FAKE_WG_PRIVKEY)
+
+        self.assertEqual(changes.peers_added, ("new-hub-key",))
+        self.assertEqual(changes.peers_removed, (fakes.FAKE_HUB_PUBKEY,))
+
+    def test_bind_ip_changed(self):
+        self.client.sync_config(self.channel, fakes.FAKE_WG_PRIVKEY)
+        self.channel["properties"]["ip"] = "10.20.0.6"
+
+        changes = self.client.sync_config(self.channel, fakes.FAKE_WG_PRIVKEY)
+
+        self.assertEqual(changes, ChangeSet(bind_ip=True))
+
+    def test_invalid_peer_address(self):
+        # shorthand that inet_aton would accept as 10.0.0.1
+        self.channel["peers"][0]["properties"]["ip"] = "10.1"
+
+        with self.assertRaises(ValueError):
+            self.client.sync_config(self.channel, fakes.FAKE_WG_PRIVKEY)
+        self.assertFalse(Path(self.tmpdir.name, "wg-calico.conf").exists())
+
+    def test_forget_written(self):
+        """After forget_written, the next sync repairs edits made on disk."""
+
+        self.client.sync_config(self.channel, fakes.FAKE_WG_PRIVKEY)
+        wg_conf = Path(self.tmpdir.name, "wg-calico.conf")
+        written = wg_conf.read_text()
+        wg_conf.unlink()
+
+        self.assertFalse(self.client.sync_config(self.channel, fakes.FAKE_WG_PRIVKEY))
+        self.client.forget_written()
+        changes = self.client.sync_config(self.channel, fakes.FAKE_WG_PRIVKEY)
+
+        self.assertTrue(changes.interface_key)
+        self.assertEqual(wg_conf.read_text(), written)
+
+    def test_channel_prefix(self):
+        self.channel["properties"]["ip"] = "10.20.0.5/16"
+
+        changes = self.client.sync_config(self.channel, fakes.FAKE_WG_PRIVKEY)
+
+        self.assertTrue(changes.bind_ip)
+        self.assertEqual(
+            Path(self.tmpdir.name, "wg-calico.ipv4").read_text(), "10.20.0.5/16"
+        )
+        wg_conf = Path(self.tmpdir.name, "wg-calico.conf")
+        self.assertIn("AllowedIPs = 10.20.0.0/16", wg_conf.read_text())
+
+    def test_failed_write_retried(self):
+        self.client.sync_config(self.channel, fakes.FAKE_WG_PRIVKEY)
+        self.channel["peers"][0]["properties"]["endpoint"] = "198.51.100.1:51820"
+
+        with patch(
+            "chi_edge_coordinator.clients.wgconfig.utils.atomic_write",
+            side_effect=OSError("Read-only file system"),
+        ):
+            with self.assertRaises(OSError):
+                self.client.sync_config(self.channel, fakes.FAKE_WG_PRIVKEY)
+
+        changes = self.client.sync_config(self.channel, fakes.FAKE_WG_PRIVKEY)
+
+        self.assertEqual(changes.peers_changed, (fakes.FAKE_HUB_PUBKEY,))
+        wg_conf = Path(self.tmpdir.name, "wg-calico.conf")
+        self.assertIn("Endpoint = 198.51.100.1:51820", wg_conf.read_text())
+
+
+class TestInterfaceForChannel(unittest.TestCase):
+    def test_user_channel(self):
+        self.assertEqual(interface_for_channel("user"), "wg-calico")
+
+    def test_short_name(self):
+        self.assertEqual(interface_for_channel("mgmt"), "wg-mgmt")
+
+    def test_long_names_sharing_a_prefix(self):
+        first = interface_for_channel("management-east")
+        second = interface_for_channel("management-west")
+
+        self.assertNotEqual(first, second)
+        for interface in (first, second):
+            self.assertLessEqual(len(interface), IFNAMSIZ)
+            self.assertTrue(interface.startswith("wg-manag."))
+
+    def test_name_clashing_with_user_channel(self):
+        self.assertNotEqual(interface_for_channel("calico"), "wg-calico")
+
+    def test_invalid_characters(self):
+        interface = interface_for_channel("a/b c")
+        self.assertRegex(interface, r"^wg-abc\.[0-9a-f]{6}$")
+        self.assertNotEqual(interface, interface_for_channel("a b/c"))
+
+
+def _spoke(index, endpoint=True):
+    properties = {
+        "public_key": f"spoke-{index}",
+        "ip": f"10.20.{index // 250}.{index % 250 + 2}",
+    }
+    if endpoint:
+        properties["endpoint"] = f"192.0.2.{index % 250 + 1}:51820"
+    return {"properties": properties}
+
+
+class TestHubMode(unittest.TestCase):
+    """A hub keeps a table of spoke peers and only redoes the ones that changed."""
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.interface = fakes.FakeWgCommand()
+        self.client = WireguardManager(
+            wg_config_dir=self.tmpdir.name, wg_command=self.interface, hub=True
+        )
+        self.channel = {
+            "properties": {"ip": "10.20.0.1"},
+            "peers": [_spoke(i) for i in range(3)] + [_spoke(3, endpoint=False)],
+        }
+
+    def test_spokes_configured(self):
+        changes = self.client.sync_config(self.channel, fakes.FAKE_WG_PRIVKEY)
+
+        self.assertEqual(len(changes.peers_added), 4)
+        config_text = Path(self.tmpdir.name, "wg-calico.conf").read_text()
+        private_key, peers = _parse_config(config_text)
+        self.assertEqual(private_key, fakes.FAKE_WG_PRIVKEY)
+        self.assertEqual(peers["spoke-1"].allowed_ips, {"10.20.0.3/32"})
+        self.assertIsNone(peers["spoke-1"].persistent_keepalive)
+        # spokes behind NAT have no endpoint, but are still peers
+        self.assertIsNone(peers["spoke-3"].endpoint)
+
+    def test_only_changed_spokes_rebuilt(self):
+        changes = self.client.sync_config(self.channel, fakes.FAKE_WG_PRIVKEY)
+        self.client.apply_peer_changes(changes)
+        self.interface.calls.clear()
+        self.channel["peers"][1]["properties"]["ip"] = "10.20.9.9"
+        del self.channel["peers"][2]
+
+        changes = self.client.sync_config(self.channel, fakes.FAKE_WG_PRIVKEY)
+
+        self.assertEqual(changes.peers_changed, ("spoke-1",))
+        self.assertEqual(changes.peers_removed, ("spoke-2",))
+        self.assertFalse(changes.peers_added)
+        self.assertFalse(changes.interface_key)
+
+        self.assertEqual(self.client.apply_peer_changes(changes), 2)
+        self.assertEqual(self.interface.calls, ["remove_peer", "set_peer"])
+        self.assertEqual(self.interface.peers["spoke-1"].allowed_ips, {"10.20.9.9/32"})
+
+    def test_unchanged_not_rendered(self):
+        self.client.sync_config(self.channel, fakes.FAKE_WG_PRIVKEY)
+
+        with patch.object(PeerTable, "render") as mock_render:
+            changes = self.client.sync_config(self.channel, fakes.FAKE_WG_PRIVKEY)
+
+        self.assertFalse(changes)
+        mock_render.assert_not_called()
+
+    def test_existing_config_read_once(self):
+        self.client.sync_config(self.channel, fakes.FAKE_WG_PRIVKEY)
+        restarted = WireguardManager(wg_config_dir=self.tmpdir.name, hub=True)
+
+        self.assertFalse(restarted.sync_config(self.channel, fakes.FAKE_WG_PRIVKEY))
+
+    def test_live_apply_spoke_without_endpoint(self):
+        changes = self.client.apply_live(self.channel, fakes.FAKE_WG_PRIVKEY)
+        self.assertEqual(len(changes["added"]), 4)
+
+        # the interface learns where the spoke is from its handshake
+        roaming = self.interface.peers["spoke-3"]._replace(endpoint="203.0.113.7:4500")
+        self.interface.peers["spoke-3"] = roaming
+        self.interface.calls.clear()
+
+        changes = self.client.apply_live(self.channel, fakes.FAKE_WG_PRIVKEY)
+        self.assertEqual(changes["changed"], [])
+        self.assertEqual(self.interface.calls, [])
+
+    def test_no_spokes_yet(self):
+        self.channel["peers"] = []
+
+        changes = self.client.sync_config(self.channel, fakes.FAKE_WG_PRIVKEY)
+        self.assertTrue(changes.interface_key)
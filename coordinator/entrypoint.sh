@@ -1,3 +1,3 @@
 #!/bin/sh
 
-python chi-edge-coordinator/src/chi_edge_coordinator/coordinator.py && "$@"
+python -m chi_edge_coordinator && "$@"
@@ -1,13 +1,27 @@
-from functools import wraps
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache, wraps
 import os
 
 import balena
+from balena.exceptions import BalenaException
 import click
 from rich.console import Console
+from rich.progress import Progress
 from rich.table import Table
 
+try:
+    from scripts.release_cache import ReleaseCache, release_cache_option
+except ImportError:
+    # run directly as a file, rather than as part of the package
+    from release_cache import ReleaseCache, release_cache_option
+
 RELEASE_TRACK_TAG = "release_track"
 BETA_RELEASE_TRACK = "beta"
+# devices updated per filtered PATCH; keeps the $in filter well within URL limits
+BATCH_SIZE = 50
+DEFAULT_CONCURRENCY = 4
+# Balena API requests per minute, across all workers
+DEFAULT_REQUEST_LIMIT = 250
 
 console = Console()
 
@@ -23,36 +37,56 @@ def main(token: str = None):
     pass
 
 
-def _balena_client(token):
-    client = balena.Balena()
+def _balena_client(token, request_limit=None):
+    # the SDK throttles requests itself, and waits out a 429 before retrying
+    settings = {"retry_rate_limited_request": True}
+    if request_limit:
+        settings.update(request_limit=str(request_limit), request_limit_interval="60")
+    client = balena.Balena(settings)
     client.auth.login_with_token(token)
     return client
 
 
-def _canary_devices_for_fleet(balena_client: "balena.Balena", fleet: str):
-    fleet_model = balena_client.models.application.get(fleet)
-    device_tags = balena_client.models.device.tags.get_all_by_application(
-        fleet_model["id"]
-    )
+def _fleet_id(balena_client: "balena.Balena", fleet: str):
+    """Resolve a fleet id, slug or name to its id; the SDK accepts any of these."""
+    if fleet.isdigit():
+        return int(fleet)
+    return balena_client.models.application.get(fleet, {"$select": ["id"]})["id"]
 
-    device_map = {
-        device["id"]: device
-        for device in balena_client.models.device.get_all_by_application(
-            fleet_model["id"],
-            {"$expand": {"should_be_running__release": {"$select": ["id", "commit"]}}},
-        )
-    }
-    beta_device_ids = [
-        tag["device"]["__id"]
-        for tag in device_tags
-        if tag["tag_key"] == RELEASE_TRACK_TAG and tag["value"] == BETA_RELEASE_TRACK
-    ]
 
-    return [
-        device_map.get(device_id)
-        for device_id in beta_device_ids
-        if device_id in device_map
-    ]
+@lru_cache(maxsize=None)
+def _canary_devices_for_fleet(balena_client: "balena.Balena", fleet: str):
+    """Return the fleet's beta track devices, found with a single device query.
+
+    The tag filter happens on the server, and the result is cached for the rest of
+    the command. Releases are returned as ids; their commits are resolved through
+    the release cache.
+    """
+    return balena_client.models.device.get_all(
+        {
+            "$select": [
+                "id",
+                "uuid",
+                "device_name",
+                "is_pinned_on__release",
+                "should_be_running__release",
+            ],
+            "$filter": {
+                "belongs_to__application": _fleet_id(balena_client, fleet),
+                "device_tag": {
+                    "$any": {
+                        "$alias": "dt",
+                        "$expr": {
+                            "dt": {
+                                "tag_key": RELEASE_TRACK_TAG,
+                                "value": BETA_RELEASE_TRACK,
+                            }
+                        },
+                    }
+                },
+            },
+        }
+    )
 
 
 def _find_device(balena_client: "balena.Balena", device_name: str):
@@ -62,14 +96,97 @@ def _find_device(balena_client: "balena.Balena", device_name: str):
     return matching[0]
 
 
-def _current_canary_release(balena_client: "balena.Balena", fleet: str):
+def _release_id(device, field="should_be_running__release"):
+    return (device.get(field) or {}).get("__id")
+
+
+def _current_canary_release(
+    balena_client: "balena.Balena", fleet: str, release_cache: ReleaseCache
+):
+    """Return the commit of the release deployed to the canary pool, if any."""
     canary_devices = _canary_devices_for_fleet(balena_client, fleet)
     if not canary_devices:
         return None
-    pinned = canary_devices[0].get("should_be_running__release") or []
-    if not pinned:
+    release_id = _release_id(canary_devices[0])
+    if not release_id:
         return None
-    return balena_client.models.release.get(pinned[0]["id"])
+    return release_cache.commit(balena_client, release_id)
+
+
+def _patch_devices(balena_client: "balena.Balena", devices, body, concurrency):
+    """Apply the same change to many devices, with as few requests as possible.
+
+    Devices are updated in batches with a PATCH filtered on their ids, run through
+    a bounded worker pool. If a batch fails, its devices are retried one by one so
+    each gets its own result. Returns a map of device name to error, or None.
+    """
+
+    def patch(batch):
+        ids = [device["id"] for device in batch]
+        balena_client.pine.patch(
+            {
+                "resource": "device",
+                "options": {"$filter": {"id": {"$in": ids}}},
+                "body": body,
+            }
+        )
+
+    def run_batch(batch):
+        try:
+            patch(batch)
+            return {device["device_name"]: None for device in batch}
+        except BalenaException:
+            if len(batch) == 1:
+                raise
+        results = {}
+        for device in batch:
+            try:
+                patch([device])
+                results[device["device_name"]] = None
+            except BalenaException as exc:
+                results[device["device_name"]] = str(exc)
+        return results
+
+    results = {}
+    batches = [devices[i : i + BATCH_SIZE] for i in range(0, len(devices), BATCH_SIZE)]
+    with Progress(console=console, transient=True) as progress, ThreadPoolExecutor(
+        max_workers=concurrency
+    ) as pool:
+        task = progress.add_task("Updating devices", total=len(devices))
+        futures = {pool.submit(run_batch, batch): batch for batch in batches}
+        for future in as_completed(futures):
+            batch = futures[future]
+            try:
+                results.update(future.result())
+            except BalenaException as exc:
+                results.update({device["device_name"]: str(exc) for device in batch})
+            progress.advance(task, len(batch))
+    return results
+
+
+def _print_summary(outcomes):
+    """Print one row per device, from a map of device name to (ok, message)."""
+    table = Table()
+    table.add_column("Device")
+    table.add_column("Result")
+    for device_name, (ok, message) in sorted(outcomes.items()):
+        table.add_row(device_name, f"[green]{message}[/green]" if ok else f"[red]{message}[/red]")
+    console.print(table)
+
+    failed = sum(1 for ok, _ in outcomes.values() if not ok)
+    console.print(f"{len(outcomes) - failed} succeeded, {failed} failed")
+    if failed:
+        raise click.ClickException(f"{failed} devices could not be updated")
+
+
+def _concurrency_option(func):
+    return click.option(
+        "--concurrency",
+        type=click.IntRange(min=1),
+        default=DEFAULT_CONCURRENCY,
+        show_default=True,
+        help="Most API requests to have in flight at once",
+    )(func)
 
 
 def _common_options(func):
@@ -92,13 +209,26 @@ def _common_options(func):
         default="chameleon/chi-edge-workers",
         help="The name of the Balena fleet to operate on",
     )
-    def wrapper(*args, token: str = None, token_file: str = None, **kwargs):
+    @click.option(
+        "--request-limit",
+        type=click.IntRange(min=1),
+        default=DEFAULT_REQUEST_LIMIT,
+        show_default=True,
+        help="Most Balena API requests to make per minute",
+    )
+    def wrapper(
+        *args,
+        token: str = None,
+        token_file: str = None,
+        request_limit: int = None,
+        **kwargs,
+    ):
         if not (token or token_file):
             raise click.UsageError("Either a token or token file must be specified")
         if not token:
             with open(os.path.expanduser(token_file), "r") as f:
                 token = f.read()
-        kwargs["balena_client"] = _balena_client(token)
+        kwargs["balena_client"] = _balena_client(token, request_limit=request_limit)
         return func(*args, **kwargs)
 
     return wrapper
@@ -106,63 +236,99 @@ def _common_options(func):
 
 @main.command()
 @click.argument("release_id")
+@_concurrency_option
+@release_cache_option
 @_common_options
-def deploy(release_id: str, balena_client: "balena.Balena", fleet: str = None):
+def deploy(
+    release_id: str,
+    balena_client: "balena.Balena",
+    release_cache: ReleaseCache,
+    fleet: str = None,
+    concurrency: int = DEFAULT_CONCURRENCY,
+):
     """Deploy a draft release as a canary to a subset of devices in the fleet."""
-    release = balena_client.models.release.get(int(release_id))
-    commit = release["commit"]
+    release_id = int(release_id)
+    commit = release_cache.commit(balena_client, release_id)
+    if not commit:
+        raise click.ClickException(f"No release with id {release_id}")
+
+    outcomes, to_pin = {}, []
     for device in _canary_devices_for_fleet(balena_client, fleet):
-        balena_client.models.device.pin_to_release(device["uuid"], commit)
-        console.print(f"Added {device['device_name']} to canary pool for {commit}")
+        if _release_id(device, "is_pinned_on__release") == release_id:
+            outcomes[device["device_name"]] = (True, f"already pinned to {commit}")
+        else:
+            to_pin.append(device)
+
+    errors = _patch_devices(
+        balena_client, to_pin, {"is_pinned_on__release": release_id}, concurrency
+    )
+    for device_name, error in errors.items():
+        outcomes[device_name] = (
+            (False, error) if error else (True, f"added to canary pool for {commit}")
+        )
+    _print_summary(outcomes)
 
 
 @main.command()
+@_concurrency_option
 @_common_options
-def rollback(balena_client: "balena.Balena", fleet: str = None):
+def rollback(
+    balena_client: "balena.Balena",
+    fleet: str = None,
+    concurrency: int = DEFAULT_CONCURRENCY,
+):
     """Roll back a canary release to the latest stable version."""
+    outcomes, to_track = {}, []
     for device in _canary_devices_for_fleet(balena_client, fleet):
-        device_uuid, device_name = device["uuid"], device["device_name"]
-        if not balena_client.models.device.is_tracking_application_release(device_uuid):
-            balena_client.models.device.track_application_release(device_uuid)
-            console.print(f"Removed {device_name} from canary set")
+        if device.get("is_pinned_on__release"):
+            to_track.append(device)
         else:
-            console.print(f"Device {device_name} already rolled back")
+            outcomes[device["device_name"]] = (True, "already rolled back")
+
+    errors = _patch_devices(
+        balena_client, to_track, {"is_pinned_on__release": None}, concurrency
+    )
+    for device_name, error in errors.items():
+        outcomes[device_name] = (False, error) if error else (True, "removed from canary set")
+    _print_summary(outcomes)
 
 
 @main.command()
+@release_cache_option
 @_common_options
-def show(balena_client: "balena.Balena", fleet: str = None):
+def show(
+    balena_client: "balena.Balena", release_cache: ReleaseCache, fleet: str = None
+):
     """Show information about the current release deployed to the canary pool."""
-    release_map = {}
+    devices = _canary_devices_for_fleet(balena_client, fleet)
+    commits = release_cache.commits(
+        balena_client, [_release_id(d) for d in devices if _release_id(d)]
+    )
 
     table = Table()
     table.add_column("Device")
     table.add_column("Release")
-    for device in _canary_devices_for_fleet(balena_client, fleet):
-        pinned = device.get("should_be_running__release") or []
-        if pinned:
-            release_id = pinned[0]["id"]
-            if release_id not in release_map:
-                release_map[release_id] = balena_client.models.release.get(release_id)
-            release_commit = release_map[release_id]["commit"]
-        else:
-            release_commit = None
-        table.add_row(device["device_name"], release_commit)
+    for device in devices:
+        table.add_row(device["device_name"], commits.get(_release_id(device)))
 
     console.print(table)
 
 
 @main.command()
 @click.argument("device_name")
+@release_cache_option
 @_common_options
 def add_device(
-    balena_client: "balena.Balena", fleet: str = None, device_name: str = None
+    balena_client: "balena.Balena",
+    release_cache: ReleaseCache,
+    fleet: str = None,
+    device_name: str = None,
 ):
     """Add a device to the canary pool.
 
     This will immediately apply the canary release to this device, if one is deployed.
     """
-    canary_release = _current_canary_release(balena_client, fleet)
+    canary_release = _current_canary_release(balena_client, fleet, release_cache)
 
     device = _find_device(balena_client, device_name)
     balena_client.models.device.tags.set(
@@ -172,9 +338,10 @@ def add_device(
 
     # Also apply the latest canary build... if any
     if canary_release:
-        release_id = canary_release["commit"]
-        balena_client.models.device.pin_to_release(device["uuid"], release_id)
-        console.print(f"Applying existing canary release {release_id} to {device_name}")
+        balena_client.models.device.pin_to_release(device["uuid"], canary_release)
+        console.print(
+            f"Applying existing canary release {canary_release} to {device_name}"
+        )
 
 
 @main.command()
@@ -1,4 +1,9 @@
+import csv
+import json
 import os
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 
 import balena as balena_sdk
@@ -6,8 +11,20 @@ import click
 from rich.console import Console
 from rich.table import Table
 
+try:
+    from scripts.release_cache import ReleaseCache, release_cache_option
+except ImportError:
+    # run directly as a file, rather than as part of the package
+    from release_cache import ReleaseCache, release_cache_option
+
 console = Console()
 
+# devices fetched per request, and how many of those requests run at once
+PAGE_SIZE = 200
+DEFAULT_CONCURRENCY = 4
+
+FIELDS = ["device_type", "device_name", "online", "last_seen", "os_version", "running", "pinned"]
+
 
 def time_ago(iso_str):
     if not iso_str:
@@ -23,11 +40,92 @@ def time_ago(iso_str):
     return f"{delta.seconds // 60}m ago"
 
 
+def release_id(resource, field):
+    return (resource.get(field) or {}).get("__id")
+
+
+def device_pages(client, fleet, concurrency):
+    """Yield the fleet's devices a page at a time, in id order.
+
+    Up to `concurrency` pages are requested ahead of the one being consumed. More
+    are requested until a page comes back short, which marks the end of the fleet.
+    """
+
+    def fetch(page):
+        return client.models.device.get_all_by_application(fleet, {
+            "$select": ["device_name", "os_version", "is_online", "last_connectivity_event",
+                        "is_running__release", "is_pinned_on__release", "is_of__device_type"],
+            "$expand": {
+                "is_of__device_type": {"$select": ["slug"]},
+            },
+            "$orderby": "id asc",
+            "$top": PAGE_SIZE,
+            "$skip": page * PAGE_SIZE,
+        })
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        in_flight = deque(pool.submit(fetch, page) for page in range(concurrency))
+        next_page = concurrency
+        while in_flight:
+            devices = in_flight.popleft().result()
+            if len(devices) < PAGE_SIZE:
+                # the last page; anything still in flight is past the end
+                for future in in_flight:
+                    future.cancel()
+                in_flight.clear()
+            else:
+                in_flight.append(pool.submit(fetch, next_page))
+                next_page += 1
+            if devices:
+                yield devices
+
+
+def device_rows(client, fleet, release_cache, concurrency):
+    """Yield a dict of FIELDS for each device, as its page arrives."""
+    for devices in device_pages(client, fleet, concurrency):
+        # one lookup per page, for the releases that aren't cached yet
+        commits = release_cache.commits(client, [
+            r for d in devices
+            for r in (release_id(d, "is_running__release"), release_id(d, "is_pinned_on__release"))
+            if r
+        ])
+        for d in devices:
+            yield {
+                "device_type": (d.get("is_of__device_type") or [{}])[0].get("slug", "unknown"),
+                "device_name": d.get("device_name", "unknown"),
+                "online": d.get("is_online", False),
+                "last_seen": d.get("last_connectivity_event"),
+                "os_version": (d.get("os_version") or "N/A").removeprefix("balenaOS "),
+                "running": commits.get(release_id(d, "is_running__release")),
+                "pinned": commits.get(release_id(d, "is_pinned_on__release")),
+            }
+
+
+def write_jsonl(rows):
+    for row in rows:
+        sys.stdout.write(json.dumps(row) + "\n")
+        sys.stdout.flush()
+
+
+def write_csv(rows):
+    writer = csv.DictWriter(sys.stdout, fieldnames=FIELDS)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        sys.stdout.flush()
+
+
 @click.command()
 @click.option("--token", default=os.getenv("BALENA_TOKEN"), metavar="TOKEN")
 @click.option("--token-file", default="~/.balena/token", metavar="FILE")
 @click.option("--fleet", default="chameleon/chi-edge-workers", metavar="NAME")
-def main(token, token_file, fleet):
+@click.option("--format", "output_format", type=click.Choice(["table", "jsonl", "csv"]),
+              default="table", show_default=True,
+              help="jsonl and csv write each device as soon as it is fetched")
+@click.option("--concurrency", type=click.IntRange(min=1), default=DEFAULT_CONCURRENCY,
+              show_default=True, help="Most pages of devices to fetch at once")
+@release_cache_option
+def main(token, token_file, fleet, output_format, concurrency, release_cache: ReleaseCache):
     """Show release and OS status for all devices in the fleet."""
     if not token:
         with open(os.path.expanduser(token_file)) as f:
@@ -36,28 +134,30 @@ def main(token, token_file, fleet):
     client = balena_sdk.Balena()
     client.auth.login_with_token(token)
 
+    rows = device_rows(client, fleet, release_cache, concurrency)
+    if output_format == "jsonl":
+        write_jsonl(rows)
+        return
+    if output_format == "csv":
+        write_csv(rows)
+        return
+
+    # releases are fetched as ids, and their commits resolved through the cache
     app = client.models.application.get(fleet, {
-        "$expand": {"should_be_running__release": {"$select": ["commit"]}}
+        "$select": ["id", "should_be_running__release"],
     })
-    fleet_pinned = ((app.get("should_be_running__release") or [{}])[0]).get("commit")
+    fleet_pinned_id = release_id(app, "should_be_running__release")
+    fleet_pinned = release_cache.commit(client, fleet_pinned_id) if fleet_pinned_id else None
 
     latest_releases = client.models.release.get_all_by_application(fleet, {
-        "$select": ["commit"],
+        "$select": ["id", "commit"],
         "$filter": {"is_final": True, "status": "success"},
         "$orderby": "created_at desc",
         "$top": 1,
     })
     latest = latest_releases[0]["commit"] if latest_releases else None
-
-    devices = client.models.device.get_all_by_application(fleet, {
-        "$select": ["device_name", "os_version", "is_online", "last_connectivity_event",
-                    "is_running__release", "is_pinned_on__release", "is_of__device_type"],
-        "$expand": {
-            "is_running__release": {"$select": ["commit"]},
-            "is_pinned_on__release": {"$select": ["commit"]},
-            "is_of__device_type": {"$select": ["slug"]},
-        },
-    })
+    if latest:
+        release_cache.put(latest_releases[0]["id"], latest)
 
     def short(c):
         return c[:7] if c else "N/A"
@@ -74,32 +174,31 @@ def main(token, token_file, fleet):
     table.add_column("Running")
     table.add_column("Pinned")
 
-    rows = []
-    for d in devices:
-        device_type = (d.get("is_of__device_type") or [{}])[0].get("slug", "unknown")
-        name = d.get("device_name", "unknown")
-        online = d.get("is_online", False)
-        last_seen = d.get("last_connectivity_event")
-        os_version = (d.get("os_version") or "N/A").removeprefix("balenaOS ")
-        running = (d.get("is_running__release") or [{}])[0].get("commit")
-        pinned = (d.get("is_pinned_on__release") or [{}])[0].get("commit")
-        rows.append((device_type, name, online, last_seen, os_version, running, pinned))
-
-    for device_type, name, online, last_seen, os_version, running, pinned in sorted(rows, key=lambda x: (x[0], not x[2], x[1])):
-        if online:
+    # the table is sorted, so it needs every device before it can be printed
+    with console.status("Fetching devices...") as status:
+        sorted_rows = []
+        for row in rows:
+            sorted_rows.append(row)
+            status.update(f"Fetching devices... {len(sorted_rows)}")
+    sorted_rows.sort(key=lambda r: (r["device_type"], not r["online"], r["device_name"]))
+
+    for row in sorted_rows:
+        if row["online"]:
             online_str = "[green]yes[/green]"
         else:
-            online_str = f"[red]no[/red] [dim]{time_ago(last_seen)}[/dim]"
+            online_str = f"[red]no[/red] [dim]{time_ago(row['last_seen'])}[/dim]"
 
+        running = row["running"]
         running_str = short(running)
         if running == latest:
             running_str = f"[green]{running_str}[/green]"
         elif running != fleet_pinned:
             running_str = f"[yellow]{running_str}[/yellow]"
 
-        pinned_str = short(pinned) if pinned else "[dim]fleet[/dim]"
+        pinned_str = short(row["pinned"]) if row["pinned"] else "[dim]fleet[/dim]"
 
-        table.add_row(device_type, name, online_str, os_version, running_str, pinned_str)
+        table.add_row(row["device_type"], row["device_name"], online_str, row["os_version"],
+                      running_str, pinned_str)
 
     console.print(table)
 
@@ -0,0 +1,133 @@
+"""On-disk cache of Balena release commits, shared by the fleet scripts.
+
+A release id always refers to the same commit, so once looked up it never needs to
+be fetched again. Entries are kept in a small JSON file in the user's cache
+directory, least recently used first, and the oldest are evicted once there are
+more than MAX_ENTRIES.
+"""
+
+import json
+import os
+import tempfile
+import threading
+from functools import wraps
+
+import click
+
+MAX_ENTRIES = 2048
+# release ids looked up per request; keeps the $in filter well within URL limits
+LOOKUP_BATCH_SIZE = 50
+
+
+def default_path():
+    cache_home = os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "chi-edge-workers", "releases.json")
+
+
+class ReleaseCache(object):
+    """Map of release id to commit, persisted between runs unless disabled."""
+
+    def __init__(self, path=None, max_entries=MAX_ENTRIES, persistent=True) -> None:
+        self.path = path or default_path()
+        self.max_entries = max_entries
+        self.persistent = persistent
+        self._lock = threading.Lock()
+        self._commits = {}
+        self._dirty = False
+        if persistent:
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+            self._commits = {
+                int(k): v for k, v in entries.items() if isinstance(v, str)
+            }
+        except (OSError, ValueError, AttributeError):
+            # missing or corrupt, start over
+            self._commits = {}
+
+    def save(self):
+        if not (self.persistent and self._dirty):
+            return
+        with self._lock:
+            entries = {str(k): v for k, v in self._commits.items()}
+            self._dirty = False
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path))
+            with os.fdopen(fd, "w") as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.path)
+        except OSError as exc:
+            click.echo(f"Could not save release cache to {self.path}: {exc}", err=True)
+
+    def get(self, release_id):
+        with self._lock:
+            commit = self._commits.pop(release_id, None)
+            if commit is not None:
+                # move to the most recently used end; this alone doesn't make the
+                # cache dirty, so runs that only read it never rewrite the file, and
+                # the order on disk is brought up to date with the next new entry
+                self._commits[release_id] = commit
+            return commit
+
+    def put(self, release_id, commit):
+        with self._lock:
+            self._commits.pop(release_id, None)
+            self._commits[release_id] = commit
+            while len(self._commits) > self.max_entries:
+                del self._commits[next(iter(self._commits))]
+            self._dirty = True
+
+    def commits(self, balena_client, release_ids) -> dict:
+        """Commits for the given release ids, fetching only those not cached."""
+
+        found, missing = {}, []
+        for release_id in set(release_ids):
+            commit = self.get(release_id)
+            if commit is None:
+                missing.append(release_id)
+            else:
+                found[release_id] = commit
+
+        for i in range(0, len(missing), LOOKUP_BATCH_SIZE):
+            releases = balena_client.pine.get(
+                {
+                    "resource": "release",
+                    "options": {
+                        "$select": ["id", "commit"],
+                        "$filter": {"id": {"$in": missing[i : i + LOOKUP_BATCH_SIZE]}},
+                    },
+                }
+            )
+            for release in releases:
+                self.put(release["id"], release["commit"])
+                found[release["id"]] = release["commit"]
+        return found
+
+    def commit(self, balena_client, release_id):
+        """Commit for a single release id, or None if there is no such release."""
+
+        return self.commits(balena_client, [release_id]).get(release_id)
+
+
+def release_cache_option(func):
+    """Add a --no-cache flag, and pass the command a `release_cache`."""
+
+    @click.option(
+        "--no-cache",
+        is_flag=True,
+        help="Look up every release, without reading or updating the on-disk cache",
+    )
+    @wraps(func)
+    def wrapper(*args, no_cache: bool = False, **kwargs):
+        release_cache = ReleaseCache(persistent=not no_cache)
+        kwargs["release_cache"] = release_cache
+        try:
+            return func(*args, **kwargs)
+        finally:
+            release_cache.save()
+
+    return wrapper
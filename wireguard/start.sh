@@ -12,21 +12,32 @@ set -x
 
 wg_up() {
   local iface="$1"
-  local suffix="${iface##wg-}"
   local wg_conf=/etc/wireguard/"$iface".conf
   if [[ ! -f "$wg_conf" ]]; then
     abort "No wireguard configuration found."
   fi
   ip link del dev "$iface" 2>/dev/null || true
-  ip link add dev "$iface" type wireguard
+  # each step checks its own status: errexit doesn't apply when the caller
+  # handles a failure with ||
+  ip link add dev "$iface" type wireguard || return 1
 
   read wg_ipv4 </etc/wireguard/"$iface".ipv4 || true
-  wg syncconf "$iface" "$wg_conf"
-  ip address add "$wg_ipv4" dev "$iface"
-  ip link set up dev "$iface"
+  wg syncconf "$iface" "$wg_conf" || return 1
+  ip address add "$wg_ipv4" dev "$iface" || return 1
+  ip link set up dev "$iface" || return 1
 }
 
+# the user channel carries k3s, so it must exist; other channels are optional, and
+# one that fails to come up (e.g. no address assigned yet) mustn't take it down
 wg_up wg-calico
+for wg_conf in /etc/wireguard/wg-*.conf; do
+  iface="$(basename "$wg_conf" .conf)"
+  [[ "$iface" == wg-calico ]] && continue
+  if ! wg_up "$iface"; then
+    echo "Failed to bring up $iface, skipping" >&2
+    ip link del dev "$iface" 2>/dev/null || true
+  fi
+done
 
 set +x
 